@@ -4,6 +4,8 @@ import subprocess
 import os
 import time
 import json
+import urllib.request
+import urllib.error
 import cv2
 import shutil
 import warnings
@@ -11,6 +13,8 @@ from PIL import Image
 
 warnings.filterwarnings("ignore")
 
+SMPLIFYX_SERVER = os.environ.get("SMPLIFYX_SERVER", "http://127.0.0.1:8765")
+
 
 def extract_frames(video_file, output_dir, max_frames=1):
     """
@@ -98,17 +102,43 @@ def run_smplifyx(data_folder, output_folder, model_folder, vposer_ckpt):
     """
     Runs SMPLify-X on the OpenPose keypoints for 3D mesh fitting.
 
+    The job is sent to the fitting server given by the SMPLIFYX_SERVER environment variable,
+    which keeps the models loaded. If no server is running, SMPLify-X is started as a new process.
+    Relative paths are resolved from the smplify-x folder.
+
     Args:
         data_folder (str): Directory containing OpenPose keypoints.
         output_folder (str): Directory to store the 3D mesh output.
-        model_folder (str): Path to SMPL-X model files.
-        vposer_ckpt (str): Path to VPoser checkpoint file.
+        model_folder (str): Path to SMPL-X model files. Only used without a server.
+        vposer_ckpt (str): Path to VPoser checkpoint file. Only used without a server.
 
     Returns:
-        None
+        dict: The result paths of the fitted persons when the server was used, else None.
     """    
     smplifyx_root = "../smplify-x"
     os.makedirs(output_folder, exist_ok=True)
+
+    # Send the job to a running fitting server (smplifyx/fit_server.py), which
+    # keeps the models loaded between requests
+    job = {"data_folder": os.path.abspath(os.path.join(smplifyx_root, data_folder)),
+           "output_folder": os.path.abspath(os.path.join(smplifyx_root, output_folder))}
+    request = urllib.request.Request(SMPLIFYX_SERVER + "/fit", data=json.dumps(job).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        # A proxy or a crashed server can answer without a JSON body
+        body = e.read().decode('utf-8', errors='replace')
+        try:
+            error = json.loads(body).get('error')
+        except (ValueError, AttributeError):
+            error = None
+        st.error(f"SMPLify-X failed: {error or body.strip() or e.reason}")
+        return None
+    except urllib.error.URLError:
+        st.warning(f"No fitting server at {SMPLIFYX_SERVER}, starting SMPLify-X for this request.")
+
     command = f"cd {smplifyx_root} && python smplifyx/main.py --config cfg_files/fit_smplx.yaml --data_folder {data_folder} --output_folder {output_folder} --visualize=False --model_folder {model_folder} --vposer_ckpt {vposer_ckpt}"
     subprocess.run(command, shell=True)
 
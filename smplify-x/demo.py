@@ -2,10 +2,14 @@ import streamlit as st
 import subprocess
 import os
 import json
+import urllib.request
+import urllib.error
 from PIL import Image
 import warnings
 warnings.filterwarnings("ignore")
 
+SMPLIFYX_SERVER = os.environ.get("SMPLIFYX_SERVER", "http://127.0.0.1:8765")
+
 def run_openpose(image_file, image_output_dir="../openpose/DATA_FOLDER/images", keypoints_output_dir="../openpose/DATA_FOLDER/keypoints"):
     os.makedirs(image_output_dir, exist_ok=True)
     os.makedirs(keypoints_output_dir, exist_ok=True)
@@ -29,6 +33,27 @@ def run_openpose(image_file, image_output_dir="../openpose/DATA_FOLDER/images",
 
 def run_smplifyx(data_folder, output_folder, model_folder, vposer_ckpt):
     smplifyx_root = os.path.join('..', 'smplify-x')
+    # Send the job to a running fitting server (smplifyx/fit_server.py), which
+    # keeps the models loaded between requests
+    job = {'data_folder': os.path.abspath(os.path.join(smplifyx_root, data_folder)),
+           'output_folder': os.path.abspath(os.path.join(smplifyx_root, output_folder))}
+    request = urllib.request.Request(SMPLIFYX_SERVER + '/fit', data=json.dumps(job).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        # A proxy or a crashed server can answer without a JSON body
+        body = e.read().decode('utf-8', errors='replace')
+        try:
+            error = json.loads(body).get('error')
+        except (ValueError, AttributeError):
+            error = None
+        st.error(f"SMPLify-X failed: {error or body.strip() or e.reason}")
+        return None
+    except urllib.error.URLError:
+        st.warning(f"No fitting server at {SMPLIFYX_SERVER}, starting SMPLify-X for this request.")
+
     command = f"cd {smplifyx_root} && python smplifyx/main.py --config cfg_files/fit_smplx.yaml --data_folder {data_folder} --output_folder {output_folder} --visualize=False --model_folder {model_folder} --vposer_ckpt {vposer_ckpt}"
     subprocess.run(command, shell=True)
 
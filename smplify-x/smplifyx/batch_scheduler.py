@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems and the Max Planck Institute for Biological
+# Cybernetics. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+class BatchScheduler(object):
+    ''' Packs the persons of several frames into fixed-size fitting batches
+
+        Persons are queued per body model, since all the persons of a batch
+        are fitted with the same model. Every person carries the paths of its
+        own frame's result, mesh and image files, so a batch can mix persons
+        of different frames.
+    '''
+
+    def __init__(self, batch_size=1):
+        self.batch_size = batch_size
+        self.queues = OrderedDict()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def add(self, img, keypoints, result_fn, mesh_fn, out_img_fn,
+            group='neutral', person_id=None, init_params=None, frame=None):
+        ''' Adds a person to the queue of its body model
+
+            Parameters
+            ----------
+            img: LazyImage or np.array, HxWx3
+                The image of the frame the person belongs to
+            keypoints: np.array, Jx3
+                The 2D keypoints of the person
+            result_fn, mesh_fn, out_img_fn: str
+                The paths where the fitting results of the person are written
+            group: str, optional
+                The body model used for the person (default='neutral')
+            person_id: int, optional
+                The index of the person in its frame
+            init_params: dict, optional
+                The parameters the fitting of the person starts from. All
+                the persons of a group must either have them or not
+            frame: str, optional
+                The name of the frame the person belongs to
+
+            Returns
+            -------
+                batches: list
+                    The batches that are full after adding the person
+        '''
+        queue = self.queues.setdefault(group, [])
+        queue.append(dict(img=img, keypoints=keypoints, result_fn=result_fn,
+                          mesh_fn=mesh_fn, out_img_fn=out_img_fn,
+                          person_id=person_id, init_params=init_params,
+                          frame=frame))
+        if len(queue) < self.batch_size:
+            return []
+        del self.queues[group]
+        return [self.create_batch(group, queue)]
+
+    def flush(self):
+        ''' Returns the partially filled batches of all the queues '''
+        batches = [self.create_batch(group, queue)
+                   for group, queue in self.queues.items()]
+        self.queues.clear()
+        return batches
+
+    def create_batch(self, group, persons):
+        ''' Builds a fitting batch from a list of queued persons
+
+            Batches with fewer persons than the batch size are filled with
+            copies of their last person. The output paths of the copies are
+            None, so nothing is written for them.
+        '''
+        num_pad = self.batch_size - len(persons)
+        persons = persons + [dict(persons[-1], result_fn=None, mesh_fn=None,
+                                  out_img_fn=None)] * num_pad
+
+        batch = {'group': group, 'num_persons': len(persons) - num_pad,
+                 'keypoints': np.stack([person['keypoints']
+                                        for person in persons])}
+        for key in ['img', 'result_fn', 'mesh_fn', 'out_img_fn',
+                    'person_id', 'frame']:
+            batch[key] = [person[key] for person in persons]
+
+        batch['init_params'] = None
+        if persons[0]['init_params'] is not None:
+            batch['init_params'] = {
+                key: np.concatenate([person['init_params'][key]
+                                     for person in persons])
+                for key in persons[0]['init_params']}
+        return batch
+
+
+def keypoint_extent(keypoints):
+    ''' Returns the center and the size of the detected keypoints
+
+        Parameters
+        ----------
+        keypoints: np.array, Jx3
+            The 2D keypoints of a person, with their confidence
+
+        Returns
+        -------
+            center: np.array, 2
+                The center of the bounding box of the detected keypoints
+            size: float
+                The length of the diagonal of the bounding box, or 0 if no
+                keypoint was detected
+    '''
+    detected = keypoints[keypoints[:, 2] > 0, :2]
+    if len(detected) < 1:
+        return np.zeros(2, dtype=keypoints.dtype), 0.0
+    min_corner, max_corner = detected.min(axis=0), detected.max(axis=0)
+    return ((min_corner + max_corner) / 2,
+            float(np.linalg.norm(max_corner - min_corner)))
+
+
+class WindowScheduler(object):
+    ''' Groups the frames of every person into overlapping windows
+
+        The persons of a frame are matched to the tracks of the previous
+        frame that use the same body model, since OpenPose lists them in
+        detection order and not by identity. A person continues the track
+        whose last keypoints are the nearest, if their centers are closer
+        than `track_dist` times the size of these keypoints. Otherwise, or
+        after a frame without the person, a new track starts. The frames of
+        a track are thus consecutive.
+
+        A window is returned once `window_size` frames of a track are
+        queued. After it has been fitted the oldest `window_stride` frames
+        leave the queue, and the remaining ones are fitted again in the next
+        window, starting from their current fit. A track that ends is
+        returned with its unfitted frames as a last, shorter window.
+    '''
+
+    def __init__(self, window_size=8, window_stride=4, track_dist=0.5):
+        self.window_size = window_size
+        self.window_stride = max(1, min(window_stride, window_size))
+        self.track_dist = track_dist
+        self.tracks = OrderedDict()
+        self.num_tracks = 0
+
+    def add(self, img, keypoints, result_fn, mesh_fn, out_img_fn, frame_idx,
+            group='neutral', person_id=None, frame=None):
+        ''' Adds a frame of a person to its track
+
+            Parameters
+            ----------
+            img: LazyImage or np.array, HxWx3
+                The image of the frame
+            keypoints: np.array, Jx3
+                The 2D keypoints of the person in the frame
+            result_fn, mesh_fn, out_img_fn: str
+                The paths where the fitting results of the frame are written
+            frame_idx: int
+                The index of the frame in the sequence. The frames must be
+                added in order
+            group: str, optional
+                The body model used for the person (default='neutral')
+            person_id: int, optional
+                The index of the person in the keypoint file
+            frame: str, optional
+                The name of the frame
+
+            Returns
+            -------
+                windows: list
+                    The windows that are full after adding the frame, and
+                    the last windows of the tracks that ended before it
+        '''
+        windows = self.end_tracks(frame_idx)
+
+        key = self.match_track(keypoints, frame_idx, group)
+        if key is None:
+            key = (group, self.num_tracks)
+            self.num_tracks += 1
+            self.tracks[key] = {'frames': [], 'params': None, 'ended': False}
+        track = self.tracks[key]
+        track['frames'].append(dict(img=img, keypoints=keypoints,
+                                    result_fn=result_fn, mesh_fn=mesh_fn,
+                                    out_img_fn=out_img_fn, frame=frame,
+                                    frame_idx=frame_idx, person_id=person_id,
+                                    params=None))
+        if len(track['frames']) >= self.window_size:
+            windows.append(self.create_window(key))
+        return windows
+
+    def match_track(self, keypoints, frame_idx, group):
+        ''' Returns the track that a person of a frame continues
+
+            Only the tracks of the body model of the person whose last frame
+            is the previous one can be continued. Returns None if none of
+            them is close enough.
+        '''
+        center, _ = keypoint_extent(keypoints)
+        best_key, best_dist = None, None
+        for key, track in self.tracks.items():
+            last_frame = track['frames'][-1]
+            if (track['ended'] or key[0] != group or
+                    last_frame['frame_idx'] != frame_idx - 1):
+                continue
+            last_center, last_size = keypoint_extent(last_frame['keypoints'])
+            dist = np.linalg.norm(center - last_center)
+            if dist < self.track_dist * last_size and (
+                    best_dist is None or dist < best_dist):
+                best_key, best_dist = key, dist
+        return best_key
+
+    def end_tracks(self, frame_idx):
+        ''' Ends the tracks without a person in the previous frame
+
+            Returns
+            -------
+                windows: list
+                    The last windows of the ended tracks with unfitted frames
+        '''
+        windows = []
+        for key, track in list(self.tracks.items()):
+            if (track['ended'] or
+                    track['frames'][-1]['frame_idx'] >= frame_idx - 1):
+                continue
+            track['ended'] = True
+            if any(frame['params'] is None for frame in track['frames']):
+                windows.append(self.create_window(key))
+            else:
+                del self.tracks[key]
+        return windows
+
+    def flush(self):
+        ''' Returns the last window of every track with unfitted frames '''
+        windows = [self.create_window(key)
+                   for key, track in self.tracks.items()
+                   if any(frame['params'] is None
+                          for frame in track['frames'])]
+        return windows
+
+    def update(self, window, result):
+        ''' Stores the fitted parameters of the frames of a window
+
+            Parameters
+            ----------
+            window: dict
+                A window returned by `add` or `flush`
+            result: dict
+                The fitted parameters, with one row per frame of the window
+        '''
+        track = self.tracks[window['track']]
+        for idx, frame in enumerate(window['frames']):
+            frame['params'] = {key: val[idx:idx + 1]
+                               for key, val in result.items()}
+        track['params'] = window['frames'][-1]['params']
+        if track['ended']:
+            del self.tracks[window['track']]
+        elif len(track['frames']) >= self.window_size:
+            del track['frames'][:self.window_stride]
+
+    def create_window(self, key):
+        ''' Builds a fitting batch from the last frames of a track
+
+            Frames that have already been fitted start from their fit, new
+            frames from the fit of the latest fitted frame. The parameters
+            are only returned if the track has been fitted before.
+        '''
+        track = self.tracks[key]
+        frames = track['frames'][-self.window_size:]
+
+        window = {'group': key[0], 'track': key, 'frames': frames,
+                  'num_persons': len(frames),
+                  'keypoints': np.stack([frame['keypoints']
+                                         for frame in frames])}
+        for name in ['img', 'result_fn', 'mesh_fn', 'out_img_fn', 'frame',
+                     'frame_idx', 'person_id']:
+            window[name] = [frame[name] for frame in frames]
+
+        window['init_params'] = None
+        if track['params'] is not None:
+            frame_params = [track['params'] if frame['params'] is None else
+                            frame['params'] for frame in frames]
+            window['init_params'] = {
+                name: np.concatenate([params[name]
+                                      for params in frame_params])
+                for name in track['params']}
+        return window
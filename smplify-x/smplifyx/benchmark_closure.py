@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems and the Max Planck Institute for Biological
+# Cybernetics. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import time
+import argparse
+
+import numpy as np
+import torch
+
+import fitting
+import utils
+from cmd_parser import parse_config
+from data_parser import create_dataset
+from main import load_models
+
+
+def time_closure(closure, num_evals=100, num_warmup=5, use_cuda=False):
+    ''' Times the evaluations of a fitting closure
+
+        Returns
+        -------
+            first_time: float
+                The time of the first evaluation in seconds, which includes
+                the compilation of the closure
+            eval_time: float
+                The mean time of an evaluation in milliseconds, after the
+                warm-up evaluations
+    '''
+    def synchronize():
+        if use_cuda and torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    synchronize()
+    start = time.time()
+    closure()
+    synchronize()
+    first_time = time.time() - start
+
+    for _ in range(num_warmup):
+        closure()
+    synchronize()
+    start = time.time()
+    for _ in range(num_evals):
+        closure()
+    synchronize()
+    eval_time = (time.time() - start) / num_evals * 1000
+    return first_time, eval_time
+
+
+def main(num_evals=100, num_warmup=5, **args):
+    ''' Compares the time of an eager and a compiled closure evaluation
+
+        The body model is evaluated on the keypoints of the first person of
+        the first image of the data folder, repeated to fill a batch. The
+        cost of an evaluation does not depend on the parameters, so they are
+        left at their initial values.
+    '''
+    dtype, _ = utils.float_dtypes(args.get('float_dtype', 'float32'))
+
+    use_cuda = args.get('use_cuda', True)
+    if use_cuda and not torch.cuda.is_available():
+        print('CUDA is not available, exiting!')
+        sys.exit(-1)
+    device = torch.device('cuda') if use_cuda else torch.device('cpu')
+
+    gender = args.pop('gender', 'neutral')
+    img_folder = args.pop('img_folder', 'images')
+    dataset_obj = create_dataset(img_folder=img_folder, **args)
+    models = load_models(dataset_obj, dtype=dtype, **args)
+
+    batch_size = args.get('batch_size', 1)
+    # SMPL-H has no gender-neutral model
+    body_model = (models['body_models'].get(gender) or
+                  models['body_models']['male'])
+    camera = models['camera']
+    with torch.no_grad():
+        camera.translation[:] = torch.tensor([0.0, 0.0, 20.0], dtype=dtype)
+
+    keypoints = dataset_obj[0]['keypoints'][:1]
+    keypoints = np.repeat(keypoints, batch_size, axis=0)
+    keypoints = torch.tensor(keypoints, dtype=dtype, device=device)
+    gt_joints = keypoints[:, :, :2]
+    joints_conf = keypoints[:, :, 2]
+
+    use_vposer = args.get('use_vposer', True)
+    pose_embedding = None
+    params = [param for param in body_model.parameters()
+              if param.requires_grad] + [camera.translation]
+    if use_vposer:
+        pose_embedding = torch.zeros([batch_size, 32], dtype=dtype,
+                                     device=device, requires_grad=True)
+        params.append(pose_embedding)
+    optimizer = torch.optim.SGD(params, lr=0.0)
+
+    loss = fitting.create_loss(
+        loss_type='smplify', rho=args.get('rho', 100),
+        use_joints_conf=args.get('use_joints_conf', True),
+        use_face=args.get('use_face', True),
+        use_hands=args.get('use_hands', True),
+        body_pose_prior=models['body_pose_prior'],
+        shape_prior=models['shape_prior'],
+        angle_prior=models['angle_prior'],
+        expr_prior=models['expr_prior'],
+        left_hand_prior=models['left_hand_prior'],
+        right_hand_prior=models['right_hand_prior'],
+        jaw_prior=models['jaw_prior'],
+        interpenetration=False,
+        reduction='none' if batch_size > 1 else 'sum',
+        data_weight=1.0, body_pose_weight=1.0, shape_weight=1.0,
+        bending_prior_weight=1.0, hand_prior_weight=1.0,
+        expr_prior_weight=1.0, jaw_prior_weight=1.0,
+        dtype=dtype).to(device=device)
+
+    times = {}
+    for compile_closure in [False, True]:
+        with fitting.FittingMonitor(
+                batch_size=batch_size, compile_closure=compile_closure,
+                model_type=args.get('model_type', 'smplx')) as monitor:
+            closure = monitor.create_fitting_closure(
+                optimizer, body_model, camera=camera, gt_joints=gt_joints,
+                joints_conf=joints_conf,
+                joint_weights=models['joint_weights'], loss=loss,
+                use_vposer=use_vposer, vposer=models['vposer'],
+                pose_embedding=pose_embedding,
+                return_verts=True, return_full_pose=True)
+            times[compile_closure] = time_closure(
+                closure, num_evals=num_evals, num_warmup=num_warmup,
+                use_cuda=use_cuda)
+
+    print('Batch size: {}, device: {}'.format(batch_size, device))
+    for compile_closure, name in [(False, 'Eager'), (True, 'Compiled')]:
+        first_time, eval_time = times[compile_closure]
+        print('{}: {:.3f} ms per evaluation, first evaluation {:.3f} s'.format(
+            name, eval_time, first_time))
+    print('Speedup per evaluation: {:.2f}x'.format(
+        times[False][1] / times[True][1]))
+
+
+if __name__ == "__main__":
+    bench_parser = argparse.ArgumentParser(add_help=False)
+    bench_parser.add_argument('--num_evals', type=int, default=100,
+                              help='The number of timed evaluations')
+    bench_parser.add_argument('--num_warmup', type=int, default=5,
+                              help='The number of evaluations before timing')
+    bench_args, argv = bench_parser.parse_known_args()
+
+    args = parse_config(argv)
+    main(num_evals=bench_args.num_evals, num_warmup=bench_args.num_warmup,
+         **args)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems and the Max Planck Institute for Biological
+# Cybernetics. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os.path as osp
+
+import time
+import json
+import glob
+import pickle
+import argparse
+
+import numpy as np
+
+from cmd_parser import parse_config
+from profiling import PROFILE_FN
+from main import main as fit_main
+
+
+def load_results(output_folder, result_folder='results'):
+    ''' Loads the fitted parameters of every person of an output folder
+
+        Returns
+        -------
+            results: dict
+                The parameters of every person, with the path of its result
+                file, relative to the result folder, as a key
+    '''
+    result_folder = osp.join(output_folder, result_folder)
+    results = {}
+    for result_fn in sorted(glob.glob(osp.join(result_folder, '*', '*.pkl'))):
+        with open(result_fn, 'rb') as result_file:
+            results[osp.relpath(result_fn, result_folder)] = pickle.load(
+                result_file)
+    return results
+
+
+def load_final_losses(output_folder):
+    ''' Returns the final loss of every person, from its profiling records
+
+        The final loss of a person is the loss of the last stage, of the
+        best orientation.
+    '''
+    final = {}
+    with open(osp.join(output_folder, PROFILE_FN)) as profile_file:
+        for line in profile_file:
+            record = json.loads(line)
+            if record['padding'] or record['stage'] == 'camera':
+                continue
+            key = (record['frame'], record['person'])
+            curr = (record['stage'], -record['loss'])
+            final[key] = max(final.get(key, curr), curr)
+    return {key: -neg_loss for key, (_, neg_loss) in final.items()}
+
+
+def main(float_dtypes=('float64', 'mixed', 'float32'), **args):
+    ''' Fits the data folder with every float type and compares the results
+
+        Every fit is written to a sub-folder of the output folder, named
+        after its float type. The first float type is the reference that the
+        final losses and the parameters of the others are compared to.
+    '''
+    output_folder = osp.expandvars(args.pop('output_folder'))
+    result_folder = args.get('result_folder', 'results')
+
+    times, results, losses = {}, {}, {}
+    for float_dtype in float_dtypes:
+        curr_folder = osp.join(output_folder, float_dtype)
+        start = time.time()
+        fit_main(**dict(args, float_dtype=float_dtype,
+                        output_folder=curr_folder, profile=True))
+        times[float_dtype] = time.time() - start
+        results[float_dtype] = load_results(curr_folder, result_folder)
+        losses[float_dtype] = load_final_losses(curr_folder)
+
+    ref_dtype = float_dtypes[0]
+    ref_losses = losses[ref_dtype]
+    print('Reference: {}, {} persons'.format(ref_dtype, len(ref_losses)))
+    for float_dtype in float_dtypes:
+        rel_loss = np.array([
+            (losses[float_dtype][key] - ref_loss) / max(abs(ref_loss), 1)
+            for key, ref_loss in ref_losses.items()])
+        param_diffs = [
+            max(np.abs(np.asarray(params[name], dtype=np.float64) -
+                       np.asarray(results[ref_dtype][fn][name],
+                                  dtype=np.float64)).max()
+                for name in params)
+            for fn, params in results[float_dtype].items()]
+        print('{}: {:.2f} s ({:.2f}x), relative final loss difference:'
+              ' median {:.2e}, max {:.2e}, max parameter difference:'
+              ' median {:.2e}'.format(
+                  float_dtype, times[float_dtype],
+                  times[ref_dtype] / times[float_dtype],
+                  np.median(rel_loss), np.abs(rel_loss).max(),
+                  np.median(param_diffs)))
+
+
+if __name__ == "__main__":
+    bench_parser = argparse.ArgumentParser(add_help=False)
+    bench_parser.add_argument('--float_dtypes', type=str, nargs='+',
+                              default=['float64', 'mixed', 'float32'],
+                              help='The float types that are compared, the' +
+                              ' first one is the reference')
+    bench_args, argv = bench_parser.parse_known_args()
+
+    args = parse_config(argv)
+    main(float_dtypes=bench_args.float_dtypes, **args)
@@ -42,6 +42,8 @@ def create_camera(camera_type='persp', **kwargs):
 class PerspectiveCamera(nn.Module):
 
     FOCAL_LENGTH = 5000
+    # Buffers that hold one value per sample of the batch
+    batch_buffers = ['zero', 'focal_length_x', 'focal_length_y', 'center']
 
     def __init__(self, rotation=None, translation=None,
                  focal_length_x=None, focal_length_y=None,
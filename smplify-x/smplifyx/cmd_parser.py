@@ -77,6 +77,25 @@ def parse_config(argv=None):
                         help='The folder where the images are stored')
     parser.add_argument('--keyp_folder', type=str, default='keypoints',
                         help='The folder where the keypoints are stored')
+    parser.add_argument('--keypoint_store', type=str, default=None,
+                        help='The folder of a keypoint store, compiled from' +
+                        ' the keypoint folder by keypoint_store.py, that' +
+                        ' the keypoints are read from. It is compiled if' +
+                        ' it does not exist yet')
+    parser.add_argument('--img_index', type=str, default=None,
+                        help='A file, relative to the data folder, with the' +
+                        ' sorted names of the images of the image folder.' +
+                        ' It is written the first time and then read' +
+                        ' instead of listing the image folder, until' +
+                        ' the folder changes')
+    parser.add_argument('--start_idx', type=int, default=0,
+                        help='The index of the first image that is fitted')
+    parser.add_argument('--end_idx', type=int, default=None,
+                        help='The index after the last image that is' +
+                        ' fitted. Negative indices count from the end')
+    parser.add_argument('--shard', type=str, default=None,
+                        help='Fit only the k-th of N contiguous shards of' +
+                        ' the images, given as k/N with 0 <= k < N')
     parser.add_argument('--summary_folder', type=str, default='summaries',
                         help='Where to store the TensorBoard summaries')
     parser.add_argument('--result_folder', type=str, default='results',
@@ -93,7 +112,10 @@ def parse_config(argv=None):
                         help='Use gender neutral or gender specific SMPL' +
                         'model')
     parser.add_argument('--float_dtype', type=str, default='float32',
-                        help='The types of floats used')
+                        choices=['float32', 'float64', 'mixed'],
+                        help='The types of floats used. With mixed the' +
+                        ' models are evaluated in float32 and the' +
+                        ' optimizers work in float64')
     parser.add_argument('--model_type', default='smpl', type=str,
                         choices=['smpl', 'smplh', 'smplx'],
                         help='The type of the model that we will fit to the' +
@@ -122,7 +144,27 @@ def parse_config(argv=None):
                         type=lambda x: x.lower() in ['true', '1'],
                         help='Use the confidence scores for the optimization')
     parser.add_argument('--batch_size', type=int, default=1,
-                        help='The size of the batch')
+                        help='The number of persons that are fitted at the' +
+                        ' same time')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='The number of processes that fit frames in' +
+                        ' parallel')
+    parser.add_argument('--num_threads', type=int, default=0,
+                        help='The number of threads used by torch in every' +
+                        ' worker process. If smaller than 1, the cores are' +
+                        ' split evenly among the workers')
+    parser.add_argument('--prefetch_frames', default=4, type=int,
+                        help='The number of frames that are read ahead in' +
+                        ' background threads while a frame is fitted. 0' +
+                        ' reads every frame when it is needed. Worker' +
+                        ' processes read at most one frame ahead')
+    parser.add_argument('--loader_threads', default=2, type=int,
+                        help='The number of threads that read the frames' +
+                        ' ahead')
+    parser.add_argument('--server_host', type=str, default='127.0.0.1',
+                        help='The address the fitting server listens on')
+    parser.add_argument('--server_port', type=int, default=8765,
+                        help='The port the fitting server listens on')
     parser.add_argument('--num_gaussians',
                         default=8,
                         type=int,
@@ -166,6 +208,14 @@ def parse_config(argv=None):
     parser.add_argument('--init_joints_idxs', nargs='*', type=int,
                         default=[9, 12, 2, 5],
                         help='Which joints to use for initializing the camera')
+    parser.add_argument('--camera_init_type', type=str, default='optim',
+                        choices=['optim', 'closed_form'],
+                        help='How the camera translation and the body' +
+                        ' orientation are initialized: with an optimization' +
+                        ' over the torso joints or directly from them')
+    parser.add_argument('--camera_refine_steps', type=int, default=0,
+                        help='The optimizer steps that refine the closed' +
+                        ' form camera initialization')
     parser.add_argument('--body_tri_idxs', nargs='*',
                         #  default='5.12,2.9',
                         default=[5, 12, 2, 9],
@@ -268,6 +318,40 @@ def parse_config(argv=None):
                         'If the pixel distance between the shoulders is less' +
                         ' than this value, two initializations of SMPL fits' +
                         ' are tried.')
+    parser.add_argument('--sequence', default=False,
+                        type=lambda x: x.lower() in ['true', '1'],
+                        help='Treat the images as the frames of a video. The' +
+                        ' fit of every person starts from its fit in the' +
+                        ' previous frame')
+    parser.add_argument('--warm_start_stages', type=int, default=2,
+                        help='The number of final optimization stages that' +
+                        ' are run for a person that starts from the fit of' +
+                        ' the previous frame')
+    parser.add_argument('--warm_start_maxiters', type=int, default=10,
+                        help='The maximum iterations of every stage for a' +
+                        ' person that starts from the fit of the previous' +
+                        ' frame. Values < 1 keep maxiters')
+    parser.add_argument('--window_size', type=int, default=0,
+                        help='If larger than one, the frames of every person' +
+                        ' are fitted jointly in overlapping windows of this' +
+                        ' many frames, with a shared body shape and smooth' +
+                        ' motion')
+    parser.add_argument('--window_stride', type=int, default=4,
+                        help='The number of frames a window advances')
+    parser.add_argument('--velocity_weight', type=float, default=30.0,
+                        help='The weight of the velocity of the pose and the' +
+                        ' camera translation when fitting windows')
+    parser.add_argument('--acceleration_weight', type=float, default=100.0,
+                        help='The weight of the acceleration of the pose and' +
+                        ' the camera translation when fitting windows')
+    parser.add_argument('--orient_stop_ratio',
+                        default=2.0,
+                        type=float,
+                        help='The fitting of one of the two side view' +
+                        ' orientations stops after an optimization stage if' +
+                        ' its loss is larger than this many times the loss' +
+                        ' of the other orientation. Values <= 0 fit both' +
+                        ' orientations until the end.')
     parser.add_argument('--optim_type', type=str, default='adam',
                         help='The optimizer used')
     parser.add_argument('--lr', type=float, default=1e-6,
@@ -278,6 +362,34 @@ def parse_config(argv=None):
                         help='The tolerance threshold for the function')
     parser.add_argument('--maxiters', type=int, default=100,
                         help='The maximum iterations for the optimization')
+    parser.add_argument('--keep_optim_state', default=False,
+                        type=lambda x: x.lower() in ['true', '1'],
+                        help='Keep the update history of the L-BFGS' +
+                        ' optimizer from one fitting stage to the next')
+    parser.add_argument('--joints_only', default=True,
+                        type=lambda x: x.lower() in ['true', '1'],
+                        help='Compute only the joints of the body model,' +
+                        ' without posing its mesh, when no loss term' +
+                        ' needs the vertices')
+    parser.add_argument('--joint_regressor_folder', default=None,
+                        type=str,
+                        help='The folder where the joint regressors of the' +
+                        ' models are cached. Defaults to the' +
+                        ' joint_regressors folder of the model folder')
+    parser.add_argument('--compile_closure', default=False,
+                        type=lambda x: x.lower() in ['true', '1'],
+                        help='Compile the evaluation of the model and of' +
+                        ' the loss with torch.compile. Falls back to eager' +
+                        ' mode if the compilation fails')
+    parser.add_argument('--check_every', type=int, default=1,
+                        help='Read the convergence criteria back from the' +
+                        ' device only every this many iterations')
+    parser.add_argument('--profile', default=False,
+                        type=lambda x: x.lower() in ['true', '1'],
+                        help='Write the wall time, the closure and line' +
+                        ' search evaluations, the iterations, the final loss' +
+                        ' and the exit reason of every fitting stage to' +
+                        ' profile.jsonl in the output folder')
 
     args = parser.parse_args(argv)
 
@@ -23,18 +23,29 @@ import sys
 import os
 import os.path as osp
 
+import time
 import json
+import functools
+import multiprocessing as mp
 
-from collections import namedtuple
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import cv2
 import numpy as np
+from PIL import Image
 
 import torch
 from torch.utils.data import Dataset
 
 
 from utils import smpl_to_openpose
+from keypoint_store import (KeypointStore, compile_keypoint_store,
+                            is_stale_store)
+
+# The first line of an image index, with the modification time of the image
+# folder it lists
+IMG_INDEX_HEADER = '# mtime {!r}'
 
 Keypoints = namedtuple('Keypoints',
                        ['keypoints', 'gender_gt', 'gender_pd'])
@@ -49,55 +60,311 @@ def create_dataset(dataset='openpose', data_folder='data', **kwargs):
         raise ValueError('Unknown dataset: {}'.format(dataset))
 
 
+def num_keypoints(num_body_joints=25, use_hands=True, use_face=True,
+                  use_face_contour=False):
+    ''' Returns the number of keypoints of a person read with these flags '''
+    return (num_body_joints + 2 * 21 * use_hands + 51 * use_face +
+            17 * (use_face and use_face_contour))
+
+
+def fill_keypoints(keypoint_fns, use_hands=True, use_face=True,
+                   use_face_contour=False):
+    ''' Reads the keypoints of several files into one array
+
+        The files are parsed first, so that the array of all their persons
+        is allocated once. It is then filled in one pass straight from the
+        lists of the JSON files, without intermediate arrays. The parts that
+        OpenPose did not detect for a person, written as empty lists, and
+        the parts it was not run for are left at zero. All the persons must
+        have the same number of body keypoints.
+
+        Returns
+        -------
+            keypoints: np.array, PxJx3
+                The keypoints of all the persons of all the files
+            num_people: list
+                The number of persons of every file
+            gender_gt: list
+                The ground truth genders of every file
+            gender_pd: list
+                The predicted genders of every file
+    '''
+    people = []
+    for keypoint_fn in keypoint_fns:
+        with open(keypoint_fn) as keypoint_file:
+            people.append(json.load(keypoint_file)['people'])
+
+    num_people = [len(curr_people) for curr_people in people]
+    num_body_values = 25 * 3
+    if sum(num_people) > 0:
+        first_person = next(curr_people[0] for curr_people in people
+                            if len(curr_people) > 0)
+        num_body_values = len(first_person['pose_keypoints_2d'])
+    num_joints = num_keypoints(num_body_joints=num_body_values // 3,
+                               use_hands=use_hands, use_face=use_face,
+                               use_face_contour=use_face_contour)
+
+    keypoints = np.zeros([sum(num_people), num_joints, 3], dtype=np.float32)
+    # The keypoints of a person are flat lists in the JSON files
+    flat_keypoints = keypoints.reshape([len(keypoints), num_joints * 3])
+    hand_start = num_body_values
+    face_start = hand_start + 2 * 21 * 3 * use_hands
+    contour_start = face_start + 51 * 3
+
+    all_gender_gt, all_gender_pd = [], []
+    idx = 0
+    for keypoint_fn, curr_people in zip(keypoint_fns, people):
+        gender_pd = []
+        gender_gt = []
+        for person_data in curr_people:
+            out = flat_keypoints[idx]
+            idx += 1
+            body_keypoints = person_data['pose_keypoints_2d']
+            if len(body_keypoints) != num_body_values:
+                raise ValueError(
+                    '{}: a person has {} body keypoints instead of {}'.format(
+                        keypoint_fn, len(body_keypoints) // 3,
+                        num_body_values // 3))
+            out[:num_body_values] = body_keypoints
+            if use_hands:
+                left_hand_keyp = person_data.get(
+                    'hand_left_keypoints_2d', [])
+                if len(left_hand_keyp) == 21 * 3:
+                    out[hand_start:hand_start + 21 * 3] = left_hand_keyp
+                right_hand_keyp = person_data.get(
+                    'hand_right_keypoints_2d', [])
+                if len(right_hand_keyp) == 21 * 3:
+                    out[hand_start + 21 * 3:face_start] = right_hand_keyp
+            if use_face:
+                # TODO: Make parameters, 17 is the offset for the eye brows,
+                # etc. 51 is the total number of FLAME compatible landmarks
+                face_keypoints = person_data.get('face_keypoints_2d', [])
+                if len(face_keypoints) >= (17 + 51) * 3:
+                    out[face_start:contour_start] = face_keypoints[
+                        17 * 3:(17 + 51) * 3]
+                if use_face_contour and len(face_keypoints) >= 17 * 3:
+                    out[contour_start:] = face_keypoints[:17 * 3]
+
+            if 'gender_pd' in person_data:
+                gender_pd.append(person_data['gender_pd'])
+            if 'gender_gt' in person_data:
+                gender_gt.append(person_data['gender_gt'])
+        all_gender_pd.append(gender_pd)
+        all_gender_gt.append(gender_gt)
+    return keypoints, num_people, all_gender_gt, all_gender_pd
+
+
+def create_reader_pool(num_workers):
+    ''' Creates the pool of processes of `read_keypoints_batch` '''
+    return ProcessPoolExecutor(max_workers=num_workers,
+                               mp_context=mp.get_context('spawn'))
+
+
+def read_keypoints_batch(keypoint_fns, use_hands=True, use_face=True,
+                         use_face_contour=False, num_workers=1,
+                         executor=None):
+    ''' Reads the keypoints of many OpenPose keypoint files at once
+
+        Parsing JSON holds the global interpreter lock, so with
+        `num_workers` > 1 the files are split in chunks that are read by a
+        pool of processes. Every chunk is read with `fill_keypoints`, and the
+        keypoints of the chunks are gathered in a single array.
+
+        Parameters
+        ----------
+        keypoint_fns: list
+            The paths of the keypoint files
+        use_hands: bool, optional
+            Read the keypoints of the hands (default=True)
+        use_face: bool, optional
+            Read the 51 face landmarks (default=True)
+        use_face_contour: bool, optional
+            Read the 17 keypoints of the face contour, after the face
+            landmarks (default=False)
+        num_workers: int, optional
+            The number of processes that read the files (default=1)
+        executor: ProcessPoolExecutor, optional
+            A pool of `num_workers` processes, which is reused instead of
+            starting a new one for every call (default=None)
+
+        Returns
+        -------
+            keypoints: list
+                The Keypoints of every file. The keypoints of a file are a
+                PxJx3 view of the array of all the files.
+    '''
+    read_chunk = functools.partial(fill_keypoints, use_hands=use_hands,
+                                   use_face=use_face,
+                                   use_face_contour=use_face_contour)
+    if num_workers > 1 and len(keypoint_fns) > 1:
+        # A few chunks per process balance the load between them
+        num_chunks = min(len(keypoint_fns), 4 * num_workers)
+        chunk_size = int(np.ceil(len(keypoint_fns) / num_chunks))
+        chunks = [keypoint_fns[start:start + chunk_size]
+                  for start in range(0, len(keypoint_fns), chunk_size)]
+        if executor is None:
+            with create_reader_pool(num_workers) as executor:
+                results = list(executor.map(read_chunk, chunks))
+        else:
+            results = list(executor.map(read_chunk, chunks))
+    else:
+        results = [read_chunk(keypoint_fns)]
+
+    if len(results) == 1:
+        keypoints = results[0][0]
+    else:
+        # The chunks without persons default to 25 body joints
+        chunk_keypoints = []
+        for chunk, result in zip(chunks, results):
+            if len(result[0]) < 1:
+                continue
+            if (len(chunk_keypoints) > 0 and
+                    result[0].shape[1] != chunk_keypoints[0].shape[1]):
+                raise ValueError(
+                    'The persons from {} on have {} keypoints, not {}'.format(
+                        chunk[0], result[0].shape[1],
+                        chunk_keypoints[0].shape[1]))
+            chunk_keypoints.append(result[0])
+        keypoints = np.concatenate(chunk_keypoints or [results[0][0]])
+    num_people = [num for result in results for num in result[1]]
+    gender_gt = [genders for result in results for genders in result[2]]
+    gender_pd = [genders for result in results for genders in result[3]]
+
+    offsets = np.cumsum([0] + num_people)
+    return [Keypoints(keypoints=keypoints[start:end],
+                      gender_pd=curr_gender_pd, gender_gt=curr_gender_gt)
+            for start, end, curr_gender_pd, curr_gender_gt in zip(
+                offsets[:-1], offsets[1:], gender_pd, gender_gt)]
+
+
 def read_keypoints(keypoint_fn, use_hands=True, use_face=True,
                    use_face_contour=False):
-    with open(keypoint_fn) as keypoint_file:
-        data = json.load(keypoint_file)
-
-    keypoints = []
-
-    gender_pd = []
-    gender_gt = []
-    for idx, person_data in enumerate(data['people']):
-        body_keypoints = np.array(person_data['pose_keypoints_2d'],
-                                  dtype=np.float32)
-        body_keypoints = body_keypoints.reshape([-1, 3])
-        if use_hands:
-            left_hand_keyp = np.array(
-                person_data['hand_left_keypoints_2d'],
-                dtype=np.float32).reshape([-1, 3])
-            right_hand_keyp = np.array(
-                person_data['hand_right_keypoints_2d'],
-                dtype=np.float32).reshape([-1, 3])
-
-            body_keypoints = np.concatenate(
-                [body_keypoints, left_hand_keyp, right_hand_keyp], axis=0)
-        if use_face:
-            # TODO: Make parameters, 17 is the offset for the eye brows,
-            # etc. 51 is the total number of FLAME compatible landmarks
-            face_keypoints = np.array(
-                person_data['face_keypoints_2d'],
-                dtype=np.float32).reshape([-1, 3])[17: 17 + 51, :]
-
-            contour_keyps = np.array(
-                [], dtype=body_keypoints.dtype).reshape(0, 3)
-            if use_face_contour:
-                contour_keyps = np.array(
-                    person_data['face_keypoints_2d'],
-                    dtype=np.float32).reshape([-1, 3])[:17, :]
-
-            body_keypoints = np.concatenate(
-                [body_keypoints, face_keypoints, contour_keyps], axis=0)
-
-        if 'gender_pd' in person_data:
-            gender_pd.append(person_data['gender_pd'])
-        if 'gender_gt' in person_data:
-            gender_gt.append(person_data['gender_gt'])
-
-        keypoints.append(body_keypoints)
-
-    return Keypoints(keypoints=keypoints, gender_pd=gender_pd,
-                     gender_gt=gender_gt)
+    return read_keypoints_batch([keypoint_fn], use_hands=use_hands,
+                                use_face=use_face,
+                                use_face_contour=use_face_contour)[0]
+
+
+def list_images(img_folder, index_fn=None):
+    ''' Returns the sorted names of the images of a folder
+
+        The folder is scanned with `os.scandir`. If `index_fn` is given, the
+        names are read from this index file instead, with one name per line,
+        and the index is written after scanning the folder if it does not
+        exist yet. The first line of the index records the modification time
+        of the folder, which changes when images are added, removed or
+        renamed. When it differs, the folder is scanned and the index is
+        written again. The index is written next to its final path and then
+        moved, so that the processes that share it never read a partial one.
+    '''
+    if index_fn is not None:
+        header = IMG_INDEX_HEADER.format(os.stat(img_folder).st_mtime)
+        if osp.exists(index_fn):
+            with open(index_fn) as index_file:
+                lines = [line.rstrip('\n') for line in index_file]
+            if len(lines) > 0 and lines[0] == header:
+                return [line for line in lines[1:] if len(line) > 0]
+            print('The image folder {} changed since {} was written,'
+                  ' listing it again'.format(img_folder, index_fn))
+
+    img_fns = sorted(entry.name for entry in os.scandir(img_folder)
+                     if (entry.name.endswith('.png') or
+                         entry.name.endswith('.jpg')) and
+                     not entry.name.startswith('.'))
+
+    if index_fn is not None:
+        tmp_fn = '{}.{}.tmp'.format(index_fn, os.getpid())
+        with open(tmp_fn, 'w') as index_file:
+            index_file.write(header + '\n')
+            index_file.writelines(img_fn + '\n' for img_fn in img_fns)
+        os.replace(tmp_fn, index_fn)
+    return img_fns
+
+
+def select_frames(num_frames, start_idx=0, end_idx=None, shard=None):
+    ''' Returns the range of the frames that are fitted
+
+        Parameters
+        ----------
+        num_frames: int
+            The number of frames of the dataset
+        start_idx: int, optional
+            The index of the first frame (default=0)
+        end_idx: int, optional
+            The index after the last frame. Negative indices count from the
+            end, and None selects all the frames up to the last one
+            (default=None)
+        shard: str, optional
+            A shard `k/N` of the selected frames, with 0 <= k < N. The frames
+            are split in N contiguous blocks of nearly equal size, so that
+            the frames of a sequence stay together (default=None)
+
+        Returns
+        -------
+            frames: range
+                The indices of the selected frames
+    '''
+    frames = range(num_frames)[start_idx:end_idx]
+    if shard is None:
+        return frames
+
+    try:
+        shard_idx, num_shards = [int(val) for val in shard.split('/')]
+    except ValueError:
+        raise ValueError('The shard must be given as k/N, not {}'.format(
+            shard))
+    if num_shards < 1 or not 0 <= shard_idx < num_shards:
+        raise ValueError('Invalid shard {}: k must be in [0, N)'.format(
+            shard))
+    start = len(frames) * shard_idx // num_shards
+    end = len(frames) * (shard_idx + 1) // num_shards
+    return frames[start:end]
+
+
+class LazyImage(object):
+    ''' A handle of an image file that is decoded only when needed
+
+        The fitting only needs the size of an image, which is read from the
+        header of the file. The pixels are decoded when the handle is
+        converted to an array, e.g. with `np.asarray`, for the overlays of
+        the visualization.
+    '''
+
+    # The EXIF orientations that rotate the image by 90 degrees, which
+    # cv2.imread applies when decoding
+    TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+    def __init__(self, img_path):
+        super(LazyImage, self).__init__()
+        self.img_path = img_path
+
+        with Image.open(img_path) as img:
+            width, height = img.size
+            orientation = img.getexif().get(0x0112, 1)
+        if orientation in self.TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+        self.shape = (height, width, 3)
+
+    def __repr__(self):
+        return 'LazyImage({}, shape={})'.format(self.img_path, self.shape)
+
+    def load(self):
+        ''' Decodes the image
+
+            Returns
+            -------
+                img: np.array, HxWx3
+                    The RGB image, as float32 values in [0, 1]
+        '''
+        img = cv2.imread(self.img_path)
+        if img is None:
+            raise IOError('Could not read image {}'.format(self.img_path))
+        return img.astype(np.float32)[:, :, ::-1] / 255.0
+
+    def __array__(self, dtype=None, copy=None):
+        img = self.load()
+        if dtype is not None:
+            img = img.astype(dtype)
+        return img
 
 
 class OpenPose(Dataset):
@@ -114,6 +381,13 @@ class OpenPose(Dataset):
                  joints_to_ign=None,
                  use_face_contour=False,
                  openpose_format='coco25',
+                 keypoint_store=None,
+                 check_store=True,
+                 img_index=None,
+                 start_idx=0,
+                 end_idx=None,
+                 shard=None,
+                 list_frames=True,
                  **kwargs):
         super(OpenPose, self).__init__()
 
@@ -132,14 +406,35 @@ class OpenPose(Dataset):
         self.img_folder = osp.join(data_folder, img_folder)
         self.keyp_folder = osp.join(data_folder, keyp_folder)
 
-        self.img_paths = [osp.join(self.img_folder, img_fn)
-                          for img_fn in os.listdir(self.img_folder)
-                          if img_fn.endswith('.png') or
-                          img_fn.endswith('.jpg') and
-                          not img_fn.startswith('.')]
-        self.img_paths = sorted(self.img_paths)
+        # A dataset that only reads the images given to `read_item`, e.g.
+        # for the jobs of the fitting server, has no frames of its own and
+        # its image folder does not need to exist
+        self.img_paths = []
+        if list_frames:
+            if img_index is not None:
+                img_index = osp.join(data_folder, img_index)
+            img_fns = list_images(self.img_folder, index_fn=img_index)
+            frames = select_frames(len(img_fns), start_idx=start_idx,
+                                   end_idx=end_idx, shard=shard)
+            self.img_paths = [osp.join(self.img_folder, img_fns[idx])
+                              for idx in frames]
         self.cnt = 0
 
+        # The keypoints are read from a compiled store instead of the JSON
+        # files, which is compiled the first time it is used and again
+        # whenever the keypoint files changed. Checking this stats every
+        # keypoint file, so the datasets of the worker processes open the
+        # store that the main process checked without `check_store`.
+        self.keypoint_store = None
+        if keypoint_store is not None:
+            store_folder = osp.join(data_folder, keypoint_store)
+            if check_store and is_stale_store(self.keyp_folder,
+                                              store_folder):
+                print('Compiling the keypoints of {} to {}'.format(
+                    self.keyp_folder, store_folder))
+                compile_keypoint_store(self.keyp_folder, store_folder)
+            self.keypoint_store = KeypointStore(store_folder)
+
     def get_model2data(self):
         return smpl_to_openpose(self.model_type, use_hands=self.use_hands,
                                 use_face=self.use_face,
@@ -173,20 +468,30 @@ class OpenPose(Dataset):
         img_path = self.img_paths[idx]
         return self.read_item(img_path)
 
-    def read_item(self, img_path):
-        img = cv2.imread(img_path).astype(np.float32)[:, :, ::-1] / 255.0
+    def read_item(self, img_path, keypoint_fn=None):
+        img = LazyImage(img_path)
         img_fn = osp.split(img_path)[1]
         img_fn, _ = osp.splitext(osp.split(img_path)[1])
 
-        keypoint_fn = osp.join(self.keyp_folder,
-                               img_fn + '_keypoints.json')
-        keyp_tuple = read_keypoints(keypoint_fn, use_hands=self.use_hands,
-                                    use_face=self.use_face,
-                                    use_face_contour=self.use_face_contour)
+        if (keypoint_fn is None and self.keypoint_store is not None and
+                img_fn in self.keypoint_store):
+            keypoints, gender_gt, gender_pd = self.keypoint_store.read(
+                img_fn, use_hands=self.use_hands, use_face=self.use_face,
+                use_face_contour=self.use_face_contour)
+            keyp_tuple = Keypoints(keypoints=keypoints, gender_gt=gender_gt,
+                                   gender_pd=gender_pd)
+        else:
+            if keypoint_fn is None:
+                keypoint_fn = osp.join(self.keyp_folder,
+                                       img_fn + '_keypoints.json')
+            keyp_tuple = read_keypoints(
+                keypoint_fn, use_hands=self.use_hands,
+                use_face=self.use_face,
+                use_face_contour=self.use_face_contour)
 
         if len(keyp_tuple.keypoints) < 1:
             return {}
-        keypoints = np.stack(keyp_tuple.keypoints)
+        keypoints = np.asarray(keyp_tuple.keypoints)
 
         output_dict = {'fn': img_fn,
                        'img_path': img_path,
@@ -213,3 +518,81 @@ class OpenPose(Dataset):
         self.cnt += 1
 
         return self.read_item(img_path)
+
+
+class FramePrefetcher(object):
+    ''' Reads the frames of a dataset ahead of time in background threads
+
+        The frames are returned in the order of their indices, while up to
+        `num_prefetch` of the next frames are read by a pool of threads.
+        Reading the keypoint files and the image headers releases the global
+        interpreter lock while waiting for the disk, so it overlaps with the
+        fitting of the current frame. Parsing the JSON keypoints holds the
+        lock, so it does not; a keypoint store avoids most of this parsing.
+
+        Parameters
+        ----------
+        dataset: Dataset
+            The dataset whose frames are read
+        indices: iterable, optional
+            The indices of the frames, in the order they are returned. By
+            default all the frames of the dataset (default=None)
+        num_prefetch: int, optional
+            The maximum number of frames that are read ahead (default=4)
+        num_threads: int, optional
+            The number of reading threads (default=2)
+    '''
+
+    def __init__(self, dataset, indices=None, num_prefetch=4,
+                 num_threads=2):
+        super(FramePrefetcher, self).__init__()
+        self.dataset = dataset
+        self.indices = indices
+        self.num_prefetch = max(1, num_prefetch)
+        self.num_threads = max(1, num_threads)
+        # The time every frame took to read and the time the consumer
+        # waited for it, in seconds
+        self.timings = []
+
+    def __len__(self):
+        if self.indices is None:
+            return len(self.dataset)
+        return len(self.indices)
+
+    def read(self, idx):
+        start = time.time()
+        data = self.dataset[idx]
+        return data, time.time() - start
+
+    def __iter__(self):
+        indices = iter(range(len(self.dataset)) if self.indices is None
+                       else self.indices)
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            pending = deque()
+            for idx in indices:
+                pending.append((idx, executor.submit(self.read, idx)))
+                if len(pending) >= self.num_prefetch:
+                    break
+
+            while len(pending) > 0:
+                idx, future = pending.popleft()
+                start = time.time()
+                data, read_time = future.result()
+                self.timings.append({'index': idx, 'read_time': read_time,
+                                     'wait_time': time.time() - start})
+
+                next_idx = next(indices, None)
+                if next_idx is not None:
+                    pending.append(
+                        (next_idx, executor.submit(self.read, next_idx)))
+                yield data
+
+    def summary(self):
+        ''' Returns a description of the reading times of the frames '''
+        if len(self.timings) < 1:
+            return 'No frames were read'
+        read_time = np.mean([timing['read_time'] for timing in self.timings])
+        wait_time = sum(timing['wait_time'] for timing in self.timings)
+        return ('Read {} frames, {:.1f} ms per frame, waited {:.2f} s for'
+                ' them in total'.format(len(self.timings), read_time * 1000,
+                                        wait_time))
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems and the Max Planck Institute for Biological
+# Cybernetics. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+''' A fitting server that keeps the models in memory between requests
+
+    The server loads the body models, the priors and VPoser once and then
+    fits the jobs it receives over HTTP. A job is a JSON object posted to
+    `/fit` with the fields:
+
+        output_folder: The folder where the results of the job are written
+        data_folder: A folder with the images and keypoints to fit, or
+        img_path: The path of an image, or a list of paths
+        keypoints_fn: The OpenPose file of each image (optional). By default
+            it is looked up in the keypoint folder of the server's dataset
+
+    The response lists the result, mesh and image paths of every fitted
+    person. The server is started with the same arguments as main.py:
+
+        python smplifyx/fit_server.py --config cfg_files/fit_smplx.yaml \\
+            --model_folder MODEL_FOLDER --vposer_ckpt VPOSER_FOLDER
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import os.path as osp
+
+import time
+import json
+import traceback
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import torch
+
+import utils
+from cmd_parser import parse_config
+from data_parser import create_dataset, FramePrefetcher
+from main import load_models, fit_frames
+
+torch.backends.cudnn.enabled = False
+
+
+class FittingServer(HTTPServer):
+    ''' HTTP server that fits jobs with models loaded at startup
+
+        Requests are handled one after the other, since all the jobs share
+        the same models.
+    '''
+
+    def __init__(self, server_address, **args):
+        self.dtype, self.optim_dtype = utils.float_dtypes(
+            args.get('float_dtype', 'float32'))
+
+        use_cuda = args.get('use_cuda', True)
+        if use_cuda and not torch.cuda.is_available():
+            raise ValueError('CUDA is not available, exiting!')
+
+        self.img_folder = args.pop('img_folder', 'images')
+        self.result_folder = args.pop('result_folder', 'results')
+        self.mesh_folder = args.pop('mesh_folder', 'meshes')
+        self.input_gender = args.pop('gender', 'neutral')
+        self.gender_lbl_type = args.pop('gender_lbl_type', 'none')
+        self.max_persons = args.pop('max_persons', -1)
+        for key in ['output_folder', 'num_workers', 'num_threads',
+                    'server_host', 'server_port']:
+            args.pop(key, None)
+
+        # The dataset is only used to read the jobs that give image paths,
+        # so its image folder is not listed
+        data_folder = args.pop('data_folder', os.getcwd())
+        self.dataset_obj = create_dataset(data_folder=data_folder,
+                                          img_folder=self.img_folder,
+                                          list_frames=False, **args)
+
+        start = time.time()
+        self.models = load_models(self.dataset_obj, dtype=self.dtype, **args)
+        print('Loading the models took {:.2f} seconds'.format(
+            time.time() - start))
+        self.args = args
+
+        HTTPServer.__init__(self, server_address, FittingRequestHandler)
+
+    def read_frames(self, job):
+        ''' Returns an iterator over the frames of a job '''
+        if 'data_folder' in job:
+            dataset_obj = create_dataset(data_folder=job['data_folder'],
+                                         img_folder=self.img_folder,
+                                         **self.args)
+            num_prefetch = self.args.get('prefetch_frames', 4)
+            if num_prefetch < 1:
+                return dataset_obj
+            return FramePrefetcher(
+                dataset_obj, num_prefetch=num_prefetch,
+                num_threads=self.args.get('loader_threads', 2))
+
+        img_paths = job['img_path']
+        if not isinstance(img_paths, (list, tuple)):
+            img_paths = [img_paths]
+        keypoint_fns = job.get('keypoints_fn', [None] * len(img_paths))
+        if not isinstance(keypoint_fns, (list, tuple)):
+            keypoint_fns = [keypoint_fns]
+        if len(keypoint_fns) != len(img_paths):
+            raise ValueError(
+                'Got {} keypoint files for {} images'.format(
+                    len(keypoint_fns), len(img_paths)))
+        return (self.dataset_obj.read_item(img_path, keypoint_fn)
+                for img_path, keypoint_fn in zip(img_paths, keypoint_fns))
+
+    def fit(self, job):
+        ''' Fits a job and returns the paths of its results '''
+        output_folder = osp.expandvars(job['output_folder'])
+        result_folder = osp.join(output_folder, self.result_folder)
+        mesh_folder = osp.join(output_folder, self.mesh_folder)
+        for folder in [result_folder, mesh_folder,
+                       osp.join(output_folder, 'images')]:
+            if not osp.exists(folder):
+                os.makedirs(folder)
+
+        start = time.time()
+        output_fns = fit_frames(self.read_frames(job), self.models,
+                                output_folder=output_folder,
+                                result_folder=result_folder,
+                                mesh_folder=mesh_folder,
+                                dtype=self.dtype,
+                                optim_dtype=self.optim_dtype,
+                                input_gender=self.input_gender,
+                                gender_lbl_type=self.gender_lbl_type,
+                                max_persons=self.max_persons,
+                                **self.args)
+        return {'persons': output_fns, 'elapsed': time.time() - start}
+
+
+class FittingRequestHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_json(404, {'error': 'Unknown path {}'.format(
+                self.path)})
+            return
+        self.send_json(200, {'status': 'ok'})
+
+    def do_POST(self):
+        if self.path != '/fit':
+            self.send_json(404, {'error': 'Unknown path {}'.format(
+                self.path)})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = json.loads(self.rfile.read(length).decode('utf-8'))
+            if 'output_folder' not in job:
+                raise ValueError('The job has no output_folder')
+            if 'data_folder' not in job and 'img_path' not in job:
+                raise ValueError('The job needs a data_folder or an img_path')
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+
+        try:
+            response = self.server.fit(job)
+        except Exception as e:
+            traceback.print_exc()
+            self.send_json(500, {'error': '{}: {}'.format(
+                type(e).__name__, e)})
+            return
+        self.send_json(200, response)
+
+
+def main(**args):
+    server_address = (args.get('server_host', '127.0.0.1'),
+                      args.get('server_port', 8765))
+    server = FittingServer(server_address, **args)
+    print('Fitting server listening on http://{}:{}'.format(*server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    args = parse_config()
+    main(**args)
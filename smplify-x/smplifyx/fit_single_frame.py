@@ -43,7 +43,7 @@ import PIL.Image as pil_img
 from optimizers import optim_factory
 
 import fitting
-from human_body_prior.tools.model_loader import load_vposer
+import utils
 
 
 def fit_single_frame(img,
@@ -87,6 +87,7 @@ def fit_single_frame(img,
                      rho=100,
                      vposer_latent_dim=32,
                      vposer_ckpt='',
+                     vposer=None,
                      use_joints_conf=False,
                      interactive=True,
                      visualize=False,
@@ -97,8 +98,74 @@ def fit_single_frame(img,
                      ign_part_pairs=None,
                      left_shoulder_idx=2,
                      right_shoulder_idx=5,
+                     orient_stop_ratio=2.0,
+                     init_params=None,
+                     warm_start_stages=2,
+                     warm_start_maxiters=10,
+                     fit_window=False,
+                     profiler=None,
+                     profile_labels=None,
+                     camera_init_type='optim',
+                     camera_refine_steps=0,
+                     keep_optim_state=False,
+                     joint_regressor=None,
                      **kwargs):
-    assert batch_size == 1, 'PyTorch L-BFGS only supports batch_size == 1'
+    ''' Fits the body model to the keypoints of one or more persons
+
+        When batch_size > 1 all the persons in `keypoints` are fitted at the
+        same time, with the body model, the camera and the pose embedding
+        holding one sample per person. In this case `result_fn`, `mesh_fn`
+        and `out_img_fn` are lists with one entry per person. Entries that
+        are None are treated as padding and nothing is written for them.
+        The persons can come from different frames, in which case `img` is a
+        list with the image of every person. An image is either an array or
+        a `LazyImage`, whose pixels are only decoded for the overlays of the
+        visualization.
+
+        If `init_params` is given, e.g. the results of the previous frame of
+        a video, the fitting starts from these parameters instead of the
+        mean pose. The camera initialization is skipped and only the last
+        `warm_start_stages` stages are run, with at most
+        `warm_start_maxiters` iterations each.
+
+        With `camera_init_type='closed_form'` the camera translation and the
+        body orientation are computed directly from the torso joints. The
+        iterative camera stage then only runs for `camera_refine_steps`
+        optimizer steps, if any, starting from this solution.
+
+        With `keep_optim_state` the L-BFGS optimizer of the body is created
+        once and keeps its update history from one stage to the next, instead
+        of starting every stage with steepest descent steps.
+
+        If a `joint_regressor` of the body model is given, the stages that
+        do not need the vertices of the model only compute its joints.
+
+        If `fit_window` is True, the rows of the batch are consecutive
+        frames of the same person. They are fitted jointly, with one set of
+        shape coefficients and a penalty on the velocity and acceleration of
+        the pose and the camera translation.
+
+        If a `profiler` is given, the statistics of every stage are written
+        for every row of the batch, labelled with the fields of
+        `profile_labels`, a list with a dict per person.
+
+        Returns
+        -------
+            result: dict
+                The fitted parameters, with one row per person
+    '''
+    msg = ('Number of persons {} does not match the batch size {}'.format(
+        keypoints.shape[0], batch_size))
+    assert keypoints.shape[0] == batch_size, msg
+
+    if not isinstance(result_fn, (list, tuple)):
+        result_fn = [result_fn]
+    if not isinstance(mesh_fn, (list, tuple)):
+        mesh_fn = [mesh_fn]
+    if not isinstance(out_img_fn, (list, tuple)):
+        out_img_fn = [out_img_fn]
+    if not isinstance(img, (list, tuple)):
+        img = [img] * batch_size
 
     device = torch.device('cuda') if use_cuda else torch.device('cpu')
 
@@ -178,16 +245,21 @@ def fit_single_frame(img,
             len(body_pose_prior_weights)), msg
 
     use_vposer = kwargs.get('use_vposer', True)
-    vposer, pose_embedding = [None, ] * 2
+    pose_embedding = None
     if use_vposer:
         pose_embedding = torch.zeros([batch_size, 32],
                                      dtype=dtype, device=device,
                                      requires_grad=True)
 
-        vposer_ckpt = osp.expandvars(vposer_ckpt)
-        vposer, _ = load_vposer(vposer_ckpt, vp_model='snapshot')
-        vposer = vposer.to(device=device)
-        vposer.eval()
+        # The model can be loaded once by the caller and passed in
+        if vposer is None:
+            from human_body_prior.tools.model_loader import load_vposer
+            vposer_ckpt = osp.expandvars(vposer_ckpt)
+            vposer, _ = load_vposer(vposer_ckpt, vp_model='snapshot')
+            vposer = vposer.to(device=device)
+            vposer.eval()
+    else:
+        vposer = None
         
     if use_vposer:
         body_mean_pose = torch.zeros([batch_size, vposer_latent_dim],
@@ -197,8 +269,9 @@ def fit_single_frame(img,
 
     keypoint_data = torch.tensor(keypoints, dtype=dtype)
     gt_joints = keypoint_data[:, :, :2]
+    joints_conf = None
     if use_joints_conf:
-        joints_conf = keypoint_data[:, :, 2].reshape(1, -1)
+        joints_conf = keypoint_data[:, :, 2].reshape(batch_size, -1)
 
     # Transfer the data to the correct device
     gt_joints = gt_joints.to(device=device, dtype=dtype)
@@ -267,18 +340,74 @@ def fit_single_frame(img,
     # The indices of the joints used for the initialization of the camera
     init_joints_idxs = torch.tensor(init_joints_idxs, device=device)
 
-    edge_indices = kwargs.get('body_tri_idxs')
-    init_t = fitting.guess_init(body_model, gt_joints, edge_indices,
-                                use_vposer=use_vposer, vposer=vposer,
-                                pose_embedding=pose_embedding,
-                                model_type=kwargs.get('model_type', 'smpl'),
-                                focal_length=focal_length, dtype=dtype)
-
-    camera_loss = fitting.create_loss('camera_init',
-                                      trans_estimation=init_t,
-                                      init_joints_idxs=init_joints_idxs,
-                                      depth_loss_weight=depth_loss_weight,
-                                      dtype=dtype).to(device=device)
+    if camera_init_type not in ['optim', 'closed_form']:
+        raise ValueError('Unknown camera initialization {}'.format(
+            camera_init_type))
+
+    img_sizes = np.array([curr_img.shape[:2] for curr_img in img],
+                         dtype=np.float64)
+    # The principal point of the camera of every person is the center of its
+    # image
+    with torch.no_grad():
+        camera.center[:] = torch.tensor(img_sizes[:, ::-1] * 0.5,
+                                        dtype=dtype)
+
+    # The index of the first stage that is run, for the profiling records
+    stage_offset = 0
+    init_orient = None
+    warm_start = init_params is not None
+    if warm_start:
+        init_t = torch.tensor(init_params['camera_translation'],
+                              dtype=dtype, device=device)
+        # The orientation of the previous fit is kept, so only the last
+        # stages are run and there is no need to try a flipped body
+        if warm_start_stages > 0:
+            stage_offset = max(0, len(opt_weights) - warm_start_stages)
+        opt_weights = opt_weights[stage_offset:]
+        if warm_start_maxiters > 0:
+            kwargs['maxiters'] = warm_start_maxiters
+        side_idxs = np.array([], dtype=np.int64)
+    elif camera_init_type == 'closed_form':
+        # Solved for the pose the fitting starts from
+        body_model.reset_params(body_pose=body_mean_pose)
+        init_t, init_orient = fitting.solve_camera_init(
+            body_model, camera, gt_joints, init_joints_idxs,
+            joints_conf=joints_conf, use_vposer=use_vposer, vposer=vposer,
+            pose_embedding=pose_embedding,
+            model_type=kwargs.get('model_type', 'smpl'))
+    else:
+        edge_indices = kwargs.get('body_tri_idxs')
+        init_t = fitting.guess_init(body_model, gt_joints, edge_indices,
+                                    use_vposer=use_vposer, vposer=vposer,
+                                    pose_embedding=pose_embedding,
+                                    model_type=kwargs.get('model_type',
+                                                          'smpl'),
+                                    focal_length=focal_length, dtype=dtype)
+
+    if not warm_start:
+
+        # If the distance between the 2D shoulders is smaller than a
+        # predefined threshold then try 2 fits, the initial one and a 180
+        # degree rotation
+        shoulder_dist = torch.norm(gt_joints[:, left_shoulder_idx] -
+                                   gt_joints[:, right_shoulder_idx], dim=-1)
+        side_idxs = np.nonzero(
+            (shoulder_dist < side_view_thsh).cpu().numpy())[0]
+        # The frames of a window share one orientation hypothesis
+        if fit_window:
+            side_idxs = np.array([], dtype=np.int64)
+    if fit_window:
+        loss_type = 'smplify_temporal'
+
+    # Batches keep a loss value per sample, so that each person and
+    # orientation can be checked for convergence separately
+    camera_loss = fitting.create_loss(
+        'camera_init',
+        trans_estimation=init_t,
+        init_joints_idxs=init_joints_idxs,
+        depth_loss_weight=depth_loss_weight,
+        reduction='none' if batch_size > 1 else 'sum',
+        dtype=dtype).to(device=device)
     camera_loss.trans_estimation[:] = init_t
 
     loss = fitting.create_loss(loss_type=loss_type,
@@ -299,194 +428,312 @@ def fit_single_frame(img,
                                pen_distance=pen_distance,
                                search_tree=search_tree,
                                tri_filtering_module=filter_faces,
+                               reduction=('none' if batch_size +
+                                          len(side_idxs) > 1 and
+                                          not fit_window else 'sum'),
                                dtype=dtype,
                                **kwargs)
     loss = loss.to(device=device)
 
-    with fitting.FittingMonitor(
-            batch_size=batch_size, visualize=visualize, **kwargs) as monitor:
+    if profile_labels is None:
+        profile_labels = [{'person': idx} for idx in range(batch_size)]
 
-        img = torch.tensor(img, dtype=dtype)
+    def profile_info(rows, flipped, stage):
+        ''' Returns the labels of the profiling records of the given rows '''
+        if profiler is None:
+            return None
+        return [dict(profile_labels[person_idx],
+                     orientation='flipped' if is_flipped else 'original',
+                     stage=stage)
+                for person_idx, is_flipped in zip(rows, flipped)]
 
-        H, W, _ = img.shape
+    with fitting.FittingMonitor(
+            batch_size=batch_size, visualize=visualize, profiler=profiler,
+            **kwargs) as monitor:
 
-        data_weight = 1000 / H
+        # Each person is weighted with the height of its own image
+        data_weight = 1000 / img_sizes[:, 0]
         # The closure passed to the optimizer
         camera_loss.reset_loss_weights({'data_weight': data_weight})
 
         # Reset the parameters to estimate the initial translation of the
         # body model
-        body_model.reset_params(body_pose=body_mean_pose)
-
-        # If the distance between the 2D shoulders is smaller than a
-        # predefined threshold then try 2 fits, the initial one and a 180
-        # degree rotation
-        shoulder_dist = torch.dist(gt_joints[:, left_shoulder_idx],
-                                   gt_joints[:, right_shoulder_idx])
-        try_both_orient = shoulder_dist.item() < side_view_thsh
+        if warm_start:
+            body_model.reset_params(**init_params)
+            if use_vposer:
+                with torch.no_grad():
+                    pose_embedding[:] = torch.tensor(init_params['body_pose'],
+                                                     dtype=dtype)
+        elif init_orient is not None:
+            body_model.reset_params(
+                body_pose=body_mean_pose,
+                global_orient=init_orient.detach().cpu().numpy())
+        else:
+            body_model.reset_params(body_pose=body_mean_pose)
 
-        # Update the value of the translation of the camera as well as
-        # the image center.
+        # Update the value of the translation of the camera
         with torch.no_grad():
             camera.translation[:] = init_t.view_as(camera.translation)
-            camera.center[:] = torch.tensor([W, H], dtype=dtype) * 0.5
 
         # Re-enable gradient calculation for the camera translation
         camera.translation.requires_grad = True
 
-        camera_opt_params = [camera.translation, body_model.global_orient]
-
-        camera_optimizer, camera_create_graph = optim_factory.create_optimizer(
-            camera_opt_params,
-            **kwargs)
+        # The closed form initialization is only refined if asked for
+        if not warm_start and (camera_init_type == 'optim' or
+                               camera_refine_steps > 0):
+            camera_opt_params = [camera.translation, body_model.global_orient]
+
+            camera_optimizer, camera_create_graph = \
+                optim_factory.create_optimizer(camera_opt_params,
+                                               batch_size=batch_size,
+                                               **kwargs)
+
+            # The closure passed to the optimizer
+            fit_camera = monitor.create_fitting_closure(
+                camera_optimizer, body_model, camera, gt_joints,
+                camera_loss, create_graph=camera_create_graph,
+                use_vposer=use_vposer, vposer=vposer,
+                pose_embedding=pose_embedding,
+                joint_regressor=joint_regressor,
+                return_full_pose=False, return_verts=False)
+
+            # Step 1: Optimize over the torso joints the camera translation
+            # Initialize the computational graph by feeding the initial
+            # translation of the camera and the initial pose of the body
+            # model.
+            camera_init_start = time.time()
+            cam_init_loss_val = monitor.run_fitting(
+                camera_optimizer, fit_camera, camera_opt_params, body_model,
+                use_vposer=use_vposer, pose_embedding=pose_embedding,
+                vposer=vposer,
+                profile_info=profile_info(range(batch_size),
+                                          [False] * batch_size, 'camera'),
+                maxiters=(camera_refine_steps if
+                          camera_init_type == 'closed_form' else None))
 
-        # The closure passed to the optimizer
-        fit_camera = monitor.create_fitting_closure(
-            camera_optimizer, body_model, camera, gt_joints,
-            camera_loss, create_graph=camera_create_graph,
-            use_vposer=use_vposer, vposer=vposer,
-            pose_embedding=pose_embedding,
-            return_full_pose=False, return_verts=False)
-
-        # Step 1: Optimize over the torso joints the camera translation
-        # Initialize the computational graph by feeding the initial translation
-        # of the camera and the initial pose of the body model.
-        camera_init_start = time.time()
-        cam_init_loss_val = monitor.run_fitting(camera_optimizer,
-                                                fit_camera,
-                                                camera_opt_params, body_model,
-                                                use_vposer=use_vposer,
-                                                pose_embedding=pose_embedding,
-                                                vposer=vposer)
-
-        if interactive:
-            if use_cuda and torch.cuda.is_available():
-                torch.cuda.synchronize()
-            tqdm.write('Camera initialization done after {:.4f}'.format(
-                time.time() - camera_init_start))
-            tqdm.write('Camera initialization final loss {:.4f}'.format(
-                cam_init_loss_val))
+            if interactive:
+                if use_cuda and torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                tqdm.write(
+                    'Camera initialization done after {:.4f}'.format(
+                        time.time() - camera_init_start))
+                tqdm.write('Camera initialization final loss {}'.format(
+                    np.array2string(np.asarray(cam_init_loss_val),
+                                    precision=4)))
 
         # If the 2D detections/positions of the shoulder joints are too
         # close the rotate the body by 180 degrees and also fit to that
-        # orientation
-        if try_both_orient:
-            body_orient = body_model.global_orient.detach().cpu().numpy()
-            flipped_orient = cv2.Rodrigues(body_orient)[0].dot(
-                cv2.Rodrigues(np.array([0., np.pi, 0]))[0])
-            flipped_orient = cv2.Rodrigues(flipped_orient)[0].ravel()
-
-            flipped_orient = torch.tensor(flipped_orient,
-                                          dtype=dtype,
-                                          device=device).unsqueeze(dim=0)
-            orientations = [body_orient, flipped_orient]
-        else:
-            orientations = [body_model.global_orient.detach().cpu().numpy()]
+        # orientation. Both orientations are fitted at the same time: the
+        # flipped copies of the side view persons are appended to the batch.
+        # Every row of the batch is a (person, orientation) hypothesis.
+        body_orient = body_model.global_orient.detach().cpu().numpy()
+        hyp_person = np.concatenate([np.arange(batch_size), side_idxs])
+        hyp_flipped = np.arange(len(hyp_person)) >= batch_size
+        if len(side_idxs) > 0:
+            flipped_orient = []
+            for idx in side_idxs:
+                curr_orient = cv2.Rodrigues(body_orient[idx])[0].dot(
+                    cv2.Rodrigues(np.array([0., np.pi, 0]))[0])
+                flipped_orient.append(cv2.Rodrigues(curr_orient)[0].ravel())
+            body_orient = np.concatenate(
+                [body_orient, np.stack(flipped_orient)]).astype(
+                    body_orient.dtype)
+
+        def select_hypotheses(rows):
+            ''' Keeps only the given rows of the fitting batch '''
+            nonlocal gt_joints, joints_conf, pose_embedding
+            rows = torch.tensor(rows, dtype=torch.long, device=device)
+            utils.index_batch(body_model, rows)
+            utils.index_batch(camera, rows)
+            gt_joints = gt_joints[rows]
+            if use_joints_conf:
+                joints_conf = joints_conf[rows]
+            if use_vposer:
+                pose_embedding = pose_embedding.detach()[rows].requires_grad_(
+                    True)
 
-        # store here the final error for both orientations,
-        # and pick the orientation resulting in the lowest error
-        results = []
+        if len(side_idxs) > 0:
+            select_hypotheses(hyp_person)
 
         # Step 2: Optimize the full model
-        final_loss_val = 0
-        for or_idx, orient in enumerate(tqdm(orientations, desc='Orientation')):
-            opt_start = time.time()
+        opt_start = time.time()
 
-            new_params = defaultdict(global_orient=orient,
+        if not warm_start:
+            new_params = defaultdict(global_orient=body_orient,
                                      body_pose=body_mean_pose)
             body_model.reset_params(**new_params)
             if use_vposer:
                 with torch.no_grad():
                     pose_embedding.fill_(0)
 
-            for opt_idx, curr_weights in enumerate(tqdm(opt_weights, desc='Stage')):
+        shared_betas = None
+        if fit_window:
+            # All the frames of the window share the shape of the person
+            shared_betas = body_model.betas.detach().mean(
+                dim=0, keepdim=True).requires_grad_(True)
+            body_model.betas.requires_grad = False
 
-                body_params = list(body_model.parameters())
-
-                final_params = list(
-                    filter(lambda x: x.requires_grad, body_params))
-
-                if use_vposer:
-                    final_params.append(pose_embedding)
-
-                body_optimizer, body_create_graph = optim_factory.create_optimizer(
-                    final_params,
-                    **kwargs)
-                body_optimizer.zero_grad()
-
-                curr_weights['data_weight'] = data_weight
-                curr_weights['bending_prior_weight'] = (
-                    3.17 * curr_weights['body_pose_weight'])
-                if use_hands:
-                    joint_weights[:, 25:67] = curr_weights['hand_weight']
-                if use_face:
-                    joint_weights[:, 67:] = curr_weights['face_weight']
-                loss.reset_loss_weights(curr_weights)
+        final_loss_val = 0
+        body_optimizer = None
+        # The rows of the previous stage that are still fitted, if some
+        # hypotheses were dropped
+        kept_rows = None
+        for opt_idx, curr_weights in enumerate(tqdm(opt_weights, desc='Stage')):
 
-                closure = monitor.create_fitting_closure(
-                    body_optimizer, body_model,
-                    camera=camera, gt_joints=gt_joints,
-                    joints_conf=joints_conf,
-                    joint_weights=joint_weights,
-                    loss=loss, create_graph=body_create_graph,
-                    use_vposer=use_vposer, vposer=vposer,
-                    pose_embedding=pose_embedding,
-                    return_verts=True, return_full_pose=True)
+            body_params = list(body_model.parameters())
 
-                if interactive:
-                    if use_cuda and torch.cuda.is_available():
-                        torch.cuda.synchronize()
-                    stage_start = time.time()
-                final_loss_val = monitor.run_fitting(
-                    body_optimizer,
-                    closure, final_params,
-                    body_model,
-                    pose_embedding=pose_embedding, vposer=vposer,
-                    use_vposer=use_vposer)
+            final_params = list(
+                filter(lambda x: x.requires_grad, body_params))
 
-                if interactive:
-                    if use_cuda and torch.cuda.is_available():
-                        torch.cuda.synchronize()
-                    elapsed = time.time() - stage_start
-                    if interactive:
-                        tqdm.write('Stage {:03d} done after {:.4f} seconds'.format(
-                            opt_idx, elapsed))
+            if use_vposer:
+                final_params.append(pose_embedding)
+            # Without the camera initialization the translation of the
+            # camera is refined together with the body
+            if warm_start:
+                final_params.append(camera.translation)
+            if fit_window:
+                final_params.append(shared_betas)
+
+            # The optimizer is reused if it can carry its state over to the
+            # loss of the new stage
+            reuse_optimizer = (keep_optim_state and
+                               hasattr(body_optimizer, 'reset_objective'))
+            if reuse_optimizer and kept_rows is not None:
+                reuse_optimizer = hasattr(body_optimizer, 'index_batch')
+                if reuse_optimizer:
+                    body_optimizer.index_batch(final_params, kept_rows)
+            kept_rows = None
+
+            if reuse_optimizer:
+                body_optimizer.reset_objective()
+            else:
+                body_optimizer, body_create_graph = \
+                    optim_factory.create_optimizer(
+                        final_params,
+                        batch_size=1 if fit_window else len(hyp_person),
+                        **kwargs)
+            body_optimizer.zero_grad()
+
+            curr_weights['data_weight'] = torch.tensor(
+                data_weight[hyp_person], dtype=dtype, device=device)
+            curr_weights['bending_prior_weight'] = (
+                3.17 * curr_weights['body_pose_weight'])
+            if use_hands:
+                joint_weights[:, 25:67] = curr_weights['hand_weight']
+            if use_face:
+                joint_weights[:, 67:] = curr_weights['face_weight']
+            loss.reset_loss_weights(curr_weights)
+            # The vertices are only needed for the interpenetration term
+            return_verts = (interpenetration and
+                            curr_weights['coll_loss_weight'].item() > 0)
+
+            closure = monitor.create_fitting_closure(
+                body_optimizer, body_model,
+                camera=camera, gt_joints=gt_joints,
+                joints_conf=joints_conf,
+                joint_weights=joint_weights,
+                loss=loss, create_graph=body_create_graph,
+                use_vposer=use_vposer, vposer=vposer,
+                pose_embedding=pose_embedding,
+                shared_betas=shared_betas,
+                joint_regressor=joint_regressor,
+                return_verts=return_verts, return_full_pose=True)
 
             if interactive:
                 if use_cuda and torch.cuda.is_available():
                     torch.cuda.synchronize()
-                elapsed = time.time() - opt_start
-                tqdm.write(
-                    'Body fitting Orientation {} done after {:.4f} seconds'.format(
-                        or_idx, elapsed))
-                tqdm.write('Body final loss val = {:.5f}'.format(
-                    final_loss_val))
-
-            # Get the result of the fitting process
-            # Store in it the errors list in order to compare multiple
-            # orientations, if they exist
-            result = {'camera_' + str(key): val.detach().cpu().numpy()
-                      for key, val in camera.named_parameters()}
-            result.update({key: val.detach().cpu().numpy()
-                           for key, val in body_model.named_parameters()})
-            if use_vposer:
-                result['body_pose'] = pose_embedding.detach().cpu().numpy()
+                stage_start = time.time()
+            final_loss_val = monitor.run_fitting(
+                body_optimizer,
+                closure, final_params,
+                body_model,
+                pose_embedding=pose_embedding, vposer=vposer,
+                use_vposer=use_vposer,
+                per_sample=False if fit_window else None,
+                profile_info=profile_info(hyp_person, hyp_flipped,
+                                          stage_offset + opt_idx))
+            hyp_loss = np.asarray(final_loss_val, dtype=np.float64).reshape(-1)
+            if fit_window:
+                # The frames of the window share the loss of the window
+                hyp_loss = np.repeat(hyp_loss, len(hyp_person))
 
-            results.append({'loss': final_loss_val,
-                            'result': result})
+            if interactive:
+                if use_cuda and torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                elapsed = time.time() - stage_start
+                if interactive:
+                    tqdm.write('Stage {:03d} done after {:.4f} seconds'.format(
+                        opt_idx, elapsed))
+
+            # Stop fitting the orientations that are clearly behind the other
+            # hypothesis of the same person
+            if (orient_stop_ratio > 0 and
+                    len(hyp_person) > batch_size and
+                    opt_idx < len(opt_weights) - 1):
+                keep = np.ones(len(hyp_person), dtype=bool)
+                for person_idx in side_idxs:
+                    person_rows = np.nonzero(hyp_person == person_idx)[0]
+                    if len(person_rows) < 2:
+                        continue
+                    orig_row, flip_row = person_rows
+                    if (hyp_loss[flip_row] >
+                            orient_stop_ratio * hyp_loss[orig_row]):
+                        keep[flip_row] = False
+                    elif (hyp_loss[orig_row] >
+                          orient_stop_ratio * hyp_loss[flip_row]):
+                        keep[orig_row] = False
+                if not keep.all():
+                    kept_rows = np.nonzero(keep)[0]
+                    select_hypotheses(kept_rows)
+                    hyp_person = hyp_person[keep]
+                    hyp_flipped = hyp_flipped[keep]
+                    hyp_loss = hyp_loss[keep]
 
-        with open(result_fn, 'wb') as result_file:
-            if len(results) > 1:
-                min_idx = (0 if results[0]['loss'] < results[1]['loss']
-                           else 1)
-            else:
-                min_idx = 0
-            pickle.dump(results[min_idx]['result'], result_file, protocol=2)
+        if interactive:
+            if use_cuda and torch.cuda.is_available():
+                torch.cuda.synchronize()
+            elapsed = time.time() - opt_start
+            tqdm.write(
+                'Body fitting done after {:.4f} seconds'.format(elapsed))
+            tqdm.write('Body final loss val = {}'.format(
+                np.array2string(hyp_loss, precision=5)))
+
+        # Pick for every person the orientation with the lowest error. The
+        # batch of the models then holds one sample per person again.
+        best_rows = []
+        for person_idx in range(batch_size):
+            person_rows = np.nonzero(hyp_person == person_idx)[0]
+            # On ties the flipped orientation is kept
+            best_rows.append(person_rows[::-1][
+                np.argmin(hyp_loss[person_rows][::-1])])
+        if not np.array_equal(best_rows, np.arange(len(hyp_person))):
+            select_hypotheses(best_rows)
+
+        if fit_window:
+            with torch.no_grad():
+                body_model.betas[:] = shared_betas
+            body_model.betas.requires_grad = True
+
+        # Get the result of the fitting process
+        result = {'camera_' + str(key): val.detach().cpu().numpy()
+                  for key, val in camera.named_parameters()}
+        result.update({key: val.detach().cpu().numpy()
+                       for key, val in body_model.named_parameters()})
+        if use_vposer:
+            result['body_pose'] = pose_embedding.detach().cpu().numpy()
+
+        for idx in range(batch_size):
+            if result_fn[idx] is None:
+                continue
+            person_result = {key: val[idx:idx + 1]
+                             for key, val in result.items()}
+            with open(result_fn[idx], 'wb') as result_file:
+                pickle.dump(person_result, result_file, protocol=2)
 
     if save_meshes or visualize:
         body_pose = vposer.decode(
             pose_embedding,
-            output_type='aa').view(1, -1) if use_vposer else None
+            output_type='aa').view(batch_size, -1) if use_vposer else None
 
         model_type = kwargs.get('model_type', 'smpl')
         append_wrists = model_type == 'smpl' and use_vposer
@@ -497,60 +744,79 @@ def fit_single_frame(img,
                 body_pose = torch.cat([body_pose, wrist_pose], dim=1)
 
         model_output = body_model(return_verts=True, body_pose=body_pose)
-        vertices = model_output.vertices.detach().cpu().numpy().squeeze()
+        all_vertices = model_output.vertices.detach().cpu().numpy()
 
         import trimesh
 
-        out_mesh = trimesh.Trimesh(vertices, body_model.faces, process=False)
-        rot = trimesh.transformations.rotation_matrix(
-            np.radians(180), [1, 0, 0])
-        out_mesh.apply_transform(rot)
-        out_mesh.export(mesh_fn)
+        out_meshes = []
+        for idx in range(batch_size):
+            out_mesh = trimesh.Trimesh(all_vertices[idx], body_model.faces,
+                                       process=False)
+            rot = trimesh.transformations.rotation_matrix(
+                np.radians(180), [1, 0, 0])
+            out_mesh.apply_transform(rot)
+            out_meshes.append(out_mesh)
+            if mesh_fn[idx] is not None:
+                out_mesh.export(mesh_fn[idx])
 
     if visualize:
         import pyrender
 
-        material = pyrender.MetallicRoughnessMaterial(
-            metallicFactor=0.0,
-            alphaMode='OPAQUE',
-            baseColorFactor=(1.0, 1.0, 0.9, 1.0))
-        mesh = pyrender.Mesh.from_trimesh(
-            out_mesh,
-            material=material)
-
-        scene = pyrender.Scene(bg_color=[0.0, 0.0, 0.0, 0.0],
-                               ambient_light=(0.3, 0.3, 0.3))
-        scene.add(mesh, 'mesh')
-
-        camera_center = camera.center.detach().cpu().numpy().squeeze()
-        camera_transl = camera.translation.detach().cpu().numpy().squeeze()
-        # Equivalent to 180 degrees around the y-axis. Transforms the fit to
-        # OpenGL compatible coordinate system.
-        camera_transl[0] *= -1.0
-
-        camera_pose = np.eye(4)
-        camera_pose[:3, 3] = camera_transl
-
-        camera = pyrender.camera.IntrinsicsCamera(
-            fx=focal_length, fy=focal_length,
-            cx=camera_center[0], cy=camera_center[1])
-        scene.add(camera, pose=camera_pose)
-
-        # Get the lights from the viewer
-        light_nodes = monitor.mv.viewer._create_raymond_lights()
-        for node in light_nodes:
-            scene.add_node(node)
-
-        r = pyrender.OffscreenRenderer(viewport_width=W,
-                                       viewport_height=H,
-                                       point_size=1.0)
-        color, _ = r.render(scene, flags=pyrender.RenderFlags.RGBA)
-        color = color.astype(np.float32) / 255.0
-
-        valid_mask = (color[:, :, -1] > 0)[:, :, np.newaxis]
-        input_img = img.detach().cpu().numpy()
-        output_img = (color[:, :, :-1] * valid_mask +
-                      (1 - valid_mask) * input_img)
-
-        img = pil_img.fromarray((output_img * 255).astype(np.uint8))
-        img.save(out_img_fn)
+        all_centers = camera.center.detach().cpu().numpy()
+        all_transl = camera.translation.detach().cpu().numpy()
+
+        # The persons of a frame share its image, which is decoded once
+        input_imgs = {}
+        for idx in range(batch_size):
+            if out_img_fn[idx] is None:
+                continue
+
+            material = pyrender.MetallicRoughnessMaterial(
+                metallicFactor=0.0,
+                alphaMode='OPAQUE',
+                baseColorFactor=(1.0, 1.0, 0.9, 1.0))
+            mesh = pyrender.Mesh.from_trimesh(
+                out_meshes[idx],
+                material=material)
+
+            scene = pyrender.Scene(bg_color=[0.0, 0.0, 0.0, 0.0],
+                                   ambient_light=(0.3, 0.3, 0.3))
+            scene.add(mesh, 'mesh')
+
+            camera_center = all_centers[idx]
+            camera_transl = all_transl[idx].copy()
+            # Equivalent to 180 degrees around the y-axis. Transforms the fit
+            # to OpenGL compatible coordinate system.
+            camera_transl[0] *= -1.0
+
+            camera_pose = np.eye(4)
+            camera_pose[:3, 3] = camera_transl
+
+            render_camera = pyrender.camera.IntrinsicsCamera(
+                fx=focal_length, fy=focal_length,
+                cx=camera_center[0], cy=camera_center[1])
+            scene.add(render_camera, pose=camera_pose)
+
+            # Get the lights from the viewer
+            light_nodes = monitor.mv.viewer._create_raymond_lights()
+            for node in light_nodes:
+                scene.add_node(node)
+
+            if id(img[idx]) not in input_imgs:
+                input_imgs[id(img[idx])] = np.asarray(img[idx])
+            input_img = input_imgs[id(img[idx])]
+            H, W, _ = input_img.shape
+            r = pyrender.OffscreenRenderer(viewport_width=W,
+                                           viewport_height=H,
+                                           point_size=1.0)
+            color, _ = r.render(scene, flags=pyrender.RenderFlags.RGBA)
+            color = color.astype(np.float32) / 255.0
+
+            valid_mask = (color[:, :, -1] > 0)[:, :, np.newaxis]
+            output_img = (color[:, :, :-1] * valid_mask +
+                          (1 - valid_mask) * input_img)
+
+            out_img = pil_img.fromarray((output_img * 255).astype(np.uint8))
+            out_img.save(out_img_fn[idx])
+
+    return result
@@ -24,13 +24,24 @@ import os
 
 import time
 
+from collections import OrderedDict
+
 import numpy as np
+import cv2
 
 import torch
 import torch.nn as nn
 
 from mesh_viewer import MeshViewer
 import utils
+import profiling
+
+# The reasons an optimization run stops for, indexed by the codes returned
+# by FittingMonitor.check_convergence
+EXIT_REASONS = ['maxiters', 'ftol', 'gtol', 'nan']
+STOP_FTOL = EXIT_REASONS.index('ftol')
+STOP_GTOL = EXIT_REASONS.index('gtol')
+STOP_NON_FINITE = EXIT_REASONS.index('nan')
 
 
 @torch.no_grad()
@@ -72,7 +83,8 @@ def guess_init(model,
     '''
 
     body_pose = vposer.decode(
-        pose_embedding, output_type='aa').view(1, -1) if use_vposer else None
+        pose_embedding, output_type='aa').view(
+            pose_embedding.shape[0], -1) if use_vposer else None
     if use_vposer and model_type == 'smpl':
         wrist_pose = torch.zeros([body_pose.shape[0], 6],
                                  dtype=body_pose.dtype,
@@ -110,17 +122,217 @@ def guess_init(model,
     return init_t
 
 
+def solve_translation(points_3d, points_2d, weights):
+    ''' Solves for the translation that best projects points on the image
+
+        The projection of a point is linear in the translation once it is
+        multiplied by the depth, which gives two linear equations per point
+        that are solved in the least squares sense.
+
+        Parameters
+        ----------
+        points_3d: torch.tensor BxNx3
+            The points in the coordinate frame of the camera, before the
+            translation
+        points_2d: torch.tensor BxNx2
+            The normalized image coordinates of the points, i.e. the pixel
+            coordinates minus the image center over the focal length
+        weights: torch.tensor BxN
+            The weight of every point
+        Returns
+        -------
+        transl: torch.tensor Bx3
+            The translation of the points
+    '''
+    batch_size, num_points = points_2d.shape[:2]
+    # T_x - u * T_z = u * Z - X and T_y - v * T_z = v * Z - Y
+    lhs = points_2d.new_zeros([batch_size, num_points, 2, 3])
+    lhs[:, :, 0, 0] = 1
+    lhs[:, :, 1, 1] = 1
+    lhs[:, :, :, 2] = -points_2d
+    rhs = points_2d * points_3d[:, :, 2:] - points_3d[:, :, :2]
+
+    lhs = lhs.reshape(batch_size, -1, 3)
+    rhs = rhs.reshape(batch_size, -1, 1)
+    weights = weights.repeat_interleave(2, dim=1).unsqueeze(dim=-1)
+
+    normal_mat = torch.matmul(lhs.transpose(1, 2), weights * lhs)
+    normal_rhs = torch.matmul(lhs.transpose(1, 2), weights * rhs)
+    return torch.matmul(torch.inverse(normal_mat), normal_rhs).squeeze(-1)
+
+
+@torch.no_grad()
+def solve_camera_init(model, camera, joints_2d, init_joints_idxs,
+                      joints_conf=None,
+                      pose_embedding=None,
+                      vposer=None,
+                      use_vposer=True,
+                      model_type='smpl',
+                      **kwargs):
+    ''' Computes the camera translation and the body orientation directly
+
+        The torso joints are close to a plane, so their projection under a
+        weak perspective camera is an affine map of their coordinates in
+        this plane. The rotation is recovered from this map, completing its
+        rows to a scaled rotation, and the translation is then the linear
+        least squares solution of the full perspective projection. Of the
+        two rotations that explain the weak perspective projection, the one
+        with the lowest reprojection error is kept. The camera rotation is
+        assumed to be the identity.
+
+        Parameters
+        ----------
+        model: nn.Module
+            The PyTorch module of the body
+        camera: nn.Module
+            The camera, whose focal length and center are used
+        joints_2d: torch.tensor BxJx2
+            The 2D tensor of the joints
+        init_joints_idxs: torch.tensor
+            The indices of the torso joints
+        joints_conf: torch.tensor BxJ, optional
+            The confidence of the joints. Joints with zero confidence are
+            ignored, unless fewer than three torso joints are left
+        pose_embedding: torch.tensor Bx32
+            The tensor that contains the embedding of V-Poser that is used to
+            generate the pose of the model
+        vposer: nn.Module, optional (None)
+            The PyTorch module that implements the V-Poser decoder
+        Returns
+        -------
+        init_t: torch.tensor Bx3
+            The translation of the camera
+        global_orient: torch.tensor Bx3
+            The orientation of the body, in axis-angle format
+    '''
+    body_pose = vposer.decode(
+        pose_embedding, output_type='aa').view(
+            pose_embedding.shape[0], -1) if use_vposer else None
+    if use_vposer and model_type == 'smpl':
+        wrist_pose = torch.zeros([body_pose.shape[0], 6],
+                                 dtype=body_pose.dtype,
+                                 device=body_pose.device)
+        body_pose = torch.cat([body_pose, wrist_pose], dim=1)
+
+    global_orient = torch.zeros_like(model.global_orient)
+    output = model(body_pose=body_pose, global_orient=global_orient,
+                   return_verts=False, return_full_pose=False)
+    joints_3d = output.joints[:, init_joints_idxs]
+    dtype, device = joints_3d.dtype, joints_3d.device
+
+    focal_length = torch.stack([camera.focal_length_x,
+                                camera.focal_length_y], dim=-1)
+    points_2d = joints_2d[:, init_joints_idxs].to(device=device, dtype=dtype)
+    points_2d = ((points_2d - camera.center.unsqueeze(dim=1)) /
+                 focal_length.to(dtype=dtype).unsqueeze(dim=1))
+
+    weights = torch.ones_like(points_2d[:, :, 0])
+    if joints_conf is not None:
+        weights = (joints_conf[:, init_joints_idxs] > 0).to(dtype=dtype)
+        too_few = weights.sum(dim=1) < 3
+        weights[too_few] = 1
+
+    # Center the joints and split them into their coordinates in the plane
+    # of the torso and the normal of the plane
+    sqrt_weights = weights.sqrt().unsqueeze(dim=-1)
+    weight_sum = weights.sum(dim=1, keepdim=True).unsqueeze(dim=-1)
+    centered_3d = (joints_3d - (weights.unsqueeze(dim=-1) * joints_3d).sum(
+        dim=1, keepdim=True) / weight_sum) * sqrt_weights
+    centered_2d = (points_2d - (weights.unsqueeze(dim=-1) * points_2d).sum(
+        dim=1, keepdim=True) / weight_sum) * sqrt_weights
+    plane_u, plane_s, plane_v = torch.svd(centered_3d)
+    plane_basis, normal = plane_v[:, :, :2], plane_v[:, :, 2]
+
+    # The affine map from the plane to the image, 2x2 per person
+    affine = (torch.matmul(plane_u[:, :, :2].transpose(1, 2), centered_2d) /
+              plane_s[:, :2].clamp(min=1e-8).unsqueeze(dim=-1)).transpose(
+                  1, 2)
+    # Complete the rows of the map with a component along the normal, so
+    # that they are orthogonal and of the same length
+    affine_u, affine_s, _ = torch.svd(affine)
+    scale = affine_s[:, 0]
+    normal_coeffs = ((affine_s[:, 0] ** 2 - affine_s[:, 1] ** 2).clamp(
+        min=0).sqrt().unsqueeze(dim=-1) * affine_u[:, :, 1])
+
+    best_error, best_rot = None, None
+    for sign in [1, -1]:
+        rows = (torch.matmul(affine, plane_basis.transpose(1, 2)) +
+                sign * normal_coeffs.unsqueeze(dim=-1) *
+                normal.unsqueeze(dim=1)) / scale.clamp(
+                    min=1e-8).view(-1, 1, 1)
+        rows = rows / rows.norm(dim=-1, keepdim=True).clamp(min=1e-8)
+        rot_mat = torch.stack(
+            [rows[:, 0], rows[:, 1],
+             torch.cross(rows[:, 0], rows[:, 1], dim=-1)], dim=1)
+
+        rotated = torch.matmul(joints_3d, rot_mat.transpose(1, 2))
+        transl = solve_translation(rotated, points_2d, weights)
+        projected = rotated + transl.unsqueeze(dim=1)
+        projected = projected[:, :, :2] / projected[:, :, 2:]
+        error = (weights * (projected - points_2d).pow(2).sum(dim=-1)).sum(
+            dim=1)
+        # Solutions that put the body behind the camera are not valid
+        error[transl[:, 2] <= 0] = float('inf')
+        if best_error is None:
+            best_error, best_rot = error, rot_mat
+        else:
+            better = error < best_error
+            best_error = torch.where(better, error, best_error)
+            best_rot = torch.where(better.view(-1, 1, 1), rot_mat, best_rot)
+
+    global_orient = torch.tensor(
+        np.stack([cv2.Rodrigues(rot_mat)[0].ravel()
+                  for rot_mat in best_rot.cpu().numpy()]),
+        dtype=dtype, device=device)
+
+    # The body rotates around its root joint, so the translation is solved
+    # again with the joints of the oriented body
+    output = model(body_pose=body_pose, global_orient=global_orient,
+                   return_verts=False, return_full_pose=False)
+    init_t = solve_translation(output.joints[:, init_joints_idxs],
+                               points_2d, weights)
+    return init_t, global_orient
+
+
 class FittingMonitor(object):
     def __init__(self, summary_steps=1, visualize=False,
                  maxiters=100, ftol=2e-09, gtol=1e-05,
                  body_color=(1.0, 1.0, 0.9, 1.0),
                  model_type='smpl',
+                 batch_size=1,
+                 check_every=1,
+                 profiler=None,
+                 compile_closure=False,
+                 optim_dtype=None,
                  **kwargs):
         super(FittingMonitor, self).__init__()
 
         self.maxiters = maxiters
         self.ftol = ftol
         self.gtol = gtol
+        self.batch_size = batch_size
+        # The stopping criteria are read back from the device only every
+        # `check_every` iterations
+        self.check_every = max(1, check_every)
+        # Compile the evaluation of the model and of the loss in the
+        # closures, if supported
+        self.compile_closure = compile_closure
+        # The data type the loss is accumulated in when it differs from the
+        # one of the model, e.g. float64 for a model evaluated in float32
+        self.optim_dtype = optim_dtype
+
+        # Per-sample state used when several persons are fitted at once.
+        # The mask marks the samples that are still being optimized and the
+        # loss holds the per-sample values of the first closure call of the
+        # current optimizer step.
+        self.active = None
+        self.sample_loss = None
+
+        # Writes the statistics of every optimization run, if given
+        self.profiler = profiler
+        self.num_steps = 0
+        self.exit_code = None
+        self.sample_steps = None
 
         self.visualize = visualize
         self.summary_steps = summary_steps
@@ -146,6 +358,7 @@ class FittingMonitor(object):
 
     def run_fitting(self, optimizer, closure, params, body_model,
                     use_vposer=True, pose_embedding=None, vposer=None,
+                    per_sample=None, profile_info=None, maxiters=None,
                     **kwargs):
         ''' Helper function for running an optimization process
             Parameters
@@ -164,55 +377,422 @@ class FittingMonitor(object):
                     The tensor that contains the latent pose variable.
                 vposer: nn.Module
                     The VPoser module
+                per_sample: bool, optional
+                    Check the convergence of every sample of the batch
+                    separately. By default this is done for batches with more
+                    than one sample. Losses that couple the samples need a
+                    single check for the whole batch.
+                profile_info: list, optional
+                    The fields that label the profiling record of every row
+                    of the batch, e.g. the frame, the person and the stage.
+                    Only used if the monitor has a profiler
+                maxiters: int, optional
+                    The maximum number of optimizer steps of this run. By
+                    default the one of the monitor
+            Returns
+            -------
+                loss: float or torch.tensor, B
+                The final loss value. When fitting a batch of samples,
+                the final loss of each sample
+        '''
+        if per_sample is None:
+            per_sample = params[0].shape[0] > 1
+
+        if self.profiler is not None:
+            self.profiler.synchronize()
+            run_start = self.profile_start(optimizer)
+
+        if per_sample:
+            loss = self.run_batch_fitting(
+                optimizer, closure, params, body_model,
+                use_vposer=use_vposer, pose_embedding=pose_embedding,
+                vposer=vposer, maxiters=maxiters, **kwargs)
+        else:
+            loss = self.run_single_fitting(
+                optimizer, closure, params, body_model,
+                use_vposer=use_vposer, pose_embedding=pose_embedding,
+                vposer=vposer, maxiters=maxiters, **kwargs)
+
+        if self.profiler is not None:
+            self.profiler.synchronize()
+            self.profile_stop(optimizer, run_start, loss, profile_info,
+                              closure=closure)
+        return loss
+
+    def run_single_fitting(self, optimizer, closure, params, body_model,
+                           use_vposer=True, pose_embedding=None,
+                           vposer=None, maxiters=None, **kwargs):
+        ''' Runs an optimization process with a single convergence check
+
+            The stopping criteria are only read back every `check_every`
+            steps. Once they are met, the parameters are kept on the device
+            at the result of the step that met them, or at the last ones
+            whose loss was finite, until the loop ends at the next read back.
+
             Returns
             -------
                 loss: float
                 The final loss value
         '''
-        append_wrists = self.model_type == 'smpl' and use_vposer
-        prev_loss = None
-        for n in range(self.maxiters):
-            loss = optimizer.step(closure)
+        if maxiters is None:
+            maxiters = self.maxiters
+
+        # The parameter values at the start of the current step, the last
+        # ones whose loss was finite and the ones the fit stopped at
+        start_params = [param.detach().clone() for param in params]
+        valid_params = [param.detach().clone() for param in params]
+        stopped_params = [param.detach().clone() for param in params]
+
+        prev_loss, last_loss = None, None
+        stop_code = None
+        for n in range(maxiters):
+            with torch.no_grad():
+                for param, start in zip(params, start_params):
+                    start.copy_(param)
 
-            if torch.isnan(loss).sum() > 0:
-                print('NaN loss value, stopping!')
-                break
+            # The loss at the start of the step
+            loss = optimizer.step(closure).detach()
 
-            if torch.isinf(loss).sum() > 0:
-                print('Infinite loss value, stopping!')
-                break
+            with torch.no_grad():
+                curr_code = self.check_convergence(loss, prev_loss, params)
+                if stop_code is None:
+                    stop_code = torch.zeros_like(curr_code)
+                    last_loss = torch.full_like(loss, float('nan'))
+                # The first reason to stop is kept until it is read back
+                running = stop_code == 0
+                stop_code = torch.where(running, curr_code, stop_code)
+                non_finite = running & (curr_code == STOP_NON_FINITE)
+                finite = running & ~non_finite
+                # Keep the last finite value without reading it back
+                last_loss = torch.where(finite, loss, last_loss)
+
+                # A converged fit keeps the result of this step, while one
+                # with a NaN loss returns to its last valid state
+                stopping = running & (curr_code > 0)
+                for param, start, valid, stopped in zip(
+                        params, start_params, valid_params, stopped_params):
+                    valid.copy_(torch.where(finite, start, valid))
+                    stopped.copy_(torch.where(
+                        stopping, torch.where(non_finite, valid, param),
+                        stopped))
+                    param.copy_(torch.where(stop_code > 0, stopped, param))
+                prev_loss = loss
+            self.num_steps = n + 1
+
+            if ((n + 1) % self.check_every == 0 or
+                    n == maxiters - 1):
+                code = stop_code.item()
+                if code == STOP_NON_FINITE:
+                    print('NaN or infinite loss value, stopping!')
+                    break
+                if code > 0:
+                    break
 
-            if n > 0 and prev_loss is not None and self.ftol > 0:
-                loss_rel_change = utils.rel_change(prev_loss, loss.item())
+            if self.visualize and n % self.summary_steps == 0:
+                self.update_viewer(body_model, use_vposer=use_vposer,
+                                   pose_embedding=pose_embedding,
+                                   vposer=vposer)
 
-                if loss_rel_change <= self.ftol:
-                    break
+        self.exit_code = stop_code
+        return None if last_loss is None else last_loss.item()
 
-            if all([torch.abs(var.grad.view(-1).max()).item() < self.gtol
-                    for var in params if var.grad is not None]):
-                break
+    def check_convergence(self, loss, prev_loss, params):
+        ''' Evaluates the stopping criteria after an optimization step
 
-            if self.visualize and n % self.summary_steps == 0:
-                body_pose = vposer.decode(
-                    pose_embedding, output_type='aa').view(
-                        1, -1) if use_vposer else None
+            The criteria are computed on the device, with a single reduction
+            over the gradients of all the parameters, so that they can be
+            read back only every few iterations.
+
+            Parameters
+            ----------
+                loss: torch.tensor, scalar or B
+                    The loss after the step, either a single value or one
+                    value per sample
+                prev_loss: torch.tensor or None
+                    The loss after the previous step
+                params: list
+                    The optimized parameters. When the loss has a value per
+                    sample, their first dimension is the batch
+            Returns
+            -------
+                stop_code: torch.tensor, long
+                    The reason to stop, with the shape of the loss. 0 if
+                    the optimization should go on, STOP_FTOL if the relative
+                    change of the loss is smaller than ftol, STOP_GTOL if the
+                    largest absolute gradient is smaller than gtol and
+                    STOP_NON_FINITE if the loss is NaN or infinite
+        '''
+        stop_code = torch.zeros_like(loss, dtype=torch.long)
+
+        num_samples = loss.numel()
+        grads = [var.grad.reshape(num_samples, -1) for var in params
+                 if var.grad is not None]
+        if len(grads) > 0:
+            max_grad = torch.cat(grads, dim=1).abs().max(dim=1)[0]
+            stop_code.masked_fill_(max_grad.view_as(loss) < self.gtol,
+                                   STOP_GTOL)
+        if prev_loss is not None and self.ftol > 0:
+            stop_code.masked_fill_(
+                utils.batch_rel_change(prev_loss, loss) <= self.ftol,
+                STOP_FTOL)
+        stop_code.masked_fill_(~torch.isfinite(loss), STOP_NON_FINITE)
+        return stop_code
+
+    def run_batch_fitting(self, optimizer, closure, params, body_model,
+                          use_vposer=True, pose_embedding=None, vposer=None,
+                          maxiters=None, **kwargs):
+        ''' Runs an optimization process over a batch of independent samples
+
+            Every sample is checked for convergence on its own. Samples that
+            have converged, or whose loss is no longer finite, are removed
+            from the active mask: their loss no longer contributes to the
+            objective and their parameters are kept at the values they had
+            when they stopped. Samples whose loss is no longer finite return
+            to the last parameters whose loss was finite.
+
+            The stopping criteria are evaluated on the device after every
+            step, but only read back every `check_every` steps, so the loop
+            ends at the first read back after all the samples stopped.
+
+            Parameters
+            ----------
+                optimizer: torch.optim.Optimizer
+                    The PyTorch optimizer object
+                closure: function
+                    The function used to calculate the gradients. It must
+                    be created with a loss that returns a value per sample
+                params: list
+                    List containing the parameters that will be optimized.
+                    The first dimension of every parameter is the batch
+                body_model: nn.Module
+                    The body model PyTorch module
+                use_vposer: bool
+                    Flag on whether to use VPoser (default=True).
+                pose_embedding: torch.tensor, BxN
+                    The tensor that contains the latent pose variable.
+                vposer: nn.Module
+                    The VPoser module
+            Returns
+            -------
+                loss: torch.tensor, B
+                The final loss value of each sample
+        '''
+        device = params[0].device
+        batch_size = params[0].shape[0]
+        self.active = torch.ones([batch_size], dtype=torch.bool,
+                                 device=device)
+        # The reason every sample stopped for and the number of steps it
+        # was optimized for
+        self.exit_code = torch.zeros([batch_size], dtype=torch.long,
+                                     device=device)
+        self.sample_steps = torch.zeros_like(self.exit_code)
+        # The parameter values at the start of the current step, the last
+        # ones whose loss was finite and the ones that the stopped samples
+        # are kept at
+        start_params = [param.detach().clone() for param in params]
+        valid_params = [param.detach().clone() for param in params]
+        stopped_params = [param.detach().clone() for param in params]
+        # The samples stopped for a NaN loss since the last read back
+        stopped_any = torch.zeros_like(self.active)
+
+        if maxiters is None:
+            maxiters = self.maxiters
 
-                if append_wrists:
-                    wrist_pose = torch.zeros([body_pose.shape[0], 6],
-                                             dtype=body_pose.dtype,
-                                             device=body_pose.device)
-                    body_pose = torch.cat([body_pose, wrist_pose], dim=1)
-                model_output = body_model(
-                    return_verts=True, body_pose=body_pose)
-                vertices = model_output.vertices.detach().cpu().numpy()
+        prev_loss = None
+        for n in range(maxiters):
+            with torch.no_grad():
+                for param, start in zip(params, start_params):
+                    start.copy_(param)
 
-                self.mv.update_mesh(vertices.squeeze(),
-                                    body_model.faces)
+            self.sample_loss = None
+            optimizer.step(closure)
+            # The loss at the start of the step
+            loss = self.sample_loss
+            self.num_steps = n + 1
 
-            prev_loss = loss.item()
+            with torch.no_grad():
+                stop_code = self.check_convergence(loss, prev_loss, params)
+                stop_code = torch.where(self.active, stop_code,
+                                        torch.zeros_like(stop_code))
+                self.sample_steps += self.active.long()
+                self.exit_code = torch.where(stop_code > 0, stop_code,
+                                             self.exit_code)
+
+                stop_mask = stop_code == STOP_NON_FINITE
+                self.active &= ~stop_mask
+                if prev_loss is None:
+                    prev_loss = torch.where(
+                        stop_mask, torch.full_like(loss, float('inf')), loss)
+                else:
+                    prev_loss = torch.where(self.active, loss, prev_loss)
+
+                # Samples that converged keep the result of this step, while
+                # the ones with a NaN loss return to their last valid state
+                converged = (stop_code > 0) & ~stop_mask
+                for param, start, valid, stopped in zip(
+                        params, start_params, valid_params, stopped_params):
+                    view = [-1] + [1] * (param.dim() - 1)
+                    valid.copy_(torch.where(self.active.view(view), start,
+                                            valid))
+                    stopped.copy_(torch.where(converged.view(view), param,
+                                              stopped))
+                    stopped.copy_(torch.where(stop_mask.view(view), valid,
+                                              stopped))
+                self.active &= ~converged
+
+                for param, stopped in zip(params, stopped_params):
+                    mask = self.active.view(-1, *[1] * (param.dim() - 1))
+                    param.copy_(torch.where(mask, param, stopped))
+                stopped_any |= stop_mask
+
+            if ((n + 1) % self.check_every == 0 or
+                    n == maxiters - 1):
+                any_active, any_stopped = torch.stack(
+                    [self.active.any(), stopped_any.any()]).tolist()
+                if any_stopped:
+                    print('NaN or infinite loss value for samples {},'
+                          ' stopping them!'.format(
+                              stopped_any.nonzero().view(-1).tolist()))
+                    stopped_any = torch.zeros_like(stopped_any)
+                if not any_active:
+                    break
 
+            if self.visualize and n % self.summary_steps == 0:
+                self.update_viewer(body_model, use_vposer=use_vposer,
+                                   pose_embedding=pose_embedding,
+                                   vposer=vposer)
+
+        self.active = None
         return prev_loss
 
+    def optimizer_state(self, optimizer):
+        ''' Returns the global state of the L-BFGS optimizers
+
+            The L-BFGS optimizers keep their iteration and evaluation
+            counters in the state of their first parameter.
+        '''
+        first_param = optimizer.param_groups[0]['params'][0]
+        return optimizer.state.get(first_param, {})
+
+    def profile_start(self, optimizer):
+        ''' Stores the counters at the start of an optimization run '''
+        state = self.optimizer_state(optimizer)
+        sample_iter = state.get('sample_iter')
+        self.num_steps = 0
+        self.exit_code = None
+        self.sample_steps = None
+        return {'time': time.time(), 'closure_evals': self.steps,
+                'n_iter': state.get('n_iter', 0),
+                'sample_iter': (None if sample_iter is None else
+                                sample_iter.clone())}
+
+    def profile_stop(self, optimizer, run_start, loss, profile_info=None,
+                     closure=None):
+        ''' Writes the profiling records of an optimization run
+
+            Parameters
+            ----------
+                optimizer: torch.optim.Optimizer
+                    The optimizer of the run
+                run_start: dict
+                    The counters returned by `profile_start`
+                loss: float or torch.tensor, B
+                    The final loss of the run
+                profile_info: list, optional
+                    The fields of the record of every row of the batch
+                closure: function, optional
+                    The closure of the run. If given, the loss of every term
+                    and of every joint at the final parameters is recorded
+                    as well
+        '''
+        wall_time = time.time() - run_start['time']
+        closure_evals = self.steps - run_start['closure_evals']
+        # Every step evaluates the closure once before the line search
+        line_search = any(group.get('line_search_fn') is not None
+                          for group in optimizer.param_groups)
+        line_search_evals = (closure_evals - self.num_steps
+                             if line_search else 0)
+
+        if torch.is_tensor(loss):
+            loss = loss.detach().cpu().numpy()
+        loss = np.asarray(loss, dtype=np.float64).reshape(-1)
+        exit_code = ([0] if self.exit_code is None else
+                     self.exit_code.view(-1).tolist())
+
+        state = self.optimizer_state(optimizer)
+        if state.get('sample_iter') is not None:
+            sample_iter = state['sample_iter']
+            if run_start['sample_iter'] is not None:
+                sample_iter = sample_iter - run_start['sample_iter']
+            iterations = sample_iter.view(-1).tolist()
+        elif 'n_iter' in state:
+            iterations = [state['n_iter'] - run_start['n_iter']]
+        elif self.sample_steps is not None:
+            iterations = self.sample_steps.tolist()
+        else:
+            iterations = [self.num_steps]
+
+        # The final value of every term, from a single evaluation of the
+        # model that does not count as a closure evaluation
+        loss_terms, joint_losses = {}, None
+        if closure is not None:
+            with torch.no_grad():
+                blocks = closure(return_blocks=True)
+            loss_terms = {name: term.cpu().numpy() for name, term in
+                          block_losses(blocks).items()}
+            if 'joints' in blocks:
+                joints = blocks['joints']
+                joint_losses = joints.view(joints.shape[0], -1, 2).pow(
+                    2).sum(dim=-1).cpu().numpy()
+
+        if profile_info is None:
+            profile_info = [{}] * max(len(loss), len(exit_code))
+
+        records = []
+        for row, info in enumerate(profile_info):
+            record = dict(info)
+            record.update(
+                batch_size=len(profile_info),
+                wall_time=wall_time,
+                closure_evals=closure_evals,
+                optimizer_steps=self.num_steps,
+                iterations=iterations[min(row, len(iterations) - 1)],
+                line_search_evals=line_search_evals,
+                loss=(None if len(loss) < 1 else
+                      profiling.finite_or_none(loss[min(row, len(loss) - 1)])),
+                exit_reason=EXIT_REASONS[
+                    exit_code[min(row, len(exit_code) - 1)]])
+            if closure is not None:
+                record['loss_terms'] = {
+                    name: profiling.finite_or_none(
+                        term[min(row, len(term) - 1)])
+                    for name, term in loss_terms.items()}
+            if joint_losses is not None:
+                record['joint_losses'] = [
+                    profiling.finite_or_none(value) for value in
+                    joint_losses[min(row, len(joint_losses) - 1)]]
+            records.append(record)
+        self.profiler.write(records)
+
+    def update_viewer(self, body_model, use_vposer=True,
+                      pose_embedding=None, vposer=None):
+        ''' Shows the current mesh of the first sample in the viewer '''
+        append_wrists = self.model_type == 'smpl' and use_vposer
+        body_pose = vposer.decode(
+            pose_embedding, output_type='aa').view(
+                pose_embedding.shape[0], -1) if use_vposer else None
+
+        if append_wrists:
+            wrist_pose = torch.zeros([body_pose.shape[0], 6],
+                                     dtype=body_pose.dtype,
+                                     device=body_pose.device)
+            body_pose = torch.cat([body_pose, wrist_pose], dim=1)
+        model_output = body_model(
+            return_verts=True, body_pose=body_pose)
+        vertices = model_output.vertices.detach().cpu().numpy()
+
+        self.mv.update_mesh(vertices[0], body_model.faces)
+
     def create_fitting_closure(self,
                                optimizer, body_model, camera=None,
                                gt_joints=None, loss=None,
@@ -222,17 +802,34 @@ class FittingMonitor(object):
                                use_vposer=False, vposer=None,
                                pose_embedding=None,
                                create_graph=False,
+                               shared_betas=None,
+                               joint_regressor=None,
                                **kwargs):
+        ''' Creates the closure that evaluates the loss for the optimizer
+
+            If `shared_betas` is given, a single set of shape coefficients
+            is used for all the samples of the batch instead of the betas of
+            the body model.
+
+            If `return_verts` is False and a `joint_regressor` of the body
+            model is given, only the joints of the model are computed.
+
+            Called with `return_blocks=True`, the closure returns the named
+            blocks of residuals of the loss instead, without computing any
+            gradient or counting an evaluation.
+        '''
         faces_tensor = body_model.faces_tensor.view(-1)
         append_wrists = self.model_type == 'smpl' and use_vposer
+        # Batched optimizers expect the loss of every sample
+        batched_optimizer = getattr(optimizer, 'batched', False)
+        # Least-squares optimizers expect the residuals of the loss and
+        # compute their Jacobian themselves
+        residual_optimizer = getattr(optimizer, 'residuals', False)
 
-        def fitting_func(backward=True):
-            if backward:
-                optimizer.zero_grad()
-
+        def loss_blocks():
             body_pose = vposer.decode(
                 pose_embedding, output_type='aa').view(
-                    1, -1) if use_vposer else None
+                    pose_embedding.shape[0], -1) if use_vposer else None
 
             if append_wrists:
                 wrist_pose = torch.zeros([body_pose.shape[0], 6],
@@ -240,30 +837,100 @@ class FittingMonitor(object):
                                          device=body_pose.device)
                 body_pose = torch.cat([body_pose, wrist_pose], dim=1)
 
-            body_model_output = body_model(return_verts=return_verts,
-                                           body_pose=body_pose,
-                                           return_full_pose=return_full_pose)
-            total_loss = loss(body_model_output, camera=camera,
-                              gt_joints=gt_joints,
-                              body_model_faces=faces_tensor,
-                              joints_conf=joints_conf,
-                              joint_weights=joint_weights,
-                              pose_embedding=pose_embedding,
-                              use_vposer=use_vposer,
-                              **kwargs)
+            betas = None
+            if shared_betas is not None:
+                betas = shared_betas.expand(body_model.batch_size, -1)
+
+            if joint_regressor is not None and not return_verts:
+                body_model_output = joint_regressor(
+                    body_model, body_pose=body_pose, betas=betas,
+                    return_full_pose=return_full_pose)
+            else:
+                body_model_output = body_model(
+                    return_verts=return_verts, body_pose=body_pose,
+                    betas=betas, return_full_pose=return_full_pose)
+            # The model is evaluated once, and the loss or the residuals
+            # are derived from the blocks of residuals of its terms
+            return loss.residual_blocks(body_model_output, camera=camera,
+                                        gt_joints=gt_joints,
+                                        body_model_faces=faces_tensor,
+                                        joints_conf=joints_conf,
+                                        joint_weights=joint_weights,
+                                        pose_embedding=pose_embedding,
+                                        use_vposer=use_vposer,
+                                        **kwargs)
+
+        # The compiled evaluation is only kept once it has run successfully
+        compiled = {'blocks': utils.compile_function(loss_blocks)
+                    if self.compile_closure else None,
+                    'verified': False}
+
+        def fitting_func(backward=True, return_blocks=False):
+            if compiled['blocks'] is None or compiled['verified']:
+                return evaluate(compiled['blocks'] or loss_blocks,
+                                backward=backward,
+                                return_blocks=return_blocks)
+            try:
+                output = evaluate(compiled['blocks'], backward=backward,
+                                  return_blocks=return_blocks)
+            except Exception as e:
+                print('Could not compile the fitting closure, falling back'
+                      ' to eager mode: {}'.format(e))
+                compiled['blocks'] = None
+                return evaluate(loss_blocks, backward=backward,
+                                return_blocks=return_blocks)
+            compiled['verified'] = backward or residual_optimizer
+            return output
+
+        def evaluate(blocks_func, backward=True, return_blocks=False):
+            if return_blocks:
+                backward = False
+            if backward and not residual_optimizer:
+                optimizer.zero_grad()
+
+            blocks = blocks_func()
+            if self.optim_dtype is not None:
+                blocks = OrderedDict(
+                    (name, block.to(dtype=self.optim_dtype))
+                    for name, block in blocks.items())
+            if return_blocks:
+                return blocks
+
+            if residual_optimizer:
+                residuals = loss.stack_residuals(blocks)
+                if self.sample_loss is None:
+                    self.sample_loss = residuals.detach().pow(2).sum(dim=1)
+                if self.active is not None:
+                    residuals = residuals * self.active.unsqueeze(
+                        dim=1).to(dtype=residuals.dtype)
+                self.steps += 1
+                return residuals
+
+            total_loss = loss.reduce_residuals(blocks)
+
+            sample_loss = None
+            if total_loss.dim() > 0:
+                # Per-sample losses: remember the values of the first
+                # evaluation of the step and drop the stopped samples
+                if self.sample_loss is None:
+                    self.sample_loss = total_loss.detach().clone()
+                if self.active is not None:
+                    total_loss = torch.where(self.active, total_loss,
+                                             torch.zeros_like(total_loss))
+                sample_loss = total_loss
+                total_loss = total_loss.sum()
 
             if backward:
                 total_loss.backward(create_graph=create_graph)
 
             self.steps += 1
             if self.visualize and self.steps % self.summary_steps == 0:
-                model_output = body_model(return_verts=True,
-                                          body_pose=body_pose)
-                vertices = model_output.vertices.detach().cpu().numpy()
-
-                self.mv.update_mesh(vertices.squeeze(),
-                                    body_model.faces)
+                self.update_viewer(body_model, use_vposer=use_vposer,
+                                   pose_embedding=pose_embedding,
+                                   vposer=vposer)
 
+            if batched_optimizer:
+                return sample_loss
             return total_loss
 
         return fitting_func
@@ -272,12 +939,51 @@ class FittingMonitor(object):
 def create_loss(loss_type='smplify', **kwargs):
     if loss_type == 'smplify':
         return SMPLifyLoss(**kwargs)
+    elif loss_type == 'smplify_temporal':
+        return SMPLifyTemporalLoss(**kwargs)
     elif loss_type == 'camera_init':
         return SMPLifyCameraInitLoss(**kwargs)
     else:
         raise ValueError('Unknown loss type: {}'.format(loss_type))
 
 
+def prior_residuals(prior, *args):
+    ''' Returns the residuals of a prior, BxN, or None for no prior
+
+        Priors without a residual form are represented by the square root
+        of their value.
+    '''
+    if hasattr(prior, 'residuals'):
+        return prior.residuals(*args)
+    value = prior(*args)
+    if not torch.is_tensor(value):
+        return None
+    return torch.sqrt(value.clamp(min=1e-12)).reshape(value.shape[0], -1)
+
+
+def sample_weight(weight, ndim):
+    ''' Reshapes a scalar or per-sample weight to broadcast over ndim dims '''
+    if weight.dim() == 0:
+        return weight
+    return weight.view(-1, *[1] * (ndim - 1))
+
+
+def block_losses(blocks):
+    ''' Returns the loss of every block of residuals
+
+        Parameters
+        ----------
+            blocks: OrderedDict
+                The named blocks of residuals, each of size BxN
+        Returns
+        -------
+            losses: OrderedDict
+                The squared sum of every block, of size B
+    '''
+    return OrderedDict((name, res.pow(2).sum(dim=1))
+                       for name, res in blocks.items())
+
+
 class SMPLifyLoss(nn.Module):
 
     def __init__(self, search_tree=None,
@@ -304,6 +1010,7 @@ class SMPLifyLoss(nn.Module):
 
         super(SMPLifyLoss, self).__init__()
 
+        self.reduction = reduction
         self.use_joints_conf = use_joints_conf
         self.angle_prior = angle_prior
 
@@ -362,70 +1069,94 @@ class SMPLifyLoss(nn.Module):
                                                  device=weight_tensor.device)
                 setattr(self, key, weight_tensor)
 
-    def forward(self, body_model_output, camera, gt_joints, joints_conf,
-                body_model_faces, joint_weights,
-                use_vposer=False, pose_embedding=None,
-                **kwargs):
+    def residual_blocks(self, body_model_output, camera, gt_joints,
+                        joints_conf, body_model_faces, joint_weights,
+                        use_vposer=False, pose_embedding=None,
+                        **kwargs):
+        ''' Returns the residuals of every term of the loss
+
+            The weights of the terms are already applied, so the squared sum
+            of all the residuals of a sample is its loss. The robust joint
+            error is written as the residual rho * x / sqrt(x^2 + rho^2),
+            whose square is the Geman-McClure penalty of x.
+
+            Returns
+            -------
+                blocks: OrderedDict
+                    The residuals of the joints, the pose prior, the shape
+                    prior, the angle prior, the hand and face priors and the
+                    collisions that are used, each of size BxN. The joint
+                    residuals are ordered as the joints, with the x and y
+                    error of every joint next to each other
+        '''
         projected_joints = camera(body_model_output.joints)
+        batch_size = projected_joints.shape[0]
         # Calculate the weights for each joints
         weights = (joint_weights * joints_conf
                    if self.use_joints_conf else
                    joint_weights).unsqueeze(dim=-1)
 
+        blocks = OrderedDict()
         # Calculate the distance of the projected joints from
         # the ground truth 2D detections
-        joint_diff = self.robustifier(gt_joints - projected_joints)
-        joint_loss = (torch.sum(weights ** 2 * joint_diff) *
-                      self.data_weight ** 2)
+        joint_diff = gt_joints - projected_joints
+        joint_res = (self.rho * joint_diff /
+                     torch.sqrt(joint_diff.pow(2) + self.rho ** 2))
+        blocks['joints'] = (weights * joint_res *
+                            sample_weight(self.data_weight, 3)).reshape(
+                                batch_size, -1)
 
         # Calculate the loss from the Pose prior
         if use_vposer:
-            pprior_loss = (pose_embedding.pow(2).sum() *
-                           self.body_pose_weight ** 2)
+            blocks['pose_prior'] = pose_embedding * self.body_pose_weight
         else:
-            pprior_loss = torch.sum(self.body_pose_prior(
-                body_model_output.body_pose,
-                body_model_output.betas)) * self.body_pose_weight ** 2
+            blocks['pose_prior'] = prior_residuals(
+                self.body_pose_prior, body_model_output.body_pose,
+                body_model_output.betas)
+            if blocks['pose_prior'] is not None:
+                blocks['pose_prior'] = (blocks['pose_prior'] *
+                                        self.body_pose_weight)
+
+        blocks['shape_prior'] = prior_residuals(
+            self.shape_prior, body_model_output.betas)
+        if blocks['shape_prior'] is not None:
+            blocks['shape_prior'] = blocks['shape_prior'] * self.shape_weight
 
-        shape_loss = torch.sum(self.shape_prior(
-            body_model_output.betas)) * self.shape_weight ** 2
         # Calculate the prior over the joint rotations. This a heuristic used
         # to prevent extreme rotation of the elbows and knees
         body_pose = body_model_output.full_pose[:, 3:66]
-        angle_prior_loss = torch.sum(
-            self.angle_prior(body_pose)) * self.bending_prior_weight
+        blocks['angle_prior'] = prior_residuals(self.angle_prior, body_pose)
+        if blocks['angle_prior'] is not None:
+            blocks['angle_prior'] = (blocks['angle_prior'] *
+                                     torch.sqrt(self.bending_prior_weight))
 
         # Apply the prior on the pose space of the hand
-        left_hand_prior_loss, right_hand_prior_loss = 0.0, 0.0
-        if self.use_hands and self.left_hand_prior is not None:
-            left_hand_prior_loss = torch.sum(
-                self.left_hand_prior(
-                    body_model_output.left_hand_pose)) * \
-                self.hand_prior_weight ** 2
-
-        if self.use_hands and self.right_hand_prior is not None:
-            right_hand_prior_loss = torch.sum(
-                self.right_hand_prior(
-                    body_model_output.right_hand_pose)) * \
-                self.hand_prior_weight ** 2
-
-        expression_loss = 0.0
-        jaw_prior_loss = 0.0
+        if self.use_hands:
+            for name, hand_prior, hand_pose in [
+                    ('left_hand_prior', self.left_hand_prior,
+                     body_model_output.left_hand_pose),
+                    ('right_hand_prior', self.right_hand_prior,
+                     body_model_output.right_hand_pose)]:
+                if hand_prior is None:
+                    continue
+                blocks[name] = prior_residuals(hand_prior, hand_pose)
+                if blocks[name] is not None:
+                    blocks[name] = blocks[name] * self.hand_prior_weight
+
         if self.use_face:
-            expression_loss = torch.sum(self.expr_prior(
-                body_model_output.expression)) * \
-                self.expr_prior_weight ** 2
+            blocks['expression_prior'] = prior_residuals(
+                self.expr_prior, body_model_output.expression)
+            if blocks['expression_prior'] is not None:
+                blocks['expression_prior'] = (blocks['expression_prior'] *
+                                              self.expr_prior_weight)
 
             if hasattr(self, 'jaw_prior'):
-                jaw_prior_loss = torch.sum(
-                    self.jaw_prior(
-                        body_model_output.jaw_pose.mul(
-                            self.jaw_prior_weight)))
+                blocks['jaw_prior'] = prior_residuals(
+                    self.jaw_prior,
+                    body_model_output.jaw_pose.mul(self.jaw_prior_weight))
 
-        pen_loss = 0.0
         # Calculate the loss due to interpenetration
         if (self.interpenetration and self.coll_loss_weight.item() > 0):
-            batch_size = projected_joints.shape[0]
             triangles = torch.index_select(
                 body_model_output.vertices, 1,
                 body_model_faces).view(batch_size, -1, 3, 3)
@@ -438,16 +1169,90 @@ class SMPLifyLoss(nn.Module):
                 collision_idxs = self.tri_filtering_module(collision_idxs)
 
             if collision_idxs.ge(0).sum().item() > 0:
-                pen_loss = torch.sum(
-                    self.coll_loss_weight *
-                    self.pen_distance(triangles, collision_idxs))
-
-        total_loss = (joint_loss + pprior_loss + shape_loss +
-                      angle_prior_loss + pen_loss +
-                      jaw_prior_loss + expression_loss +
-                      left_hand_prior_loss + right_hand_prior_loss)
+                pen_loss = self.coll_loss_weight * self.pen_distance(
+                    triangles, collision_idxs)
+                blocks['collision'] = torch.sqrt(
+                    pen_loss.clamp(min=1e-12)).reshape(batch_size, -1)
+
+        return OrderedDict((name, res) for name, res in blocks.items()
+                           if res is not None)
+
+    def stack_residuals(self, blocks):
+        ''' Concatenates the blocks of residuals into a BxM tensor '''
+        return torch.cat(list(blocks.values()), dim=1)
+
+    def reduce_residuals(self, blocks):
+        ''' Returns the loss of a set of blocks of residuals '''
+        total_loss = sum(block_losses(blocks).values())
+        if self.reduction == 'sum':
+            return torch.sum(total_loss)
         return total_loss
 
+    def residuals(self, body_model_output, camera, **kwargs):
+        ''' Returns the residuals of the loss, BxM '''
+        return self.stack_residuals(self.residual_blocks(
+            body_model_output, camera=camera, **kwargs))
+
+    def forward(self, body_model_output, camera, **kwargs):
+        return self.reduce_residuals(self.residual_blocks(
+            body_model_output, camera=camera, **kwargs))
+
+
+class SMPLifyTemporalLoss(SMPLifyLoss):
+    ''' The SMPLify loss for a window of consecutive frames of one person
+
+        The samples of the batch are the frames of the window. On top of the
+        terms of every frame, the velocity and the acceleration of the pose
+        and of the camera translation are penalized. These terms couple the
+        frames, so the loss is always summed over the batch.
+    '''
+
+    def __init__(self, velocity_weight=0.0, acceleration_weight=0.0,
+                 dtype=torch.float32, **kwargs):
+        kwargs['reduction'] = 'sum'
+        super(SMPLifyTemporalLoss, self).__init__(dtype=dtype, **kwargs)
+
+        self.register_buffer('velocity_weight',
+                             torch.tensor(velocity_weight, dtype=dtype))
+        self.register_buffer('acceleration_weight',
+                             torch.tensor(acceleration_weight, dtype=dtype))
+
+    def residual_blocks(self, body_model_output, camera, **kwargs):
+        ''' Returns the residuals of every term of the loss
+
+            On top of the blocks of every frame, the velocity and the
+            acceleration blocks hold the residuals of the whole window, with
+            a size of 1xN.
+        '''
+        blocks = super(SMPLifyTemporalLoss, self).residual_blocks(
+            body_model_output, camera=camera, **kwargs)
+
+        velocity_res, acceleration_res = [], []
+        for motion in [body_model_output.full_pose, camera.translation]:
+            if motion.shape[0] < 2:
+                continue
+            velocity = motion[1:] - motion[:-1]
+            velocity_res.append(velocity.reshape(-1) * self.velocity_weight)
+            if motion.shape[0] > 2:
+                acceleration = velocity[1:] - velocity[:-1]
+                acceleration_res.append(acceleration.reshape(-1) *
+                                        self.acceleration_weight)
+        if len(velocity_res) > 0:
+            blocks['velocity'] = torch.cat(velocity_res).unsqueeze(dim=0)
+        if len(acceleration_res) > 0:
+            blocks['acceleration'] = torch.cat(
+                acceleration_res).unsqueeze(dim=0)
+        return blocks
+
+    def stack_residuals(self, blocks):
+        ''' Concatenates the residuals of the whole window, 1xM '''
+        return torch.cat([res.reshape(-1) for res in blocks.values()]
+                         ).unsqueeze(dim=0)
+
+    def reduce_residuals(self, blocks):
+        ''' Returns the loss of the whole window '''
+        return sum(loss.sum() for loss in block_losses(blocks).values())
+
 
 class SMPLifyCameraInitLoss(nn.Module):
 
@@ -458,6 +1263,7 @@ class SMPLifyCameraInitLoss(nn.Module):
                  **kwargs):
         super(SMPLifyCameraInitLoss, self).__init__()
         self.dtype = dtype
+        self.reduction = reduction
 
         if trans_estimation is not None:
             self.register_buffer(
@@ -483,21 +1289,49 @@ class SMPLifyCameraInitLoss(nn.Module):
                                              device=weight_tensor.device)
                 setattr(self, key, weight_tensor)
 
-    def forward(self, body_model_output, camera, gt_joints,
-                **kwargs):
+    def residual_blocks(self, body_model_output, camera, gt_joints,
+                        **kwargs):
+        ''' Returns the residuals of the torso joints and of the depth
 
+            Returns
+            -------
+                blocks: OrderedDict
+                    The residuals of the joints and, if an estimate of the
+                    translation is given, of its depth, each of size BxN
+        '''
         projected_joints = camera(body_model_output.joints)
+        batch_size = projected_joints.shape[0]
 
-        joint_error = torch.pow(
+        blocks = OrderedDict()
+        joint_res = (
             torch.index_select(gt_joints, 1, self.init_joints_idxs) -
-            torch.index_select(projected_joints, 1, self.init_joints_idxs),
-            2)
-        joint_loss = torch.sum(joint_error) * self.data_weight ** 2
+            torch.index_select(projected_joints, 1, self.init_joints_idxs))
+        blocks['joints'] = (joint_res *
+                            sample_weight(self.data_weight, 3)).reshape(
+                                batch_size, -1)
 
-        depth_loss = 0.0
         if (self.depth_loss_weight.item() > 0 and self.trans_estimation is not
                 None):
-            depth_loss = self.depth_loss_weight ** 2 * torch.sum((
-                camera.translation[:, 2] - self.trans_estimation[:, 2]).pow(2))
+            blocks['depth'] = self.depth_loss_weight * (
+                camera.translation[:, 2:3] - self.trans_estimation[:, 2:3])
+        return blocks
+
+    def stack_residuals(self, blocks):
+        ''' Concatenates the blocks of residuals into a BxM tensor '''
+        return torch.cat(list(blocks.values()), dim=1)
+
+    def reduce_residuals(self, blocks):
+        ''' Returns the loss of a set of blocks of residuals '''
+        total_loss = sum(block_losses(blocks).values())
+        if self.reduction == 'sum':
+            return torch.sum(total_loss)
+        return total_loss
+
+    def residuals(self, body_model_output, camera, **kwargs):
+        ''' Returns the residuals of the loss, BxM '''
+        return self.stack_residuals(self.residual_blocks(
+            body_model_output, camera=camera, **kwargs))
 
-        return joint_loss + depth_loss
+    def forward(self, body_model_output, camera, **kwargs):
+        return self.reduce_residuals(self.residual_blocks(
+            body_model_output, camera=camera, **kwargs))
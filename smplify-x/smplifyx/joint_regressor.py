@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems and the Max Planck Institute for Biological
+# Cybernetics. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import os.path as osp
+
+from collections import namedtuple, OrderedDict
+
+import torch
+import torch.nn as nn
+
+from smplx.lbs import (batch_rodrigues, batch_rigid_transform, blend_shapes,
+                       find_dynamic_lmk_idx_and_bcoords)
+
+# The fields of the body model outputs that the fitting losses read. The
+# vertices are always None.
+JointsOutput = namedtuple('JointsOutput',
+                          ['vertices', 'joints', 'full_pose', 'betas',
+                           'global_orient', 'body_pose', 'left_hand_pose',
+                           'right_hand_pose', 'expression', 'jaw_pose'])
+JointsOutput.__new__.__defaults__ = (None,) * len(JointsOutput._fields)
+
+
+def create_joint_regressor(body_model, gender='neutral', cache_folder=None):
+    ''' Creates the joint regressor of a body model
+
+        Returns None if the joints of the model cannot be computed without
+        posing its whole mesh.
+
+        Parameters
+        ----------
+        body_model: nn.Module
+            The body model, with the joint mapper used for fitting
+        gender: str, optional
+            The gender of the body model, used for the name of the cached
+            regressor (default='neutral')
+        cache_folder: str, optional
+            The folder of the cached regressors. If given, the regressor is
+            loaded from it when it was built for the same model and joint
+            mapping, and stored in it otherwise (default=None)
+    '''
+    if body_model.name() not in ['SMPL', 'SMPL+H', 'SMPL-X']:
+        return None
+    if not JointRegressor.is_supported(body_model):
+        return None
+
+    cache_fn = None
+    if cache_folder is not None:
+        model_name = body_model.name().lower().replace('+', '').replace(
+            '-', '')
+        cache_fn = osp.join(osp.expandvars(cache_folder),
+                            '{}_{}.pt'.format(model_name, gender))
+
+    if cache_fn is not None and osp.exists(cache_fn):
+        regressor = JointRegressor.load(cache_fn, body_model)
+        if regressor is not None:
+            return regressor
+
+    regressor = JointRegressor(body_model)
+    if cache_fn is not None:
+        regressor.save(cache_fn, body_model)
+    return regressor
+
+
+class JointRegressor(nn.Module):
+    ''' Computes the joints of a body model without posing its whole mesh
+
+        The joints of the kinematic tree are regressed from the shaped
+        template mesh, which is a linear function of the shape coefficients.
+        The joint regressor is therefore contracted with the template and
+        the shape blend shapes once, and the rest joints of a sample are
+        computed directly from its shape coefficients. The extra joints,
+        e.g. the nose or the toes, and the landmarks of the face of SMPL-X
+        are regressed from the few vertices that the joint mapper of the
+        model actually uses, and only these vertices are posed with linear
+        blend skinning. The permutation of the joint
+        mapper is folded into a single index of the output joints. The
+        output is the same as the mapped joints of the forward pass of the
+        model.
+    '''
+
+    def __init__(self, body_model, buffers=None):
+        super(JointRegressor, self).__init__()
+
+        self.model_type = body_model.name()
+        self.num_joints = body_model.J_regressor.shape[0]
+        if buffers is None:
+            with torch.no_grad():
+                buffers = self.build(body_model)
+        for name, buf in buffers.items():
+            self.register_buffer(name, buf)
+        self.use_dynamic_landmarks = 'dynamic_vertex_idxs' in buffers
+        self.register_buffer('parents', body_model.parents.clone())
+
+    @staticmethod
+    def num_landmarks(body_model):
+        ''' Returns the number of static and dynamic landmarks of the model
+
+            The static landmarks of the face are interpolated from fixed
+            triangles of the mesh. The dynamic landmarks of the contour of
+            the face use triangles that depend on the rotation of the head.
+        '''
+        if body_model.name() != 'SMPL-X':
+            return 0, 0
+        num_dynamic = 0
+        if body_model.use_face_contour:
+            num_dynamic = body_model.dynamic_lmk_faces_idx.shape[1]
+        return body_model.lmk_faces_idx.shape[0], num_dynamic
+
+    @staticmethod
+    def joint_maps(body_model):
+        ''' Returns the indices of the joints of the forward pass of the
+            model that are kept by its joint mapper
+        '''
+        joint_mapper = body_model.joint_mapper
+        if joint_mapper is not None and getattr(
+                joint_mapper, 'joint_maps', None) is not None:
+            return joint_mapper.joint_maps.tolist()
+        num_extra_joints = len(
+            body_model.vertex_joint_selector.extra_joints_idxs)
+        return list(range(body_model.J_regressor.shape[0] +
+                          num_extra_joints +
+                          sum(JointRegressor.num_landmarks(body_model))))
+
+    @staticmethod
+    def is_supported(body_model):
+        ''' Checks that the joint mapper only selects joints of the forward
+            pass of the model
+        '''
+        num_joints = (body_model.J_regressor.shape[0] +
+                      len(body_model.vertex_joint_selector.extra_joints_idxs) +
+                      sum(JointRegressor.num_landmarks(body_model)))
+        return max(JointRegressor.joint_maps(body_model)) < num_joints
+
+    def build(self, body_model):
+        ''' Computes the buffers of the regressor from the body model '''
+        shapedirs = body_model.shapedirs
+        if self.model_type == 'SMPL-X':
+            shapedirs = torch.cat([shapedirs, body_model.expr_dirs], dim=-1)
+        J_regressor = body_model.J_regressor
+        num_joints = self.num_joints
+
+        buffers = OrderedDict()
+        buffers['joints_template'] = torch.matmul(
+            J_regressor, body_model.v_template)
+        buffers['joints_shapedirs'] = torch.einsum(
+            'jv,vkl->jkl', [J_regressor, shapedirs])
+
+        # The forward pass of the model appends the extra joints, the static
+        # landmarks and the dynamic landmarks to the joints of the kinematic
+        # tree. Each extra joint or static landmark is a fixed combination
+        # of at most three vertices, so they are stacked as the rows of one
+        # regressor over the vertices they use.
+        extra_idxs = body_model.vertex_joint_selector.extra_joints_idxs
+        num_extra_joints = len(extra_idxs)
+        num_static, num_dynamic = self.num_landmarks(body_model)
+        num_static_joints = num_joints + num_extra_joints + num_static
+
+        joint_maps = self.joint_maps(body_model)
+        used_static = sorted(set(
+            idx - num_joints for idx in joint_maps
+            if num_joints <= idx < num_static_joints))
+        used_dynamic = sorted(set(
+            idx - num_static_joints for idx in joint_maps
+            if idx >= num_static_joints))
+
+        rows = []
+        for idx in used_static:
+            if idx < num_extra_joints:
+                rows.append(([extra_idxs[idx].item()], [1.0]))
+            else:
+                lmk_idx = idx - num_extra_joints
+                face = body_model.faces_tensor[
+                    body_model.lmk_faces_idx[lmk_idx]]
+                rows.append((face.tolist(),
+                             body_model.lmk_bary_coords[lmk_idx].tolist()))
+
+        # Only the triangles of the dynamic landmarks that are kept
+        if len(used_dynamic) > 0:
+            dynamic_faces = body_model.faces_tensor[
+                body_model.dynamic_lmk_faces_idx[:, used_dynamic]]
+            dynamic_bary_coords = body_model.dynamic_lmk_bary_coords[
+                :, used_dynamic]
+        else:
+            dynamic_faces = torch.zeros([0], dtype=torch.long)
+
+        vertex_ids = sorted(
+            set(vertex for face, _ in rows for vertex in face) |
+            set(dynamic_faces.view(-1).tolist()))
+        vertex_pos = {vertex: pos for pos, vertex in enumerate(vertex_ids)}
+
+        dtype = body_model.v_template.dtype
+        device = body_model.v_template.device
+        vertex_regressor = torch.zeros([len(rows), len(vertex_ids)],
+                                       dtype=dtype, device=device)
+        for row, (face, weights) in enumerate(rows):
+            for vertex, weight in zip(face, weights):
+                vertex_regressor[row, vertex_pos[vertex]] += weight
+
+        num_rows = num_joints + len(rows)
+        output_idxs = [
+            idx if idx < num_joints else
+            num_joints + used_static.index(idx - num_joints)
+            if idx < num_static_joints else
+            num_rows + used_dynamic.index(idx - num_static_joints)
+            for idx in joint_maps]
+
+        if len(used_dynamic) > 0:
+            # The look-up table of the triangles indexes the posed vertices
+            buffers['dynamic_vertex_idxs'] = dynamic_faces.cpu().apply_(
+                lambda vertex: vertex_pos[vertex]).to(device=device)
+            buffers['dynamic_bary_coords'] = dynamic_bary_coords.clone()
+            buffers['neck_kin_chain'] = body_model.neck_kin_chain.clone()
+
+        vertex_ids = torch.tensor(vertex_ids, dtype=torch.long,
+                                  device=device)
+        num_pose_feats = body_model.posedirs.shape[0]
+        posedirs = body_model.posedirs.view(num_pose_feats, -1, 3)
+        buffers['vertex_regressor'] = vertex_regressor
+        buffers['vertex_template'] = body_model.v_template[vertex_ids].clone()
+        buffers['vertex_shapedirs'] = shapedirs[vertex_ids].clone()
+        buffers['vertex_posedirs'] = posedirs[:, vertex_ids].reshape(
+            num_pose_feats, -1).clone()
+        buffers['vertex_lbs_weights'] = body_model.lbs_weights[
+            vertex_ids].clone()
+        buffers['output_idxs'] = torch.tensor(output_idxs, dtype=torch.long,
+                                              device=device)
+        return buffers
+
+    @staticmethod
+    def cache_key(body_model):
+        ''' Returns the description of the model that a cached regressor
+            must have been built for
+        '''
+        return dict(model_type=body_model.name(),
+                    dtype=str(body_model.v_template.dtype),
+                    num_vertices=body_model.v_template.shape[0],
+                    num_betas=body_model.shapedirs.shape[-1],
+                    num_expression_coeffs=(
+                        body_model.expr_dirs.shape[-1]
+                        if hasattr(body_model, 'expr_dirs') else 0),
+                    template_sum=body_model.v_template.sum().item(),
+                    regressor_sum=body_model.J_regressor.sum().item(),
+                    num_landmarks=JointRegressor.num_landmarks(body_model),
+                    joint_maps=JointRegressor.joint_maps(body_model))
+
+    def save(self, cache_fn, body_model):
+        ''' Stores the buffers of the regressor in a file '''
+        buffers = OrderedDict(
+            (name, buf) for name, buf in self.named_buffers()
+            if name != 'parents')
+        try:
+            os.makedirs(osp.dirname(cache_fn), exist_ok=True)
+            torch.save(dict(key=self.cache_key(body_model), buffers=buffers),
+                       cache_fn)
+        except OSError as err:
+            print('Could not cache the joint regressor in {}: {}'.format(
+                cache_fn, err))
+
+    @classmethod
+    def load(cls, cache_fn, body_model):
+        ''' Loads a cached regressor
+
+            Returns None if the file was built for a different model or
+            joint mapping.
+        '''
+        data = torch.load(cache_fn,
+                          map_location=body_model.v_template.device)
+        if data.get('key') != cls.cache_key(body_model):
+            return None
+        return cls(body_model, buffers=data['buffers'])
+
+    def full_pose(self, body_model, body_pose=None):
+        ''' Returns the pose of all the joints of the model, in the order of
+            its forward pass, and the pose parameters of the output
+        '''
+        global_orient = body_model.global_orient
+        body_pose = body_pose if body_pose is not None else \
+            body_model.body_pose
+        params = dict(global_orient=global_orient, body_pose=body_pose)
+        if self.model_type == 'SMPL':
+            return torch.cat([global_orient, body_pose], dim=1), params
+
+        left_hand_pose = body_model.left_hand_pose
+        right_hand_pose = body_model.right_hand_pose
+        params.update(left_hand_pose=left_hand_pose,
+                      right_hand_pose=right_hand_pose)
+        if body_model.use_pca:
+            left_hand_pose = torch.einsum(
+                'bi,ij->bj', [left_hand_pose,
+                              body_model.left_hand_components])
+            right_hand_pose = torch.einsum(
+                'bi,ij->bj', [right_hand_pose,
+                              body_model.right_hand_components])
+
+        if self.model_type == 'SMPL+H':
+            full_pose = torch.cat([global_orient, body_pose,
+                                   left_hand_pose, right_hand_pose], dim=1)
+        else:
+            params.update(jaw_pose=body_model.jaw_pose,
+                          expression=body_model.expression)
+            batch_size = global_orient.shape[0]
+            full_pose = torch.cat(
+                [global_orient.reshape(batch_size, -1),
+                 body_pose.reshape(batch_size, -1),
+                 body_model.jaw_pose.reshape(batch_size, -1),
+                 body_model.leye_pose.reshape(batch_size, -1),
+                 body_model.reye_pose.reshape(batch_size, -1),
+                 left_hand_pose.reshape(batch_size, -1),
+                 right_hand_pose.reshape(batch_size, -1)], dim=1)
+        return full_pose + body_model.pose_mean, params
+
+    def forward(self, body_model, body_pose=None, betas=None,
+                return_full_pose=False, **kwargs):
+        ''' Computes the joints of the body model
+
+            Parameters
+            ----------
+            body_model: nn.Module
+                The body model the regressor was created for. Its parameters
+                are used for the pose and the shape of the body, except for
+                the given ones
+            body_pose: torch.tensor, optional
+                The pose of the body, in axis-angle format
+            betas: torch.tensor, optional
+                The shape coefficients
+            return_full_pose: bool, optional
+                Return the pose of all the joints (default=False)
+
+            Returns
+            -------
+                output: JointsOutput
+                    The joints of the model, mapped by its joint mapper,
+                    and the parameters they were computed from
+        '''
+        full_pose, params = self.full_pose(body_model, body_pose=body_pose)
+        batch_size = full_pose.shape[0]
+        dtype, device = full_pose.dtype, full_pose.device
+
+        betas = betas if betas is not None else body_model.betas
+        if betas.shape[0] != batch_size:
+            betas = betas.expand(batch_size, -1)
+        shape_components = betas
+        if self.model_type == 'SMPL-X':
+            shape_components = torch.cat([betas, params['expression']],
+                                         dim=-1)
+
+        rot_mats = batch_rodrigues(full_pose.view(-1, 3)).view(
+            [batch_size, -1, 3, 3])
+        rest_joints = self.joints_template + torch.einsum(
+            'bl,jkl->bjk', [shape_components, self.joints_shapedirs])
+        joints, rel_transforms = batch_rigid_transform(
+            rot_mats, rest_joints, self.parents, dtype=dtype)
+
+        # Linear blend skinning of the vertices of the extra joints and of
+        # the landmarks
+        ident = torch.eye(3, dtype=dtype, device=device)
+        pose_feature = (rot_mats[:, 1:] - ident).view([batch_size, -1])
+        vertices = (
+            self.vertex_template +
+            blend_shapes(shape_components, self.vertex_shapedirs) +
+            torch.matmul(pose_feature, self.vertex_posedirs).view(
+                batch_size, -1, 3))
+        transforms = torch.matmul(
+            self.vertex_lbs_weights,
+            rel_transforms.view(batch_size, self.num_joints, 16)).view(
+                batch_size, -1, 4, 4)
+        vertices = torch.matmul(
+            transforms[:, :, :3, :3],
+            vertices.unsqueeze(dim=-1)).squeeze(dim=-1) + \
+            transforms[:, :, :3, 3]
+        extra_joints = torch.einsum('bvk,jv->bjk',
+                                    [vertices, self.vertex_regressor])
+        joints = [joints, extra_joints]
+
+        if self.use_dynamic_landmarks:
+            dyn_vertex_idxs, dyn_bary_coords = \
+                find_dynamic_lmk_idx_and_bcoords(
+                    vertices, full_pose, self.dynamic_vertex_idxs,
+                    self.dynamic_bary_coords, self.neck_kin_chain)
+            batch_idxs = torch.arange(
+                batch_size, dtype=torch.long, device=device).view(-1, 1, 1)
+            dyn_vertices = vertices[batch_idxs, dyn_vertex_idxs]
+            joints.append(torch.einsum('blfi,blf->bli',
+                                       [dyn_vertices, dyn_bary_coords]))
+
+        joints = torch.index_select(torch.cat(joints, dim=1), 1,
+                                    self.output_idxs)
+        if hasattr(body_model, 'transl'):
+            joints = joints + body_model.transl.unsqueeze(dim=1)
+
+        return JointsOutput(joints=joints, betas=betas,
+                            full_pose=full_pose if return_full_pose else None,
+                            **params)
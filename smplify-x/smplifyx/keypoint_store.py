@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems and the Max Planck Institute for Biological
+# Cybernetics. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import os
+import os.path as osp
+
+import time
+import argparse
+
+import numpy as np
+
+# The file names of a keypoint store, inside its folder
+KEYPOINTS_FN = 'keypoints.bin'
+INDEX_FN = 'index.npz'
+KEYPOINTS_SUFFIX = '_keypoints.json'
+
+# The number of body joints of the stores that do not record it
+NUM_BODY_JOINTS = 25
+NUM_HAND_JOINTS = 21
+NUM_FACE_LANDMARKS = 51
+NUM_CONTOUR_JOINTS = 17
+
+
+def store_parts(num_body_joints=NUM_BODY_JOINTS):
+    ''' Returns the parts of the keypoints of a person in a store
+
+        The keypoints of every person are stored in this order, so that the
+        keypoints of the usual combinations of parts are a slice of the
+        store. Every part is given by its name, its key in the OpenPose
+        output and its number of joints. The number of body joints depends
+        on the body format of OpenPose.
+    '''
+    return [('body', 'pose_keypoints_2d', num_body_joints),
+            ('hand_left', 'hand_left_keypoints_2d', NUM_HAND_JOINTS),
+            ('hand_right', 'hand_right_keypoints_2d', NUM_HAND_JOINTS),
+            ('face', 'face_keypoints_2d', NUM_FACE_LANDMARKS),
+            ('contour', 'face_keypoints_2d', NUM_CONTOUR_JOINTS)]
+
+
+def list_keypoint_files(keyp_folder):
+    ''' Returns the sorted keypoint files of a folder and their last change
+
+        Returns
+        -------
+            keypoint_fns: list
+                The sorted names of the `*_keypoints.json` files
+            mtime: float
+                The latest modification time of the files, or 0 if there
+                are none
+    '''
+    keypoint_fns, mtime = [], 0.0
+    for entry in os.scandir(keyp_folder):
+        if (entry.name.endswith(KEYPOINTS_SUFFIX) and
+                not entry.name.startswith('.')):
+            keypoint_fns.append(entry.name)
+            mtime = max(mtime, entry.stat().st_mtime)
+    return sorted(keypoint_fns), mtime
+
+
+def is_stale_store(keyp_folder, store_folder):
+    ''' Checks whether a keypoint store is missing or out of date
+
+        The index of a store records the number of keypoint files it was
+        compiled from and their latest modification time. The store is
+        stale when the folder has a different number of files or when one
+        of them changed since, e.g. after OpenPose was run again. The
+        stores whose index does not record them are stale too.
+    '''
+    index_path = osp.join(store_folder, INDEX_FN)
+    if not osp.exists(index_path):
+        return True
+    with np.load(index_path) as index:
+        if 'keyp_mtime' not in index.files:
+            return True
+        num_files = int(index['num_files'])
+        keyp_mtime = float(index['keyp_mtime'])
+    keypoint_fns, mtime = list_keypoint_files(keyp_folder)
+    return len(keypoint_fns) != num_files or mtime > keyp_mtime
+
+
+def compile_keypoint_store(keyp_folder, store_folder, num_workers=1,
+                           chunk_size=4096):
+    ''' Converts a folder of OpenPose keypoint files to a keypoint store
+
+        The keypoints of all the persons of all the frames are written to one
+        binary file of float32 values, with J x 3 values per person. The
+        index holds the name of every frame, the offset of its first person
+        in the keypoint file, the gender labels of the persons and the number
+        of body joints. The parts that OpenPose did not detect for a person,
+        or was not run for, are left at zero, as `read_keypoints` returns
+        them. All the persons must have the same number of body joints.
+        The index also records the number of keypoint files and their latest
+        modification time, which `is_stale_store` compares to the folder.
+
+        The files are read in chunks of `chunk_size` files with
+        `read_keypoints_batch`, by a pool of `num_workers` processes. The
+        store is written next to its final path, to files named after the
+        process, and then moved, so that an interrupted compilation does not
+        leave a partial store behind and the processes that compile the same
+        store at once do not write to the same files.
+
+        Parameters
+        ----------
+        keyp_folder: str
+            The folder with the `*_keypoints.json` files of OpenPose
+        store_folder: str
+            The folder the store is written to
+        num_workers: int, optional
+            The number of processes that read the files (default=1)
+        chunk_size: int, optional
+            The number of files that are read at once (default=4096)
+
+        Returns
+        -------
+            num_frames: int
+                The number of frames in the store
+            num_persons: int
+                The number of persons in the store
+    '''
+    # The dataset of data_parser reads its keypoints from this module
+    from data_parser import read_keypoints_batch, create_reader_pool
+
+    keypoint_fns, keyp_mtime = list_keypoint_files(keyp_folder)
+
+    if not osp.exists(store_folder):
+        os.makedirs(store_folder)
+    keypoints_path = osp.join(store_folder, KEYPOINTS_FN)
+    index_path = osp.join(store_folder, INDEX_FN)
+
+    offsets = [0]
+    gender_pd, gender_gt = [], []
+    # The layout of the rows is set by the body of the first person
+    parts = None
+    # The temporary files are named after the process that writes them
+    keypoints_tmp = '{}.{}.tmp'.format(keypoints_path, os.getpid())
+    index_tmp = '{}.{}.tmp'.format(index_path, os.getpid())
+    executor = create_reader_pool(num_workers) if num_workers > 1 else None
+    try:
+        with open(keypoints_tmp, 'wb') as keypoints_file:
+            for start in range(0, len(keypoint_fns), chunk_size):
+                chunk_fns = [osp.join(keyp_folder, keypoint_fn)
+                             for keypoint_fn in
+                             keypoint_fns[start:start + chunk_size]]
+                chunk = read_keypoints_batch(
+                    chunk_fns, use_hands=True, use_face=True,
+                    use_face_contour=True, num_workers=num_workers,
+                    executor=executor)
+                for keypoint_fn, keyp_tuple in zip(chunk_fns, chunk):
+                    keypoints = keyp_tuple.keypoints
+                    num_people = len(keypoints)
+                    offsets.append(offsets[-1] + num_people)
+                    # The persons without a gender label come last
+                    gender_pd += keyp_tuple.gender_pd + [''] * (
+                        num_people - len(keyp_tuple.gender_pd))
+                    gender_gt += keyp_tuple.gender_gt + [''] * (
+                        num_people - len(keyp_tuple.gender_gt))
+                    if num_people < 1:
+                        continue
+
+                    num_joints = keypoints.shape[1]
+                    if parts is None:
+                        parts = store_parts(
+                            num_joints - sum(part[2]
+                                             for part in store_parts(0)))
+                    if num_joints != sum(part[2] for part in parts):
+                        raise ValueError(
+                            '{}: the persons have {} body keypoints, but the'
+                            ' store has {}'.format(
+                                keypoint_fn, num_joints - sum(
+                                    part[2] for part in parts[1:]),
+                                parts[0][2]))
+                    keypoints_file.write(keypoints.tobytes())
+
+        if parts is None:
+            parts = store_parts()
+        # np.savez appends the extension to paths that do not end with it
+        with open(index_tmp, 'wb') as index_file:
+            np.savez(index_file,
+                     frames=np.array([keypoint_fn[:-len(KEYPOINTS_SUFFIX)]
+                                      for keypoint_fn in keypoint_fns],
+                                     dtype=np.str_),
+                     offsets=np.array(offsets, dtype=np.int64),
+                     gender_pd=np.array(gender_pd, dtype=np.str_),
+                     gender_gt=np.array(gender_gt, dtype=np.str_),
+                     num_body_joints=parts[0][2],
+                     num_files=len(keypoint_fns), keyp_mtime=keyp_mtime)
+        os.replace(keypoints_tmp, keypoints_path)
+        os.replace(index_tmp, index_path)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        # The temporary files are only left if the compilation failed
+        for tmp_path in [keypoints_tmp, index_tmp]:
+            if osp.exists(tmp_path):
+                os.remove(tmp_path)
+    return len(keypoint_fns), offsets[-1]
+
+
+class KeypointStore(object):
+    ''' Reads the keypoints of the frames from a compiled keypoint store
+
+        The keypoint file is memory-mapped, so opening a store only reads
+        its index, and the keypoints of a frame are a view of the file
+        whenever the requested parts are contiguous in it.
+    '''
+
+    def __init__(self, store_folder):
+        super(KeypointStore, self).__init__()
+        self.store_folder = store_folder
+
+        with np.load(osp.join(store_folder, INDEX_FN)) as index:
+            self.frames = index['frames']
+            self.offsets = index['offsets']
+            self.gender_pd = index['gender_pd']
+            self.gender_gt = index['gender_gt']
+            num_body_joints = NUM_BODY_JOINTS
+            if 'num_body_joints' in index.files:
+                num_body_joints = int(index['num_body_joints'])
+        self.store_parts = store_parts(num_body_joints)
+        self.num_joints = sum(part[2] for part in self.store_parts)
+        self.frame_idxs = {frame: idx
+                           for idx, frame in enumerate(self.frames.tolist())}
+
+        num_persons = int(self.offsets[-1])
+        if num_persons > 0:
+            self.keypoints = np.memmap(
+                osp.join(store_folder, KEYPOINTS_FN), dtype=np.float32,
+                mode='r', shape=(num_persons, self.num_joints, 3))
+        else:
+            self.keypoints = np.zeros([0, self.num_joints, 3],
+                                      dtype=np.float32)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, frame):
+        return frame in self.frame_idxs
+
+    def joint_idxs(self, use_hands=True, use_face=True,
+                   use_face_contour=False):
+        ''' Returns the indices of the requested parts in the store
+
+            The result is a slice when the parts are contiguous, which is the
+            case unless the face is used without the hands.
+        '''
+        names = ['body']
+        if use_hands:
+            names += ['hand_left', 'hand_right']
+        if use_face:
+            names += ['face']
+            if use_face_contour:
+                names += ['contour']
+        idxs, start = [], 0
+        for name, _, num_joints in self.store_parts:
+            if name in names:
+                idxs += list(range(start, start + num_joints))
+            start += num_joints
+        if idxs == list(range(len(idxs))):
+            return slice(0, len(idxs))
+        return np.array(idxs, dtype=np.int64)
+
+    def read(self, frame, use_hands=True, use_face=True,
+             use_face_contour=False):
+        ''' Returns the keypoints and the gender labels of a frame
+
+            Returns
+            -------
+                keypoints: np.array, PxJx3
+                    The keypoints of the P persons of the frame
+                gender_gt: list
+                    The ground truth gender of the persons that have one
+                gender_pd: list
+                    The predicted gender of the persons that have one
+        '''
+        frame_idx = self.frame_idxs[frame]
+        start, end = self.offsets[frame_idx], self.offsets[frame_idx + 1]
+        joint_idxs = self.joint_idxs(use_hands=use_hands, use_face=use_face,
+                                     use_face_contour=use_face_contour)
+        keypoints = self.keypoints[start:end][:, joint_idxs]
+
+        gender_gt = [gender for gender in self.gender_gt[start:end].tolist()
+                     if len(gender) > 0]
+        gender_pd = [gender for gender in self.gender_pd[start:end].tolist()
+                     if len(gender) > 0]
+        return keypoints, gender_gt, gender_pd
+
+
+def main(keyp_folder, store_folder, num_workers=1):
+    if not osp.exists(keyp_folder):
+        print('Keypoint folder {} does not exist!'.format(keyp_folder))
+        sys.exit(-1)
+
+    start = time.time()
+    num_frames, num_persons = compile_keypoint_store(
+        keyp_folder, store_folder, num_workers=num_workers)
+    print('Compiled {} persons of {} frames to {} in {:.2f} s'.format(
+        num_persons, num_frames, store_folder, time.time() - start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Compiles a folder of OpenPose keypoint files to a' +
+        ' keypoint store')
+    parser.add_argument('--keyp_folder', type=str, required=True,
+                        help='The folder with the OpenPose keypoint files')
+    parser.add_argument('--store_folder', type=str, required=True,
+                        help='The folder the keypoint store is written to')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='The number of processes that read the' +
+                        ' keypoint files')
+    args = parser.parse_args()
+
+    main(args.keyp_folder, args.store_folder, num_workers=args.num_workers)
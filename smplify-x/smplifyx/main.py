@@ -23,79 +23,53 @@ import sys
 import os
 
 import os.path as osp
+from collections import OrderedDict
 
 import time
 import yaml
+import numpy as np
+import multiprocessing as mp
 import torch
 
 import smplx
 
+import utils
 from utils import JointMapper
 from cmd_parser import parse_config
-from data_parser import create_dataset
+from data_parser import create_dataset, FramePrefetcher
 from fit_single_frame import fit_single_frame
+from batch_scheduler import BatchScheduler, WindowScheduler, keypoint_extent
+from profiling import create_profiler, PROFILE_FN
 
 from camera import create_camera
+from human_body_prior.tools.model_loader import load_vposer
 from prior import create_prior
+from joint_regressor import create_joint_regressor
 
 torch.backends.cudnn.enabled = False
 
 
-def main(**args):
-    output_folder = args.pop('output_folder')
-    output_folder = osp.expandvars(output_folder)
-    if not osp.exists(output_folder):
-        os.makedirs(output_folder)
-
-    # Store the arguments for the current experiment
-    conf_fn = osp.join(output_folder, 'conf.yaml')
-    with open(conf_fn, 'w') as conf_file:
-        yaml.dump(args, conf_file)
+def load_models(dataset_obj, dtype=torch.float32, **args):
+    ''' Creates the body models, the camera and the priors used for fitting
 
-    result_folder = args.pop('result_folder', 'results')
-    result_folder = osp.join(output_folder, result_folder)
-    if not osp.exists(result_folder):
-        os.makedirs(result_folder)
-
-    mesh_folder = args.pop('mesh_folder', 'meshes')
-    mesh_folder = osp.join(output_folder, mesh_folder)
-    if not osp.exists(mesh_folder):
-        os.makedirs(mesh_folder)
-
-    out_img_folder = osp.join(output_folder, 'images')
-    if not osp.exists(out_img_folder):
-        os.makedirs(out_img_folder)
+        The returned objects can be reused for any number of frames, so
+        they are only loaded once per process.
 
-    float_dtype = args['float_dtype']
-    if float_dtype == 'float64':
-        dtype = torch.float64
-    elif float_dtype == 'float32':
-        dtype = torch.float64
-    else:
-        print('Unknown float type {}, exiting!'.format(float_dtype))
-        sys.exit(-1)
+        Parameters
+        ----------
+        dataset_obj: Dataset
+            The dataset whose keypoints are fitted
+        dtype: torch.dtype, optional
+            The data type of the models (default=torch.float32)
 
+        Returns
+        -------
+            models: dict
+                The body models and their joint regressors, with the gender
+                as a key, the camera, the joint weights, the priors and
+                VPoser
+    '''
     use_cuda = args.get('use_cuda', True)
-    if use_cuda and not torch.cuda.is_available():
-        print('CUDA is not available, exiting!')
-        sys.exit(-1)
-
-    img_folder = args.pop('img_folder', 'images')
-    dataset_obj = create_dataset(img_folder=img_folder, **args)
-
-    start = time.time()
-
-    input_gender = args.pop('gender', 'neutral')
-    gender_lbl_type = args.pop('gender_lbl_type', 'none')
-    max_persons = args.pop('max_persons', -1)
-
-    float_dtype = args.get('float_dtype', 'float32')
-    if float_dtype == 'float64':
-        dtype = torch.float64
-    elif float_dtype == 'float32':
-        dtype = torch.float32
-    else:
-        raise ValueError('Unknown float type {}, exiting!'.format(float_dtype))
 
     joint_mapper = JointMapper(dataset_obj.get_model2data())
 
@@ -173,6 +147,12 @@ def main(**args):
 
     angle_prior = create_prior(prior_type='angle', dtype=dtype)
 
+    vposer = None
+    if args.get('use_vposer'):
+        vposer_ckpt = osp.expandvars(args.get('vposer_ckpt', ''))
+        vposer, _ = load_vposer(vposer_ckpt, vp_model='snapshot')
+        vposer.eval()
+
     if use_cuda and torch.cuda.is_available():
         device = torch.device('cuda')
 
@@ -184,6 +164,8 @@ def main(**args):
         body_pose_prior = body_pose_prior.to(device=device)
         angle_prior = angle_prior.to(device=device)
         shape_prior = shape_prior.to(device=device)
+        if vposer is not None:
+            vposer = vposer.to(device=device)
         if use_face:
             expr_prior = expr_prior.to(device=device)
             jaw_prior = jaw_prior.to(device=device)
@@ -202,7 +184,197 @@ def main(**args):
     # Add a fake batch dimension for broadcasting
     joint_weights.unsqueeze_(dim=0)
 
-    for idx, data in enumerate(dataset_obj):
+    body_models = {'male': male_model, 'female': female_model}
+    if args.get('model_type') != 'smplh':
+        body_models['neutral'] = neutral_model
+
+    # The joints of the models are computed without their mesh in the
+    # stages that do not need it
+    joint_regressors = {}
+    if args.get('joints_only', True):
+        regressor_folder = args.get('joint_regressor_folder', None)
+        if regressor_folder is None:
+            regressor_folder = osp.join(args.get('model_folder'),
+                                        'joint_regressors')
+        joint_regressors = {
+            gender: create_joint_regressor(body_model, gender=gender,
+                                           cache_folder=regressor_folder)
+            for gender, body_model in body_models.items()}
+
+    return dict(body_models=body_models,
+                joint_regressors=joint_regressors,
+                camera=camera,
+                joint_weights=joint_weights,
+                shape_prior=shape_prior,
+                expr_prior=expr_prior,
+                body_pose_prior=body_pose_prior,
+                left_hand_prior=left_hand_prior,
+                right_hand_prior=right_hand_prior,
+                jaw_prior=jaw_prior,
+                angle_prior=angle_prior,
+                vposer=vposer)
+
+
+def match_previous_fit(keypoints, gender, prev_fits, track_dist=0.5):
+    ''' Returns the fit of the previous frame that a person continues
+
+        Parameters
+        ----------
+        keypoints: np.array, Jx3
+            The 2D keypoints of the person in the current frame
+        gender: str
+            The body model of the person
+        prev_fits: list
+            The gender, the keypoints and the fitted parameters of the
+            persons of the previous frame
+        track_dist: float, optional
+            The largest distance between the centers of the keypoints of the
+            two frames, relative to the size of the previous ones
+            (default=0.5)
+
+        Returns
+        -------
+            idx: int
+                The index of the nearest fit of the same body model in
+                `prev_fits`, or None if none of them is close enough
+    '''
+    center, _ = keypoint_extent(keypoints)
+    best_idx, best_dist = None, None
+    for idx, (prev_gender, prev_keypoints, _) in enumerate(prev_fits):
+        if prev_gender != gender:
+            continue
+        prev_center, prev_size = keypoint_extent(prev_keypoints)
+        dist = np.linalg.norm(center - prev_center)
+        if dist < track_dist * prev_size and (
+                best_dist is None or dist < best_dist):
+            best_idx, best_dist = idx, dist
+    return best_idx
+
+
+def fit_frames(frames, models, output_folder, result_folder, mesh_folder,
+               dtype=torch.float32, input_gender='neutral',
+               gender_lbl_type='none', max_persons=-1, sequence=False,
+               window_size=0, window_stride=4, track_dist=0.5, profiler=None,
+               **args):
+    ''' Fits the persons of a sequence of frames
+
+        Parameters
+        ----------
+        frames: iterable
+            The frames that are fitted, as returned by the dataset
+        models: dict
+            The body models, the camera and the priors, as returned by
+            `load_models`
+        output_folder, result_folder, mesh_folder: str
+            The folders where the fitting results are written
+        sequence: bool, optional
+            If True the frames are treated as a video. Every person starts
+            from the fit of the nearest person of the previous frame, and
+            only the last stages are run. Persons without a close enough
+            one are fitted from scratch (default=False)
+        window_size: int, optional
+            If larger than one, the frames of every person are fitted
+            jointly in overlapping windows of this size, with a shared shape
+            and smooth motion. The persons are tracked from frame to frame
+            by the position of their keypoints (default=0)
+        window_stride: int, optional
+            The number of frames a window advances (default=4)
+        track_dist: float, optional
+            A person continues a person of the previous frame whose
+            keypoints have a center closer than this times their size
+            (default=0.5)
+        profiler: FittingProfiler, optional
+            Writes the statistics of every fitting stage. By default one is
+            created if the `profile` argument is set
+
+        Returns
+        -------
+            output_fns: list
+                The result, mesh and image paths of every fitted person
+    '''
+    batch_size = args.get('batch_size', 1)
+    fit_window = window_size > 1
+    if fit_window:
+        scheduler = WindowScheduler(window_size=window_size,
+                                    window_stride=window_stride,
+                                    track_dist=track_dist)
+    else:
+        # Persons of consecutive frames are packed into batches of the same
+        # size
+        scheduler = BatchScheduler(batch_size=batch_size)
+    if profiler is None:
+        profiler = create_profiler(output_folder, **args)
+    output_fns = []
+    # The body model, the keypoints and the fitted parameters of the persons
+    # of the previous and the current frame, used to initialize the next
+    # frame in sequence mode
+    prev_results, curr_results = [], []
+
+    def fit_batch(batch):
+        gender = batch['group'][0]
+        body_model = models['body_models'][gender]
+
+        fit_args = args
+        num_rows = batch_size
+        if fit_window:
+            # The models hold one sample per frame of the window, which is
+            # shorter at the end of a sequence
+            num_rows = batch['num_persons']
+            fit_args = dict(args, batch_size=num_rows)
+        # A fit that failed, e.g. in a job of the fitting server, can also
+        # leave the models with the rows of its orientation hypotheses
+        for module in [body_model, models['camera']]:
+            if module.batch_size != num_rows:
+                utils.index_batch(module, torch.zeros(
+                    num_rows, dtype=torch.long))
+
+        joint_regressor = models['joint_regressors'].get(gender)
+        profile_labels = [{'frame': frame, 'person': person_id,
+                           'padding': curr_result_fn is None}
+                          for frame, person_id, curr_result_fn in zip(
+                              batch['frame'], batch['person_id'],
+                              batch['result_fn'])]
+        result = fit_single_frame(batch['img'], batch['keypoints'],
+                                  body_model=body_model,
+                                  joint_regressor=joint_regressor,
+                                  camera=models['camera'],
+                                  joint_weights=models['joint_weights'],
+                                  dtype=dtype,
+                                  output_folder=output_folder,
+                                  out_img_fn=batch['out_img_fn'],
+                                  result_fn=batch['result_fn'],
+                                  mesh_fn=batch['mesh_fn'],
+                                  shape_prior=models['shape_prior'],
+                                  expr_prior=models['expr_prior'],
+                                  body_pose_prior=models['body_pose_prior'],
+                                  left_hand_prior=models['left_hand_prior'],
+                                  right_hand_prior=models['right_hand_prior'],
+                                  jaw_prior=models['jaw_prior'],
+                                  angle_prior=models['angle_prior'],
+                                  vposer=models['vposer'],
+                                  init_params=batch['init_params'],
+                                  fit_window=fit_window,
+                                  profiler=profiler,
+                                  profile_labels=profile_labels,
+                                  **fit_args)
+        if fit_window:
+            scheduler.update(batch, result)
+
+        for idx in range(batch['num_persons']):
+            output_fns.append({key: batch[key][idx] for key in
+                               ['result_fn', 'mesh_fn', 'out_img_fn']})
+            if sequence:
+                curr_results.append(
+                    (gender, batch['keypoints'][idx],
+                     {key: val[idx:idx + 1] for key, val in result.items()}))
+
+    # The frames without persons are counted too, so that the tracks of
+    # the windows do not continue across them
+    for frame_idx, data in enumerate(frames):
+        if len(data) < 1:
+            # The persons of the next frame do not continue older fits
+            prev_results = []
+            continue
 
         img = data['img']
         fn = data['fn']
@@ -228,6 +400,7 @@ def main(**args):
                                        '{:03d}'.format(person_id))
             if not osp.exists(curr_img_folder):
                 os.makedirs(curr_img_folder)
+            out_img_fn = osp.join(curr_img_folder, 'output.png')
 
             if gender_lbl_type != 'none':
                 if gender_lbl_type == 'pd' and 'gender_pd' in data:
@@ -237,33 +410,208 @@ def main(**args):
             else:
                 gender = input_gender
 
-            if gender == 'neutral':
-                body_model = neutral_model
-            elif gender == 'female':
-                body_model = female_model
-            elif gender == 'male':
-                body_model = male_model
+            if fit_window:
+                batches = scheduler.add(img, keypoints[person_id],
+                                        result_fn=curr_result_fn,
+                                        mesh_fn=curr_mesh_fn,
+                                        out_img_fn=out_img_fn,
+                                        frame_idx=frame_idx,
+                                        group=(gender,),
+                                        person_id=person_id,
+                                        frame=fn)
+            else:
+                # OpenPose does not list the persons in the same order in
+                # every frame, so they are matched by their position
+                init_params = None
+                prev_idx = match_previous_fit(keypoints[person_id], gender,
+                                              prev_results,
+                                              track_dist=track_dist)
+                if prev_idx is not None:
+                    init_params = prev_results.pop(prev_idx)[2]
+
+                # Persons that start from a previous fit run fewer stages,
+                # so they are not mixed in a batch with the ones that do not
+                batches = scheduler.add(img, keypoints[person_id],
+                                        result_fn=curr_result_fn,
+                                        mesh_fn=curr_mesh_fn,
+                                        out_img_fn=out_img_fn,
+                                        group=(gender,
+                                               init_params is not None),
+                                        person_id=person_id,
+                                        init_params=init_params,
+                                        frame=fn)
+            for batch in batches:
+                fit_batch(batch)
+
+        if sequence and not fit_window:
+            # The next frame needs the results of this one
+            for batch in scheduler.flush():
+                fit_batch(batch)
+            prev_results, curr_results = curr_results, []
+
+    # Fit the persons that did not fill a complete batch
+    for batch in scheduler.flush():
+        fit_batch(batch)
+
+    if fit_window:
+        # Frames are fitted in several windows, report each one once
+        output_fns = list(OrderedDict(
+            (fns['result_fn'], fns) for fns in output_fns).values())
+    return output_fns
+
+
+def fitting_worker(worker_id, frame_queue, num_threads, args):
+    ''' Fits the frames taken from a queue in a separate process
+
+        The worker loads the models once and then fits frames until it reads
+        None from the queue.
+
+        Parameters
+        ----------
+        worker_id: int
+            The index of the worker
+        frame_queue: multiprocessing.Queue
+            The queue with the indices of the frames that are still to be
+            fitted
+        num_threads: int
+            The number of threads used by torch in the worker
+        args: dict
+            The fitting configuration
+    '''
+    # The tensors of a fit are tiny, so the workers should not compete for
+    # the cores with the thread pools of torch
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(num_threads)
+    except RuntimeError:
+        pass
+
+    # The main process compiled the keypoint store if it was out of date
+    img_folder = args.pop('img_folder', 'images')
+    dataset_obj = create_dataset(img_folder=img_folder, check_store=False,
+                                 **args)
+    models = load_models(dataset_obj, **args)
+
+    frames = iter(frame_queue.get, None)
+    # A frame that a worker reads ahead is taken from the shared queue, so
+    # the other workers cannot fit it. Reading more than the next frame
+    # ahead would leave idle workers at the end of the queue, while the
+    # last frames wait in the prefetch queues of busy ones.
+    num_prefetch = min(args.get('prefetch_frames', 4), 1)
+    if num_prefetch > 0:
+        frames = FramePrefetcher(dataset_obj, indices=frames,
+                                 num_prefetch=num_prefetch,
+                                 num_threads=args.get('loader_threads', 2))
+        fit_frames(frames, models, **args)
+        print('Worker {}: {}'.format(worker_id, frames.summary()))
+    else:
+        fit_frames((dataset_obj[idx] for idx in frames), models, **args)
+
 
-            out_img_fn = osp.join(curr_img_folder, 'output.png')
+def main(**args):
+    output_folder = args.pop('output_folder')
+    output_folder = osp.expandvars(output_folder)
+    if not osp.exists(output_folder):
+        os.makedirs(output_folder)
+
+    # Store the arguments for the current experiment
+    conf_fn = osp.join(output_folder, 'conf.yaml')
+    with open(conf_fn, 'w') as conf_file:
+        yaml.dump(args, conf_file)
+    # The profiling records are appended, so start from an empty file
+    profile_fn = osp.join(output_folder, PROFILE_FN)
+    if args.get('profile', False) and osp.exists(profile_fn):
+        os.remove(profile_fn)
+
+    result_folder = args.pop('result_folder', 'results')
+    result_folder = osp.join(output_folder, result_folder)
+    if not osp.exists(result_folder):
+        os.makedirs(result_folder)
+
+    mesh_folder = args.pop('mesh_folder', 'meshes')
+    mesh_folder = osp.join(output_folder, mesh_folder)
+    if not osp.exists(mesh_folder):
+        os.makedirs(mesh_folder)
+
+    out_img_folder = osp.join(output_folder, 'images')
+    if not osp.exists(out_img_folder):
+        os.makedirs(out_img_folder)
+
+    use_cuda = args.get('use_cuda', True)
+    if use_cuda and not torch.cuda.is_available():
+        print('CUDA is not available, exiting!')
+        sys.exit(-1)
+
+    img_folder = args.pop('img_folder', 'images')
+    dataset_obj = create_dataset(img_folder=img_folder, **args)
 
-            fit_single_frame(img, keypoints[[person_id]],
-                             body_model=body_model,
-                             camera=camera,
-                             joint_weights=joint_weights,
-                             dtype=dtype,
-                             output_folder=output_folder,
-                             result_folder=curr_result_folder,
-                             out_img_fn=out_img_fn,
-                             result_fn=curr_result_fn,
-                             mesh_fn=curr_mesh_fn,
-                             shape_prior=shape_prior,
-                             expr_prior=expr_prior,
-                             body_pose_prior=body_pose_prior,
-                             left_hand_prior=left_hand_prior,
-                             right_hand_prior=right_hand_prior,
-                             jaw_prior=jaw_prior,
-                             angle_prior=angle_prior,
-                             **args)
+    start = time.time()
+
+    input_gender = args.pop('gender', 'neutral')
+    gender_lbl_type = args.pop('gender_lbl_type', 'none')
+    max_persons = args.pop('max_persons', -1)
+
+    dtype, optim_dtype = utils.float_dtypes(
+        args.get('float_dtype', 'float32'))
+
+    num_workers = args.pop('num_workers', 1)
+    num_threads = args.pop('num_threads', 0)
+    if num_threads < 1:
+        num_threads = max(1, mp.cpu_count() // max(1, num_workers))
+
+    args.update(output_folder=output_folder, result_folder=result_folder,
+                mesh_folder=mesh_folder, dtype=dtype, optim_dtype=optim_dtype,
+                input_gender=input_gender, gender_lbl_type=gender_lbl_type,
+                max_persons=max_persons)
+
+    if num_workers > 1 and (args.get('sequence', False) or
+                            args.get('window_size', 0) > 1):
+        print('The frames of a sequence are fitted in order, so they' +
+              ' cannot be split among workers, exiting!')
+        sys.exit(-1)
+
+    if num_workers > 1:
+        if args.get('prefetch_frames', 4) > 1:
+            print('Worker processes read at most one frame ahead, the' +
+                  ' prefetch_frames setting of {} is not used'.format(
+                      args['prefetch_frames']))
+        # Every worker takes the next frame from the queue as soon as it is
+        # done with the previous one
+        ctx = mp.get_context('spawn')
+        frame_queue = ctx.Queue()
+        for idx in range(len(dataset_obj)):
+            frame_queue.put(idx)
+        for _ in range(num_workers):
+            frame_queue.put(None)
+
+        workers = []
+        for worker_id in range(num_workers):
+            worker_args = dict(args, img_folder=img_folder)
+            worker = ctx.Process(target=fitting_worker,
+                                 args=(worker_id, frame_queue, num_threads,
+                                       worker_args))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+
+        failed = [worker_id for worker_id, worker in enumerate(workers)
+                  if worker.exitcode != 0]
+        if len(failed) > 0:
+            print('Workers {} failed, exiting!'.format(failed))
+            sys.exit(-1)
+    else:
+        models = load_models(dataset_obj, **args)
+        frames = dataset_obj
+        num_prefetch = args.get('prefetch_frames', 4)
+        if num_prefetch > 0:
+            # The next frames are read while the current one is fitted
+            frames = FramePrefetcher(
+                dataset_obj, num_prefetch=num_prefetch,
+                num_threads=args.get('loader_threads', 2))
+        fit_frames(frames, models, **args)
+        if num_prefetch > 0:
+            print(frames.summary())
 
     elapsed = time.time() - start
     time_msg = time.strftime('%H hours, %M minutes, %S seconds',
@@ -194,11 +194,15 @@ class LBFGS(Optimizer):
             value/parameter changes (default: 1e-9).
         history_size (int): update history size (default: 100).
         line_search_fn (str): either 'strong_Wolfe' or None (default: None).
+        state_dtype (torch.dtype): the data type of the history, of the line
+            search and of a copy of the parameters that the steps are
+            applied to, when it differs from the one of the parameters
+            (default: None).
     """
 
     def __init__(self, params, lr=1, max_iter=20, max_eval=None,
                  tolerance_grad=1e-5, tolerance_change=1e-9, history_size=100,
-                 line_search_fn=None):
+                 line_search_fn=None, state_dtype=None):
         if max_eval is None:
             max_eval = max_iter * 5 // 4
         defaults = dict(lr=lr, max_iter=max_iter, max_eval=max_eval,
@@ -212,6 +216,8 @@ class LBFGS(Optimizer):
 
         self._params = self.param_groups[0]['params']
         self._numel_cache = None
+        self._state_dtype = state_dtype
+        self._master_params = None
 
     def _numel(self):
         if self._numel_cache is None:
@@ -228,21 +234,50 @@ class LBFGS(Optimizer):
             else:
                 view = p.grad.view(-1)
             views.append(view)
-        return torch.cat(views, 0)
+        flat_grad = torch.cat(views, 0)
+        if self._master_params is not None:
+            flat_grad = flat_grad.to(dtype=self._state_dtype)
+        return flat_grad
+
+    def _sync_master_params(self):
+        """Updates the copies of the parameters in the state data type.
+
+        Only the values that were changed outside of the optimizer are
+        copied again.
+        """
+        if self._state_dtype is None or all(
+                p.dtype == self._state_dtype for p in self._params):
+            self._master_params = None
+            return
+        if self._master_params is None:
+            self._master_params = [p.detach().to(dtype=self._state_dtype)
+                                   for p in self._params]
+            return
+        for p, master in zip(self._params, self._master_params):
+            changed = master.to(dtype=p.dtype) != p.detach()
+            master.copy_(torch.where(changed, p.detach().to(master.dtype),
+                                     master))
 
     def _add_grad(self, step_size, update):
         offset = 0
-        for p in self._params:
+        params = self._master_params or self._params
+        for p in params:
             numel = p.numel()
             # view as to avoid deprecated pointwise semantics
             p.data.add_(step_size, update[offset:offset + numel].view_as(p.data))
             offset += numel
         assert offset == self._numel()
+        if self._master_params is not None:
+            self._set_param(self._master_params)
 
     def _clone_param(self):
-        return [p.clone() for p in self._params]
+        return [p.clone() for p in self._master_params or self._params]
 
     def _set_param(self, params_data):
+        if self._master_params is not None:
+            for master, pdata in zip(self._master_params, params_data):
+                if master is not pdata:
+                    master.copy_(pdata)
         for p, pdata in zip(self._params, params_data):
             p.data.copy_(pdata)
 
@@ -253,6 +288,21 @@ class LBFGS(Optimizer):
         self._set_param(x)
         return loss, flat_grad
 
+    def reset_objective(self):
+        """Prepares the optimizer for a new objective of the same parameters.
+
+        The update history of the previous objective is kept as the initial
+        approximation of the inverse Hessian, so the next step does not start
+        with a steepest descent step. Only the pair that would combine the
+        gradients of the two objectives is not stored. Without any history
+        the optimizer starts over.
+        """
+        state = self.state[self._params[0]]
+        if len(state.get('old_dirs') or []) < 1:
+            self.state.pop(self._params[0], None)
+            return
+        state['skip_update'] = True
+
     def step(self, closure):
         """Performs a single optimization step.
         Arguments:
@@ -275,6 +325,7 @@ class LBFGS(Optimizer):
         state = self.state[self._params[0]]
         state.setdefault('func_evals', 0)
         state.setdefault('n_iter', 0)
+        self._sync_master_params()
 
         # evaluate initial f(x) and df/dx
         orig_loss = closure()
@@ -320,7 +371,10 @@ class LBFGS(Optimizer):
                 y = flat_grad.sub(prev_flat_grad)
                 s = d.mul(t)
                 ys = y.dot(s)  # y*s
-                if ys > 1e-10:
+                # The first pair after a change of the objective mixes the
+                # gradients of two different functions
+                skip_update = state.pop('skip_update', False)
+                if ys > 1e-10 and not skip_update:
                     # updating memory
                     if len(old_dirs) == history_size:
                         # shift history by one (limited-memory)
@@ -0,0 +1,680 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems and the Max Planck Institute for Biological
+# Cybernetics. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+# Batched version of the L-BFGS with Strong Wolfe line search in lbfgs_ls.py.
+# Every sample of the batch is an independent problem with its own history,
+# step length and line search.
+
+import torch
+from functools import reduce
+
+from torch.optim import Optimizer
+
+# The phases of the line search of every sample
+_BRACKET, _ZOOM, _DONE = 0, 1, 2
+
+
+def _cubic_interpolate(x1, f1, g1, x2, f2, g2, bounds=None):
+    # Element-wise version of _cubic_interpolate in lbfgs_ls.py
+    if bounds is not None:
+        xmin_bound, xmax_bound = bounds
+    else:
+        xmin_bound = torch.min(x1, x2)
+        xmax_bound = torch.max(x1, x2)
+
+    d1 = g1 + g2 - 3 * (f1 - f2) / (x1 - x2)
+    d2_square = d1 ** 2 - g1 * g2
+    d2 = d2_square.clamp(min=0).sqrt()
+    min_pos = torch.where(
+        x1 <= x2,
+        x2 - (x2 - x1) * ((g2 + d2 - d1) / (g2 - g1 + 2 * d2)),
+        x1 - (x1 - x2) * ((g1 + d2 - d1) / (g1 - g2 + 2 * d2)))
+    min_pos = torch.min(torch.max(min_pos, xmin_bound), xmax_bound)
+
+    mid_point = (xmin_bound + xmax_bound) / 2.
+    valid = (d2_square >= 0) & torch.isfinite(min_pos)
+    return torch.where(valid, min_pos, mid_point)
+
+
+def _strong_Wolfe(obj_func, x, t, d, f, g, gtd, active, c1=1e-4, c2=0.9,
+                  tolerance_change=1e-9, max_iter=20, max_ls=25):
+    ''' Strong Wolfe line search run independently for every sample
+
+        All the samples are evaluated together with a single call of
+        `obj_func`, each one at its own trial step. The bracketing and zoom
+        phases of lbfgs_ls._strong_Wolfe are tracked per sample with masks.
+
+        Parameters
+        ----------
+            t: torch.tensor, B
+                The initial step length of every sample
+            d: torch.tensor, BxN
+                The search directions
+            f: torch.tensor, B
+                The loss values at step 0
+            g: torch.tensor, BxN
+                The gradients at step 0
+            gtd: torch.tensor, B
+                The directional derivatives at step 0
+            active: torch.tensor, B
+                Boolean mask of the samples that perform a line search
+        Returns
+        -------
+            The loss, gradient and step length selected for every sample,
+            the number of function evaluations and the number of them that
+            every sample took part in
+    '''
+    d_norm = d.abs().max(dim=1)[0]
+    g = g.clone()
+    # evaluate objective and gradient using initial step
+    f_new, g_new = obj_func(x, t, d)
+    ls_func_evals = 1
+    gtd_new = (g_new * d).sum(dim=1)
+
+    t_prev = torch.zeros_like(t)
+    f_prev, g_prev, gtd_prev = f.clone(), g.clone(), gtd.clone()
+
+    ls_iter = torch.zeros_like(t, dtype=torch.long)
+    phase = torch.where(active, torch.full_like(ls_iter, _BRACKET),
+                        torch.full_like(ls_iter, _DONE))
+    insuf_progress = torch.zeros_like(active)
+    # Samples whose last evaluation was a trial point of the zoom phase
+    zoom_eval = torch.zeros_like(active)
+
+    # The low (lowest loss) and high end of the bracket of every sample
+    lo_t, lo_f, lo_g, lo_gtd = (t.clone(), f_new.clone(), g_new.clone(),
+                                gtd_new.clone())
+    hi_t, hi_f, hi_g, hi_gtd = (t.clone(), f_new.clone(), g_new.clone(),
+                                gtd_new.clone())
+
+    def assign(mask, t_val, f_val, g_val, gtd_val, dst):
+        dst_t, dst_f, dst_g, dst_gtd = dst
+        return (torch.where(mask, t_val, dst_t),
+                torch.where(mask, f_val, dst_f),
+                torch.where(mask.unsqueeze(dim=1), g_val, dst_g),
+                torch.where(mask, gtd_val, dst_gtd))
+
+    while True:
+        ############################################################
+        # zoom phase: refine the bracket with the last trial point
+        ############################################################
+        if zoom_eval.any():
+            armijo_fail = zoom_eval & (
+                (f_new > (f + c1 * t * gtd)) | (f_new >= lo_f))
+            # Armijo condition not satisfied or not lower than lowest point
+            hi_t, hi_f, hi_g, hi_gtd = assign(
+                armijo_fail, t, f_new, g_new, gtd_new,
+                (hi_t, hi_f, hi_g, hi_gtd))
+            swap = armijo_fail & (hi_f < lo_f)
+            lo_t, lo_f, lo_g, lo_gtd, hi_t, hi_f, hi_g, hi_gtd = (
+                *assign(swap, hi_t, hi_f, hi_g, hi_gtd,
+                        (lo_t, lo_f, lo_g, lo_gtd)),
+                *assign(swap, lo_t, lo_f, lo_g, lo_gtd,
+                        (hi_t, hi_f, hi_g, hi_gtd)))
+
+            accepted = zoom_eval & ~armijo_fail
+            # Wolfe conditions satisfied
+            wolfe = accepted & (gtd_new.abs() <= -c2 * gtd)
+            # old high becomes new low
+            move_high = accepted & ~wolfe & (
+                gtd_new * (hi_t - lo_t) >= 0)
+            hi_t, hi_f, hi_g, hi_gtd = assign(
+                move_high, lo_t, lo_f, lo_g, lo_gtd,
+                (hi_t, hi_f, hi_g, hi_gtd))
+            # new point becomes new low
+            lo_t, lo_f, lo_g, lo_gtd = assign(
+                accepted, t, f_new, g_new, gtd_new,
+                (lo_t, lo_f, lo_g, lo_gtd))
+
+            # line-search bracket is so small
+            too_small = zoom_eval & (
+                (hi_t - lo_t).abs() * d_norm < tolerance_change)
+            phase = torch.where(wolfe | too_small,
+                                torch.full_like(phase, _DONE), phase)
+
+        ############################################################
+        # bracketing phase
+        ############################################################
+        extrapolate = torch.zeros_like(active)
+        in_bracket = phase == _BRACKET
+        if in_bracket.any():
+            # reached max number of iterations?
+            out_of_iters = in_bracket & (ls_iter >= max_ls)
+            checked = in_bracket & ~out_of_iters
+
+            armijo_fail = (f_new > (f + c1 * t * gtd)) | (
+                (ls_iter > 1) & (f_new >= f_prev))
+            wolfe = ~armijo_fail & (gtd_new.abs() <= -c2 * gtd)
+            positive_slope = ~armijo_fail & ~wolfe & (gtd_new >= 0)
+
+            found = checked & wolfe
+            to_zoom = (checked & (armijo_fail | positive_slope)) | \
+                out_of_iters
+
+            # The first end of the new bracket is the previous trial point,
+            # or step 0 for the samples that ran out of iterations
+            first_t, first_f, first_g, first_gtd = assign(
+                out_of_iters, torch.zeros_like(t), f, g, gtd,
+                (t_prev, f_prev, g_prev, gtd_prev))
+            first_low = first_f <= f_new
+
+            new_lo = to_zoom & first_low
+            new_hi = to_zoom & ~first_low
+            lo_t, lo_f, lo_g, lo_gtd = assign(
+                new_lo, first_t, first_f, first_g, first_gtd,
+                (lo_t, lo_f, lo_g, lo_gtd))
+            lo_t, lo_f, lo_g, lo_gtd = assign(
+                new_hi | found, t, f_new, g_new, gtd_new,
+                (lo_t, lo_f, lo_g, lo_gtd))
+            hi_t, hi_f, hi_g, hi_gtd = assign(
+                new_lo, t, f_new, g_new, gtd_new,
+                (hi_t, hi_f, hi_g, hi_gtd))
+            hi_t, hi_f, hi_g, hi_gtd = assign(
+                new_hi, first_t, first_f, first_g, first_gtd,
+                (hi_t, hi_f, hi_g, hi_gtd))
+
+            phase = torch.where(to_zoom, torch.full_like(phase, _ZOOM),
+                                phase)
+            phase = torch.where(found, torch.full_like(phase, _DONE), phase)
+            extrapolate = in_bracket & ~to_zoom & ~found
+
+        # interpolate
+        t_trial = torch.zeros_like(t)
+        if extrapolate.any():
+            min_step = t + 0.01 * (t - t_prev)
+            max_step = t * 10
+            t_extr = _cubic_interpolate(t_prev, f_prev, gtd_prev,
+                                        t, f_new, gtd_new,
+                                        bounds=(min_step, max_step))
+            t_trial = torch.where(extrapolate, t_extr, t_trial)
+
+            t_prev, f_prev, g_prev, gtd_prev = assign(
+                extrapolate, t, f_new, g_new, gtd_new,
+                (t_prev, f_prev, g_prev, gtd_prev))
+
+        ############################################################
+        # compute the new trial values of the zoom phase
+        ############################################################
+        in_zoom = phase == _ZOOM
+        phase = torch.where(in_zoom & (ls_iter >= max_iter),
+                            torch.full_like(phase, _DONE), phase)
+        zoom_eval = phase == _ZOOM
+        if zoom_eval.any():
+            t_zoom = _cubic_interpolate(lo_t, lo_f, lo_gtd,
+                                        hi_t, hi_f, hi_gtd)
+
+            # test what we are making sufficient progress
+            b_max = torch.max(lo_t, hi_t)
+            b_min = torch.min(lo_t, hi_t)
+            eps = 0.1 * (b_max - b_min)
+            close = torch.min(b_max - t_zoom, t_zoom - b_min) < eps
+            at_boundary = insuf_progress | (t_zoom >= b_max) | (
+                t_zoom <= b_min)
+            # evaluate at 0.1 away from boundary
+            t_zoom = torch.where(
+                close & at_boundary,
+                torch.where((t_zoom - b_max).abs() < (t_zoom - b_min).abs(),
+                            b_max - eps, b_min + eps),
+                t_zoom)
+            insuf_progress = torch.where(zoom_eval, close & ~at_boundary,
+                                         insuf_progress)
+            t_trial = torch.where(zoom_eval, t_zoom, t_trial)
+
+        evaluate = extrapolate | zoom_eval
+        if not evaluate.any():
+            break
+
+        # Evaluate new point
+        t = torch.where(evaluate, t_trial, t)
+        f_new, g_new = obj_func(x, torch.where(evaluate, t, 0 * t), d)
+        ls_func_evals += 1
+        gtd_new = (g_new * d).sum(dim=1)
+        ls_iter = ls_iter + evaluate.long()
+
+    return lo_f, lo_g, lo_t, ls_func_evals, ls_iter + 1
+
+
+class BatchLBFGS(Optimizer):
+    """Implements a batched L-BFGS algorithm with strong Wolfe line search.
+
+    The first dimension of every parameter is the batch dimension and each
+    sample is optimized as an independent problem: the update history, the
+    step length and the line search are kept per sample, and samples that
+    have converged stop while the rest of the batch continues. The closure
+    must return the loss of every sample as a tensor of size B, with the
+    gradients of their sum.
+
+    .. warning::
+        This optimizer doesn't support per-parameter options and parameter
+        groups (there can be only one).
+    Arguments:
+        lr (float): learning rate (default: 1)
+        max_iter (int): maximal number of iterations per optimization step
+            (default: 20)
+        max_eval (int): maximal number of function evaluations per optimization
+            step (default: max_iter * 1.25).
+        tolerance_grad (float): termination tolerance on first order optimality
+            (default: 1e-5).
+        tolerance_change (float): termination tolerance on function
+            value/parameter changes (default: 1e-9).
+        history_size (int): update history size (default: 100).
+        line_search_fn (str): either 'strong_Wolfe' or None (default: None).
+        state_dtype (torch.dtype): the data type of the history, of the line
+            search and of a copy of the parameters that the steps are
+            applied to, when it differs from the one of the parameters
+            (default: None).
+    """
+
+    # The closure must return a loss value per sample
+    batched = True
+
+    def __init__(self, params, lr=1, max_iter=20, max_eval=None,
+                 tolerance_grad=1e-5, tolerance_change=1e-9, history_size=100,
+                 line_search_fn=None, state_dtype=None):
+        if max_eval is None:
+            max_eval = max_iter * 5 // 4
+        defaults = dict(lr=lr, max_iter=max_iter, max_eval=max_eval,
+                        tolerance_grad=tolerance_grad, tolerance_change=tolerance_change,
+                        history_size=history_size, line_search_fn=line_search_fn)
+        super(BatchLBFGS, self).__init__(params, defaults)
+
+        if len(self.param_groups) != 1:
+            raise ValueError("BatchLBFGS doesn't support per-parameter "
+                             "options (parameter groups)")
+
+        self._params = self.param_groups[0]['params']
+        self._batch_size = self._params[0].shape[0]
+        for p in self._params:
+            if p.shape[0] != self._batch_size:
+                raise ValueError('All parameters must have the same batch'
+                                 ' size, expected {} but got {}'.format(
+                                     self._batch_size, p.shape[0]))
+        self._numel_cache = None
+        self._state_dtype = state_dtype
+        self._master_params = None
+
+    def _numel(self):
+        if self._numel_cache is None:
+            self._numel_cache = reduce(
+                lambda total, p: total + p[0].numel(), self._params, 0)
+        return self._numel_cache
+
+    def _gather_flat_grad(self):
+        views = []
+        for p in self._params:
+            if p.grad is None:
+                view = p.new_zeros([self._batch_size, p[0].numel()])
+            else:
+                view = p.grad.view(self._batch_size, -1)
+            views.append(view)
+        flat_grad = torch.cat(views, 1)
+        if self._master_params is not None:
+            flat_grad = flat_grad.to(dtype=self._state_dtype)
+        return flat_grad
+
+    def _sync_master_params(self):
+        """Updates the copies of the parameters in the state data type.
+
+        Only the values that were changed outside of the optimizer, e.g.
+        the samples that were reset after they stopped, are copied again.
+        """
+        if self._state_dtype is None or all(
+                p.dtype == self._state_dtype for p in self._params):
+            self._master_params = None
+            return
+        if self._master_params is None:
+            self._master_params = [p.detach().to(dtype=self._state_dtype)
+                                   for p in self._params]
+            return
+        for p, master in zip(self._params, self._master_params):
+            changed = master.to(dtype=p.dtype) != p.detach()
+            master.copy_(torch.where(changed, p.detach().to(master.dtype),
+                                     master))
+
+    def _add_grad(self, step_size, update):
+        offset = 0
+        params = self._master_params or self._params
+        for p in params:
+            numel = p[0].numel()
+            p.data.add_((step_size.unsqueeze(dim=1) *
+                         update[:, offset:offset + numel]).view_as(p.data))
+            offset += numel
+        assert offset == self._numel()
+        if self._master_params is not None:
+            self._set_param(self._master_params)
+
+    def _clone_param(self):
+        return [p.clone() for p in self._master_params or self._params]
+
+    def _set_param(self, params_data):
+        if self._master_params is not None:
+            for master, pdata in zip(self._master_params, params_data):
+                if master is not pdata:
+                    master.copy_(pdata)
+        for p, pdata in zip(self._params, params_data):
+            p.data.copy_(pdata)
+
+    def _directional_evaluate(self, closure, x, t, d):
+        self._add_grad(t, d)
+        loss = closure().detach()
+        if self._master_params is not None:
+            loss = loss.to(dtype=self._state_dtype)
+        flat_grad = self._gather_flat_grad()
+        self._set_param(x)
+        return loss, flat_grad
+
+    def reset_objective(self):
+        """Prepares the optimizer for a new objective of the same parameters.
+
+        The update history of the previous objective is kept as the initial
+        approximation of the inverse Hessian, so the next step does not start
+        with a steepest descent step. Only the pair that would combine the
+        gradients of the two objectives is not stored. Samples without any
+        history start over.
+        """
+        state = self.state[self._params[0]]
+        if 'old_dirs' not in state:
+            return
+        has_history = state['hist_len'] > 0
+        state['skip_update'].copy_(has_history)
+        state['sample_iter'][~has_history] = 0
+
+    def index_batch(self, params, index):
+        """Replaces the parameters with a selection of their samples.
+
+        Arguments:
+            params (iterable): the new parameters, whose samples are the
+                samples of the current parameters at ``index``
+            index (torch.Tensor): the indices of the samples that are kept,
+                whose state is carried over to the new parameters
+        """
+        params = list(params)
+        state = self.state.pop(self._params[0], {})
+        index = torch.as_tensor(index, dtype=torch.long,
+                                device=params[0].device)
+
+        self.param_groups[0]['params'] = params
+        self._params = params
+        self._batch_size = len(index)
+        self._numel_cache = None
+        for p in self._params:
+            if p.shape[0] != self._batch_size:
+                raise ValueError('All parameters must have the same batch'
+                                 ' size, expected {} but got {}'.format(
+                                     self._batch_size, p.shape[0]))
+
+        # The counters are shared by the batch, the rest of the state has a
+        # row per sample
+        self.state[self._params[0]] = {
+            key: (val[index] if torch.is_tensor(val) and val.dim() > 0
+                  else val)
+            for key, val in state.items()}
+        if self._master_params is not None:
+            self._master_params = [master[index]
+                                   for master in self._master_params]
+
+    def step(self, closure):
+        """Performs a single optimization step.
+        Arguments:
+            closure (callable): A closure that reevaluates the model
+                and returns the loss of every sample.
+        """
+        assert len(self.param_groups) == 1
+
+        group = self.param_groups[0]
+        lr = group['lr']
+        max_iter = group['max_iter']
+        max_eval = group['max_eval']
+        tolerance_grad = group['tolerance_grad']
+        tolerance_change = group['tolerance_change']
+        line_search_fn = group['line_search_fn']
+        history_size = group['history_size']
+
+        # NOTE: LBFGS has only global state, but we register it as state for
+        # the first param, because this helps with casting in load_state_dict
+        state = self.state[self._params[0]]
+        state.setdefault('func_evals', 0)
+        state.setdefault('n_iter', 0)
+        self._sync_master_params()
+
+        # evaluate initial f(x) and df/dx
+        orig_loss = closure()
+        loss = orig_loss.detach().clone()
+        if self._master_params is not None:
+            loss = loss.to(dtype=self._state_dtype)
+        state['func_evals'] += 1
+
+        flat_grad = self._gather_flat_grad()
+        # The samples that are still optimized in this step
+        running = flat_grad.abs().max(dim=1)[0] > tolerance_grad
+
+        # optimal condition
+        if not running.any():
+            return orig_loss
+
+        batch_size, numel = flat_grad.shape
+        batch_idxs = torch.arange(batch_size, device=flat_grad.device)
+        # The evaluations of every sample, which stops once it reaches
+        # max_eval regardless of the line searches of the other samples
+        current_evals = torch.ones_like(batch_idxs)
+
+        if 'old_dirs' not in state:
+            # The history of every sample is a ring buffer. hist_head points
+            # to the slot that will be written next.
+            state['old_dirs'] = flat_grad.new_zeros(
+                [batch_size, history_size, numel])
+            state['old_stps'] = flat_grad.new_zeros(
+                [batch_size, history_size, numel])
+            state['ro'] = flat_grad.new_zeros([batch_size, history_size])
+            state['hist_head'] = torch.zeros_like(batch_idxs)
+            state['hist_len'] = torch.zeros_like(batch_idxs)
+            state['H_diag'] = flat_grad.new_ones([batch_size])
+            state['sample_iter'] = torch.zeros_like(batch_idxs)
+            state['d'] = torch.zeros_like(flat_grad)
+            state['t'] = flat_grad.new_zeros([batch_size])
+            state['prev_flat_grad'] = torch.zeros_like(flat_grad)
+            state['prev_loss'] = torch.zeros_like(loss)
+            state['skip_update'] = torch.zeros_like(running)
+
+        # tensors cached in state (for tracing)
+        d = state['d']
+        t = state['t']
+        old_dirs = state['old_dirs']
+        old_stps = state['old_stps']
+        ro = state['ro']
+        hist_head = state['hist_head']
+        hist_len = state['hist_len']
+        H_diag = state['H_diag']
+        sample_iter = state['sample_iter']
+        prev_flat_grad = state['prev_flat_grad']
+        prev_loss = state['prev_loss']
+        skip_update = state['skip_update']
+
+        n_iter = 0
+        # optimize for a max of max_iter iterations
+        while n_iter < max_iter:
+            # keep track of nb of iterations
+            n_iter += 1
+            state['n_iter'] += 1
+            sample_iter += running.long()
+
+            ############################################################
+            # compute gradient descent direction
+            ############################################################
+            first_iter = running & (sample_iter == 1)
+            update = running & ~first_iter
+            direction = torch.where(first_iter.unsqueeze(dim=1),
+                                    flat_grad.neg(),
+                                    torch.zeros_like(flat_grad))
+            if update.any():
+                # do lbfgs update (update memory)
+                y = flat_grad.sub(prev_flat_grad)
+                s = d.mul(t.unsqueeze(dim=1))
+                ys = (y * s).sum(dim=1)  # y*s
+                # The first pair after a change of the objective mixes the
+                # gradients of two different functions
+                store = update & (ys > 1e-10) & ~skip_update
+                skip_update &= ~update
+                if store.any():
+                    # store new direction/step, replacing the oldest one when
+                    # the history is full
+                    idxs = batch_idxs[store]
+                    slots = hist_head[store]
+                    old_dirs[idxs, slots] = y[store]
+                    old_stps[idxs, slots] = s[store]
+                    ro[idxs, slots] = 1. / ys[store]
+                    hist_head[store] = (slots + 1) % history_size
+                    hist_len[store] = torch.clamp(hist_len[store] + 1,
+                                                  max=history_size)
+
+                    # update scale of initial Hessian approximation
+                    H_diag[store] = ys[store] / (y[store] * y[store]).sum(
+                        dim=1)  # (y*y)
+
+                # compute the approximate (L-BFGS) inverse Hessian
+                # multiplied by the gradient
+                num_old = int(hist_len[update].max())
+                al = flat_grad.new_zeros([batch_size, max(num_old, 1)])
+
+                # iteration in L-BFGS loop collapsed to use just one buffer
+                q = flat_grad.neg()
+                for i in range(num_old):
+                    # newest to oldest entry of every sample
+                    slots = (hist_head - 1 - i) % history_size
+                    valid = update & (i < hist_len)
+                    al[:, i] = torch.where(
+                        valid,
+                        (old_stps[batch_idxs, slots] * q).sum(dim=1) *
+                        ro[batch_idxs, slots],
+                        torch.zeros_like(H_diag))
+                    q.sub_(al[:, i].unsqueeze(dim=1) *
+                           old_dirs[batch_idxs, slots])
+
+                # multiply by initial Hessian
+                # r is the final direction
+                r = torch.mul(q, H_diag.unsqueeze(dim=1))
+                for i in range(num_old - 1, -1, -1):
+                    slots = (hist_head - 1 - i) % history_size
+                    valid = update & (i < hist_len)
+                    be_i = (old_dirs[batch_idxs, slots] * r).sum(dim=1) * \
+                        ro[batch_idxs, slots]
+                    coeff = torch.where(valid, al[:, i] - be_i,
+                                        torch.zeros_like(be_i))
+                    r.add_(coeff.unsqueeze(dim=1) *
+                           old_stps[batch_idxs, slots])
+
+                direction = torch.where(update.unsqueeze(dim=1), r,
+                                        direction)
+
+            # Only the samples that are still running update their state
+            d = torch.where(running.unsqueeze(dim=1), direction, d)
+            prev_flat_grad = torch.where(running.unsqueeze(dim=1),
+                                         flat_grad, prev_flat_grad)
+            prev_loss = torch.where(running, loss, prev_loss)
+
+            ############################################################
+            # compute step length
+            ############################################################
+            # reset initial guess for step size
+            t_init = torch.where(
+                first_iter,
+                torch.clamp(1. / flat_grad.abs().sum(dim=1), max=1.) * lr,
+                torch.full_like(t, lr))
+            t = torch.where(running, t_init, t)
+
+            # directional derivative
+            gtd = (flat_grad * d).sum(dim=1)  # g * d
+
+            # directional derivative is below tolerance
+            running = running & ~(gtd > -tolerance_change)
+            if not running.any():
+                break
+            step_size = torch.where(running, t, torch.zeros_like(t))
+
+            # optional line search: user function
+            ls_func_evals = 0
+            sample_evals = torch.zeros_like(current_evals)
+            if line_search_fn is not None:
+                # perform line search, using user function
+                if line_search_fn != "strong_Wolfe":
+                    raise RuntimeError("only 'strong_Wolfe' is supported")
+                else:
+                    x_init = self._clone_param()
+
+                    def obj_func(x, t, d):
+                        return self._directional_evaluate(closure, x, t, d)
+                    (ls_loss, ls_grad, ls_t, ls_func_evals,
+                     sample_evals) = _strong_Wolfe(
+                        obj_func, x_init, step_size, d, loss, flat_grad, gtd,
+                        running, tolerance_change=tolerance_change,
+                        max_iter=max_iter)
+                loss = torch.where(running, ls_loss, loss)
+                flat_grad = torch.where(running.unsqueeze(dim=1), ls_grad,
+                                        flat_grad)
+                t = torch.where(running, ls_t, t)
+                step_size = torch.where(running, t, torch.zeros_like(t))
+                self._add_grad(step_size, d)
+                opt_cond = flat_grad.abs().max(dim=1)[0] <= tolerance_grad
+            else:
+                # no line search, simply move with fixed-step
+                self._add_grad(step_size, d)
+                if n_iter != max_iter:
+                    # re-evaluate function only if not in last iteration
+                    # the reason we do this: in a stochastic setting,
+                    # no use to re-evaluate that function here
+                    loss = closure().detach()
+                    if self._master_params is not None:
+                        loss = loss.to(dtype=self._state_dtype)
+                    flat_grad = self._gather_flat_grad()
+                    opt_cond = flat_grad.abs().max(dim=1)[0] <= tolerance_grad
+                    ls_func_evals = 1
+                    sample_evals = torch.ones_like(current_evals)
+                else:
+                    opt_cond = torch.zeros_like(running)
+
+            # update func eval
+            current_evals += torch.where(running, sample_evals,
+                                         torch.zeros_like(sample_evals))
+            state['func_evals'] += ls_func_evals
+
+            ############################################################
+            # check conditions
+            ############################################################
+            if n_iter == max_iter:
+                break
+
+            running = running & (current_evals < max_eval)
+
+            # optimal condition
+            running = running & ~opt_cond
+
+            # lack of progress
+            running = running & ~(
+                d.mul(step_size.unsqueeze(dim=1)).abs().max(dim=1)[0] <=
+                tolerance_change)
+            running = running & ~(
+                (loss - prev_loss).abs() < tolerance_change)
+
+            if not running.any():
+                break
+
+        state['d'] = d
+        state['t'] = t
+        state['H_diag'] = H_diag
+        state['prev_flat_grad'] = prev_flat_grad
+        state['prev_loss'] = prev_loss
+
+        return orig_loss
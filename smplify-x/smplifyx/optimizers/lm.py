@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems and the Max Planck Institute for Biological
+# Cybernetics. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+# Levenberg-Marquardt solver for objectives that are sums of squares.
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+from functools import reduce
+
+import torch
+from torch.optim.optimizer import Optimizer
+
+import utils
+
+
+class LevenbergMarquardt(Optimizer):
+    """Implements the Levenberg-Marquardt algorithm.
+
+    The closure must return the vector of residuals r(x), whose squared sum
+    is the loss, with the graph to the parameters. The Jacobian of the
+    residuals is computed with a batched backward pass and every iteration
+    solves the damped normal equations
+
+        (J^T J + lambda * diag(J^T J)) dx = -J^T r
+
+    directly. Steps that do not decrease the loss are rejected and increase
+    the damping, successful steps decrease it.
+
+    When ``batched`` is True the first dimension of every parameter and of
+    the residuals is the batch dimension. Every sample is then an
+    independent problem with its own normal equations and damping, and
+    samples that have converged stop while the rest of the batch continues.
+    Otherwise all the parameters form a single problem.
+
+    .. warning::
+        This optimizer doesn't support per-parameter options and parameter
+        groups (there can be only one).
+    Arguments:
+        max_iter (int): maximal number of iterations per optimization step
+            (default: 20)
+        damping (float): initial damping factor lambda (default: 1e-3)
+        damping_factor (float): factor by which the damping is multiplied
+            after a rejected step and divided after an accepted one
+            (default: 10)
+        tolerance_grad (float): termination tolerance on first order optimality
+            (default: 1e-5).
+        tolerance_change (float): termination tolerance on the relative
+            change of the loss (default: 1e-9).
+        batched (bool): whether the samples of the batch are independent
+            problems (default: False)
+    """
+
+    # The closure must return the residuals instead of the loss
+    residuals = True
+
+    def __init__(self, params, max_iter=20, damping=1e-3, damping_factor=10.,
+                 tolerance_grad=1e-5, tolerance_change=1e-9, batched=False):
+        defaults = dict(max_iter=max_iter, damping=damping,
+                        damping_factor=damping_factor,
+                        tolerance_grad=tolerance_grad,
+                        tolerance_change=tolerance_change)
+        super(LevenbergMarquardt, self).__init__(params, defaults)
+
+        if len(self.param_groups) != 1:
+            raise ValueError("LevenbergMarquardt doesn't support "
+                             "per-parameter options (parameter groups)")
+
+        self._params = self.param_groups[0]['params']
+        self.batched = batched
+        self._batch_size = self._params[0].shape[0] if batched else 1
+        for p in self._params:
+            if batched and p.shape[0] != self._batch_size:
+                raise ValueError('All parameters must have the same batch'
+                                 ' size, expected {} but got {}'.format(
+                                     self._batch_size, p.shape[0]))
+
+    def _numel(self):
+        return reduce(lambda total, p: total + p.numel(), self._params,
+                      0) // self._batch_size
+
+    def _flat_residuals(self, residuals):
+        return residuals.reshape(self._batch_size, -1)
+
+    def _add_step(self, step):
+        offset = 0
+        for p in self._params:
+            numel = p.numel() // self._batch_size
+            p.data.add_(step[:, offset:offset + numel].view_as(p.data))
+            offset += numel
+
+    def _flat_params(self):
+        return torch.cat([p.data.reshape(self._batch_size, -1)
+                          for p in self._params], dim=1)
+
+    def _restore_params(self, flat_params, mask):
+        ''' Sets the parameters of the samples in the mask to flat_params '''
+        offset = 0
+        for p in self._params:
+            numel = p.numel() // self._batch_size
+            p.data.copy_(torch.where(
+                mask.unsqueeze(dim=1),
+                flat_params[:, offset:offset + numel],
+                p.data.reshape(self._batch_size, -1)).view_as(p.data))
+            offset += numel
+
+    def _set_grad(self, flat_grad):
+        ''' Stores the gradient of the loss, for the convergence checks '''
+        offset = 0
+        for p in self._params:
+            numel = p.numel() // self._batch_size
+            p.grad = flat_grad[:, offset:offset + numel].reshape_as(
+                p).clone()
+            offset += numel
+
+    def _jacobian(self, residuals):
+        ''' Returns the Jacobian of the residuals, of size BxMxP
+
+            The rows of all the samples are computed together: the m-th
+            backward pass propagates the m-th residual of every sample, which
+            only depends on the parameters of its own sample.
+        '''
+        batch_size, num_residuals = residuals.shape
+        grad_outputs = torch.eye(
+            num_residuals, dtype=residuals.dtype,
+            device=residuals.device).unsqueeze(dim=1).expand(
+                num_residuals, batch_size, num_residuals)
+        params = [p for p in self._params if p.requires_grad]
+        try:
+            grads = torch.autograd.grad(
+                residuals, params,
+                grad_outputs=grad_outputs.reshape(
+                    (num_residuals,) + residuals.shape),
+                is_grads_batched=True, retain_graph=True, allow_unused=True)
+        except (TypeError, RuntimeError):
+            # Older versions of PyTorch and some operators do not support
+            # batched gradients, so the rows are computed one by one
+            rows = [torch.autograd.grad(residuals, params,
+                                        grad_outputs=grad_output,
+                                        retain_graph=True, allow_unused=True)
+                    for grad_output in grad_outputs]
+            grads = [None if row[0] is None else torch.stack(row)
+                     for row in zip(*rows)]
+
+        grads = dict(zip([id(p) for p in params], grads))
+        jac = []
+        for p in self._params:
+            grad = grads.get(id(p))
+            if grad is None:
+                grad = residuals.new_zeros((num_residuals,) + p.shape)
+            jac.append(grad.reshape(num_residuals, batch_size, -1))
+        return torch.cat(jac, dim=2).permute(1, 0, 2)
+
+    def step(self, closure):
+        """Performs a single optimization step.
+        Arguments:
+            closure (callable): A closure that reevaluates the model
+                and returns the residuals.
+        """
+        assert len(self.param_groups) == 1
+
+        group = self.param_groups[0]
+        max_iter = group['max_iter']
+        damping_factor = group['damping_factor']
+        tolerance_grad = group['tolerance_grad']
+        tolerance_change = group['tolerance_change']
+
+        state = self.state[self._params[0]]
+        state.setdefault('func_evals', 0)
+        state.setdefault('n_iter', 0)
+        if 'damping' not in state:
+            state['damping'] = torch.full(
+                [self._batch_size], group['damping'],
+                dtype=self._params[0].dtype, device=self._params[0].device)
+        damping = state['damping']
+
+        orig_loss = None
+        running = None
+        residuals, jac = None, None
+        for n_iter in range(max_iter):
+            # The residuals and the Jacobian are only evaluated again if
+            # some sample has moved
+            if residuals is None:
+                with torch.enable_grad():
+                    curr_residuals = self._flat_residuals(closure())
+                state['func_evals'] += 1
+                jac = self._jacobian(curr_residuals)
+                residuals = curr_residuals.detach()
+                loss = residuals.pow(2).sum(dim=1)
+                flat_grad = torch.einsum('bmp,bm->bp', [jac, residuals])
+                self._set_grad(2 * flat_grad)
+
+            if orig_loss is None:
+                orig_loss = loss.clone()
+                running = flat_grad.abs().max(dim=1)[0] > tolerance_grad
+                if not running.any():
+                    break
+            state['n_iter'] += 1
+
+            # Solve the damped normal equations of every sample
+            jtj = torch.matmul(jac.transpose(1, 2), jac)
+            jtj_diag = torch.diagonal(jtj, dim1=1, dim2=2)
+            # The small constant keeps the system positive definite for
+            # parameters that do not affect the residuals
+            damped = jtj + torch.diag_embed(
+                damping.unsqueeze(dim=1) * jtj_diag + 1e-9)
+            try:
+                chol = torch.linalg.cholesky(damped)
+                step = torch.cholesky_solve(-flat_grad.unsqueeze(dim=-1),
+                                            chol).squeeze(dim=-1)
+            except RuntimeError:
+                step = torch.linalg.lstsq(
+                    damped, -flat_grad.unsqueeze(dim=-1)).solution.squeeze(
+                        dim=-1)
+            step = torch.where(running.unsqueeze(dim=1), step,
+                               torch.zeros_like(step))
+
+            prev_params = self._flat_params()
+            self._add_step(step)
+            with torch.no_grad():
+                new_loss = self._flat_residuals(closure()).pow(2).sum(dim=1)
+            state['func_evals'] += 1
+
+            accept = running & (new_loss < loss)
+            # Rejected steps are undone exactly, subtracting them again
+            # would not round back to the same values
+            self._restore_params(prev_params, ~accept)
+            damping.copy_(torch.where(
+                accept, damping / damping_factor,
+                torch.where(running, damping * damping_factor, damping)))
+
+            # The same relative change as the convergence checks of the
+            # fitting monitor
+            rel_change = utils.batch_rel_change(loss, new_loss)
+            running = running & ~(accept & (rel_change <= tolerance_change))
+            # A sample that can no longer find a decrease has converged
+            running = running & (damping < 1e10)
+            if not running.any():
+                break
+            if accept.any():
+                residuals = None
+
+        if self.batched:
+            return orig_loss
+        return orig_loss.sum()
@@ -22,6 +22,8 @@ from __future__ import division
 
 import torch.optim as optim
 from .lbfgs_ls import LBFGS as LBFGSLs
+from .lbfgs_ls_batch import BatchLBFGS
+from .lm import LevenbergMarquardt
 
 
 def create_optimizer(parameters, optim_type='lbfgs',
@@ -38,8 +40,22 @@ def create_optimizer(parameters, optim_type='lbfgs',
                      maxiters=20,
                      gtol=1e-6,
                      ftol=1e-9,
+                     batch_size=1,
+                     optim_dtype=None,
                      **kwargs):
     ''' Creates the optimizer
+
+        For batches of independent samples 'lbfgsls' is replaced by its
+        batched variant, which keeps a separate history and line search for
+        every sample.
+
+        'lm' is a Levenberg-Marquardt solver, whose closure returns the
+        residuals of the loss instead of its value. The samples of a batch
+        are solved as independent problems.
+
+        If `optim_dtype` is given, the L-BFGS optimizers keep a copy of the
+        parameters, their history and their line search in this data type,
+        e.g. float64 for parameters in float32.
     '''
     if optim_type == 'adam':
         return (optim.Adam(parameters, lr=lr, betas=(beta1, beta2),
@@ -47,9 +63,23 @@ def create_optimizer(parameters, optim_type='lbfgs',
                 False)
     elif optim_type == 'lbfgs':
         return (optim.LBFGS(parameters, lr=lr, max_iter=maxiters), False)
+    elif optim_type == 'lbfgsls' and batch_size > 1:
+        return BatchLBFGS(parameters, lr=lr, max_iter=maxiters,
+                          line_search_fn='strong_Wolfe',
+                          state_dtype=optim_dtype), False
     elif optim_type == 'lbfgsls':
         return LBFGSLs(parameters, lr=lr, max_iter=maxiters,
-                       line_search_fn='strong_Wolfe'), False
+                       line_search_fn='strong_Wolfe',
+                       state_dtype=optim_dtype), False
+    elif optim_type == 'lbfgsls_batch':
+        return BatchLBFGS(parameters, lr=lr, max_iter=maxiters,
+                          line_search_fn='strong_Wolfe',
+                          state_dtype=optim_dtype), False
+    elif optim_type == 'lm':
+        return LevenbergMarquardt(parameters, max_iter=maxiters,
+                                  tolerance_grad=gtol,
+                                  tolerance_change=ftol,
+                                  batched=batch_size > 1), False
     elif optim_type == 'rmsprop':
         return (optim.RMSprop(parameters, lr=lr, epsilon=epsilon,
                               alpha=rmsprop_alpha,
@@ -84,9 +84,15 @@ class SMPLifyAnglePrior(nn.Module):
             A sze (B) tensor containing the angle prior loss for each element
             in the batch.
         '''
+        return self.residuals(pose, with_global_pose=with_global_pose).pow(2)
+
+    def residuals(self, pose, with_global_pose=False):
+        ''' Returns the residuals of the angle prior, whose squares are the
+            loss values returned by forward, Bx4
+        '''
         angle_prior_idxs = self.angle_prior_idxs - (not with_global_pose) * 3
         return torch.exp(pose[:, angle_prior_idxs] *
-                         self.angle_prior_signs).pow(2)
+                         self.angle_prior_signs)
 
 
 class L2Prior(nn.Module):
@@ -94,7 +100,16 @@ class L2Prior(nn.Module):
         super(L2Prior, self).__init__()
 
     def forward(self, module_input, *args):
-        return torch.sum(module_input.pow(2))
+        # Keep the batch dimension so that each sample can be reduced
+        # separately when fitting multiple persons at once
+        return torch.sum(
+            module_input.pow(2).reshape(module_input.shape[0], -1), dim=-1)
+
+    def residuals(self, module_input, *args):
+        ''' Returns the residuals of the prior, whose squared sum is the
+            loss of every sample, BxN
+        '''
+        return module_input.reshape(module_input.shape[0], -1)
 
 
 class MaxMixturePrior(nn.Module):
@@ -143,86 +158,121 @@ class MaxMixturePrior(nn.Module):
 
         self.register_buffer('covs', torch.tensor(covs, dtype=dtype))
 
-        precisions = [np.linalg.inv(cov) for cov in covs]
-        precisions = np.stack(precisions).astype(np_dtype)
-
-        self.register_buffer('precisions',
-                             torch.tensor(precisions, dtype=dtype))
-
+        # The quadratic form of every component is written as the squared
+        # norm of U (x - mean), where U is the transposed Cholesky factor of
+        # its precision. The factors of all the components are stacked, so
+        # that the quadratic forms of a batch of poses are computed with a
+        # single matrix product.
+        covs64 = covs.astype(np.float64)
+        precisions = np.stack([np.linalg.inv(cov) for cov in covs64])
+        factors = np.stack(
+            [np.linalg.cholesky(prec).T for prec in precisions])
+        self.register_buffer('stacked_factors', torch.tensor(
+            factors.reshape(-1, factors.shape[-1]), dtype=dtype))
+        self.register_buffer('factor_means', torch.tensor(
+            np.einsum('mij,mj->mi', factors, means.astype(np.float64)),
+            dtype=dtype))
+
+        # The log-determinants are computed in double precision, since the
+        # determinants of the covariances underflow in single precision
+        _, logdets = np.linalg.slogdet(covs64)
         # The constant term:
-        sqrdets = np.array([(np.sqrt(np.linalg.det(c)))
-                            for c in gmm['covars']])
         const = (2 * np.pi)**(69 / 2.)
+        sqrdets = np.exp(0.5 * logdets)
 
-        nll_weights = np.asarray(gmm['weights'] / (const *
-                                                   (sqrdets / sqrdets.min())))
+        weights = weights.astype(np.float64)
+        nll_weights = np.asarray(weights / (const *
+                                            (sqrdets / sqrdets.min())))
         nll_weights = torch.tensor(nll_weights, dtype=dtype).unsqueeze(dim=0)
         self.register_buffer('nll_weights', nll_weights)
+        weight_terms = -(np.log(weights) - np.log(const) -
+                         0.5 * (logdets - logdets.min()))
+        self.register_buffer('weight_terms', torch.tensor(
+            weight_terms, dtype=dtype).unsqueeze(dim=0))
 
-        weights = torch.tensor(gmm['weights'], dtype=dtype).unsqueeze(dim=0)
+        weights = torch.tensor(weights, dtype=dtype).unsqueeze(dim=0)
         self.register_buffer('weights', weights)
 
         self.register_buffer('pi_term',
                              torch.log(torch.tensor(2 * np.pi, dtype=dtype)))
 
-        cov_dets = [np.log(np.linalg.det(cov.astype(np_dtype)) + epsilon)
-                    for cov in covs]
+        # log(det(cov) + epsilon)
+        cov_dets = np.logaddexp(logdets, np.log(epsilon))
         self.register_buffer('cov_dets',
                              torch.tensor(cov_dets, dtype=dtype))
 
         # The dimensionality of the random variable
         self.random_var_dim = self.means.shape[1]
+        self.register_buffer('cov_terms', 0.5 * (
+            self.cov_dets + self.random_var_dim * self.pi_term).unsqueeze(
+                dim=0))
 
     def get_mean(self):
         ''' Returns the mean of the mixture '''
         mean_pose = torch.matmul(self.weights, self.means)
         return mean_pose
 
-    def merged_log_likelihood(self, pose, betas):
-        diff_from_mean = pose.unsqueeze(dim=1) - self.means
+    def factor_diff_prod(self, pose):
+        ''' Returns U (x - mean) for every component, BxMxD
+
+            The pose can have any number of leading dimensions, which are
+            flattened into the batch dimension.
+        '''
+        pose = pose.reshape(-1, self.random_var_dim)
+        prod = torch.matmul(pose, self.stacked_factors.t()).view(
+            pose.shape[0], self.num_gaussians, -1)
+        return prod - self.factor_means
 
-        prec_diff_prod = torch.einsum('mij,bmj->bmi',
-                                      [self.precisions, diff_from_mean])
-        diff_prec_quadratic = (prec_diff_prod * diff_from_mean).sum(dim=-1)
+    def merged_log_likelihood(self, pose, betas):
+        diff_prec_quadratic = self.factor_diff_prod(pose).pow(2).sum(dim=-1)
 
-        curr_loglikelihood = 0.5 * diff_prec_quadratic - \
-            torch.log(self.nll_weights)
-        #  curr_loglikelihood = 0.5 * (self.cov_dets.unsqueeze(dim=0) +
-        #  self.random_var_dim * self.pi_term +
-        #  diff_prec_quadratic
-        #  ) - torch.log(self.weights)
+        curr_loglikelihood = 0.5 * diff_prec_quadratic + self.weight_terms
 
         min_likelihood, _ = torch.min(curr_loglikelihood, dim=1)
-        return min_likelihood
+        return min_likelihood.view(pose.shape[:-1])
 
     def log_likelihood(self, pose, betas, *args, **kwargs):
         ''' Create graph operation for negative log-likelihood calculation
         '''
-        likelihoods = []
-
-        for idx in range(self.num_gaussians):
-            mean = self.means[idx]
-            prec = self.precisions[idx]
-            cov = self.covs[idx]
-            diff_from_mean = pose - mean
-
-            curr_loglikelihood = torch.einsum('bj,ji->bi',
-                                              [diff_from_mean, prec])
-            curr_loglikelihood = torch.einsum('bi,bi->b',
-                                              [curr_loglikelihood,
-                                               diff_from_mean])
-            cov_term = torch.log(torch.det(cov) + self.epsilon)
-            curr_loglikelihood += 0.5 * (cov_term +
-                                         self.random_var_dim *
-                                         self.pi_term)
-            likelihoods.append(curr_loglikelihood)
-
-        log_likelihoods = torch.stack(likelihoods, dim=1)
-        min_idx = torch.argmin(log_likelihoods, dim=1)
-        weight_component = self.nll_weights[:, min_idx]
-        weight_component = -torch.log(weight_component)
-
-        return weight_component + log_likelihoods[:, min_idx]
+        diff_prec_quadratic = self.factor_diff_prod(pose).pow(2).sum(dim=-1)
+        log_likelihoods = diff_prec_quadratic + self.cov_terms
+
+        min_likelihood, min_idx = torch.min(log_likelihoods, dim=1)
+        weight_component = self.weight_terms[0, min_idx]
+
+        return (weight_component + min_likelihood).view(pose.shape[:-1])
+
+    def residuals(self, pose, betas):
+        ''' Returns the residuals of the negative log-likelihood, BxN+1
+
+            The squared sum of the residuals of every sample is the negative
+            log-likelihood of its closest component. The last residual is the
+            square root of the constant term of that component, which is
+            clamped at zero when the constant is negative.
+        '''
+        factor_diff_prod = self.factor_diff_prod(pose)
+        diff_prec_quadratic = factor_diff_prod.pow(2).sum(dim=-1)
+
+        weight_term = self.weight_terms.expand_as(diff_prec_quadratic)
+        if self.use_merged:
+            scale = 0.5
+            min_idx = torch.argmin(scale * diff_prec_quadratic + weight_term,
+                                   dim=1)
+            const = weight_term
+        else:
+            # The component is selected without its weight, as in
+            # log_likelihood
+            scale = 1.0
+            min_idx = torch.argmin(diff_prec_quadratic + self.cov_terms,
+                                   dim=1)
+            const = self.cov_terms + weight_term
+
+        batch_idxs = torch.arange(diff_prec_quadratic.shape[0],
+                                  device=pose.device)
+        quadratic_res = (factor_diff_prod[batch_idxs, min_idx] *
+                         np.sqrt(scale))
+        const_res = const[batch_idxs, min_idx].clamp(min=0).sqrt()
+        return torch.cat([quadratic_res, const_res.unsqueeze(dim=-1)], dim=1)
 
     def forward(self, pose, betas):
         if self.use_merged:
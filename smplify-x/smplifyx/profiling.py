@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems and the Max Planck Institute for Biological
+# Cybernetics. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os.path as osp
+
+import json
+import math
+
+import torch
+
+# The name of the profile file in the output folder
+PROFILE_FN = 'profile.jsonl'
+
+
+class FittingProfiler(object):
+    ''' Writes the statistics of the optimization runs as JSON lines
+
+        Every record describes one row of the fitting batch, i.e. one
+        person and orientation, during one stage of the fitting. The file is
+        opened in append mode for every write, so that several worker
+        processes can share it.
+    '''
+
+    def __init__(self, profile_fn, use_cuda=False):
+        self.profile_fn = profile_fn
+        self.use_cuda = use_cuda and torch.cuda.is_available()
+
+    def synchronize(self):
+        ''' Waits for the queued device work, so that timings are exact '''
+        if self.use_cuda:
+            torch.cuda.synchronize()
+
+    def write(self, records):
+        ''' Appends a list of records to the profile file '''
+        if len(records) < 1:
+            return
+        lines = ''.join(json.dumps(record, default=to_json) + '\n'
+                        for record in records)
+        with open(self.profile_fn, 'a') as profile_file:
+            profile_file.write(lines)
+
+
+def to_json(value):
+    ''' Converts the numpy scalars of a record to python values '''
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError('{} is not JSON serializable'.format(type(value)))
+
+
+def finite_or_none(value):
+    ''' Replaces NaN and infinite values, which are not valid JSON '''
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+def create_profiler(output_folder, profile=False, use_cuda=False, **kwargs):
+    ''' Creates the profiler of a run, or None if profiling is disabled '''
+    if not profile:
+        return None
+    return FittingProfiler(osp.join(output_folder, PROFILE_FN),
+                           use_cuda=use_cuda)
@@ -33,14 +33,75 @@ def to_tensor(tensor, dtype=torch.float32):
         return torch.tensor(tensor, dtype)
 
 
+def compile_function(func):
+    ''' Compiles a function with torch.compile
+
+        Returns None if the installed version of PyTorch cannot compile
+        functions. The compilation itself only happens on the first call,
+        which may still fail for functions the compiler does not support.
+    '''
+    if not hasattr(torch, 'compile'):
+        return None
+    return torch.compile(func)
+
+
+def float_dtypes(float_dtype):
+    ''' Returns the data types of the models and of the optimizers
+
+        With 'mixed' the models are evaluated in single precision, while the
+        optimizers keep their state, their line search and the loss in
+        double precision. Otherwise the data type of the optimizers is None,
+        i.e. the one of the parameters.
+    '''
+    if float_dtype == 'float64':
+        return torch.float64, None
+    elif float_dtype == 'float32':
+        return torch.float32, None
+    elif float_dtype == 'mixed':
+        return torch.float32, torch.float64
+    else:
+        raise ValueError('Unknown float type {}, exiting!'.format(float_dtype))
+
+
 def rel_change(prev_val, curr_val):
     return (prev_val - curr_val) / max([np.abs(prev_val), np.abs(curr_val), 1])
 
 
+def batch_rel_change(prev_val, curr_val):
+    ''' Computes the relative change for every element of a batch '''
+    scale = torch.max(torch.max(prev_val.abs(), curr_val.abs()),
+                      torch.ones_like(curr_val))
+    return (prev_val - curr_val) / scale
+
+
 def max_grad_change(grad_arr):
     return grad_arr.abs().max()
 
 
+@torch.no_grad()
+def index_batch(module, index):
+    ''' Selects samples from the batch of a module
+
+        Every parameter of the module, as well as the buffers listed in its
+        `batch_buffers` attribute, is replaced by its rows at `index`. This
+        is used to repeat or drop samples of the body model and the camera.
+
+        Parameters
+        ----------
+        module: nn.Module
+            The module whose first parameter dimension is the batch
+        index: torch.tensor
+            The indices of the samples that will be kept
+    '''
+    for name, param in list(module.named_parameters(recurse=False)):
+        setattr(module, name,
+                nn.Parameter(param[index].clone(),
+                             requires_grad=param.requires_grad))
+    for name in getattr(module, 'batch_buffers', []):
+        setattr(module, name, getattr(module, name)[index].clone())
+    module.batch_size = len(index)
+
+
 class JointMapper(nn.Module):
     def __init__(self, joint_maps=None):
         super(JointMapper, self).__init__()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import os.path as osp
+import pickle
+import sys
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+import torch
+
+# The modules of smplifyx import each other as top-level modules
+sys.path.insert(0, osp.join(osp.dirname(osp.dirname(
+    osp.abspath(__file__))), 'smplifyx'))
+
+# The kinematic tree of SMPL-X
+PARENTS = [-1, 0, 0, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 9, 9, 12, 13, 14, 16, 17,
+           18, 19, 15, 15, 15, 20, 25, 26, 20, 28, 29, 20, 31, 32, 20, 34,
+           35, 20, 37, 38, 21, 40, 41, 21, 43, 44, 21, 46, 47, 21, 49, 50,
+           21, 52, 53]
+# Enough vertices for the extra joints selected by smplx
+NUM_VERTICES = 10000
+NUM_FACES = 20000
+BODY_POSE_DIM = 63
+
+# The starting points of the optimization tests
+STARTS = [[3.0, 3.0], [-1.2, 1.0], [0.5, -0.5], [-4.0, 0.0]]
+
+
+def quadratic(x, center=(1.0, -2.0), scale=(1.0, 10.0)):
+    center = x.new_tensor(center)
+    scale = x.new_tensor(scale)
+    return (scale * (x - center) ** 2).sum(dim=-1)
+
+
+def create_closure(optimizer, x, loss_func, monitor=None, residual_func=None,
+                   batched=True):
+    ''' Mirrors the closures of FittingMonitor for a batched optimizer
+
+        Without a monitor, every sample is optimized. `batched=False`
+        returns the summed loss, as the closures of the unbatched
+        optimizers do.
+    '''
+    def closure(return_blocks=False):
+        if return_blocks:
+            return OrderedDict(data=residual_func(x))
+        optimizer.zero_grad()
+        loss = loss_func(x)
+        if monitor is not None:
+            if monitor.sample_loss is None:
+                monitor.sample_loss = loss.detach().clone()
+            if monitor.active is not None:
+                loss = torch.where(monitor.active, loss,
+                                   torch.zeros_like(loss))
+            monitor.steps += 1
+        loss.sum().backward()
+        return loss if batched else loss.sum()
+    return closure
+
+
+@pytest.fixture(scope='session')
+def body_pose_prior(tmp_path_factory):
+    ''' A random mixture over the body pose of SMPL-X '''
+    rng = np.random.RandomState(0)
+    covars = []
+    for _ in range(4):
+        basis = rng.randn(BODY_POSE_DIM, BODY_POSE_DIM)
+        covars.append(0.05 * np.matmul(basis, basis.T) / BODY_POSE_DIM +
+                      0.05 * np.eye(BODY_POSE_DIM))
+    gmm = dict(means=0.1 * rng.randn(4, BODY_POSE_DIM),
+               covars=np.stack(covars), weights=rng.dirichlet(np.ones(4)))
+    folder = tmp_path_factory.mktemp('prior')
+    with open(str(folder / 'gmm_04.pkl'), 'wb') as f:
+        pickle.dump(gmm, f)
+    # The prior module is found through the path of smplifyx above
+    from prior import MaxMixturePrior
+    return MaxMixturePrior(prior_folder=str(folder), num_gaussians=4,
+                           dtype=torch.float64)
+
+
+@pytest.fixture(scope='session')
+def model_folder(tmp_path_factory):
+    ''' Writes a random SMPL-X model with the layout of the real one '''
+    rng = np.random.RandomState(0)
+    num_joints = len(PARENTS)
+
+    lbs_weights = rng.rand(NUM_VERTICES, num_joints) ** 8
+    lbs_weights /= lbs_weights.sum(axis=1, keepdims=True)
+    J_regressor = rng.rand(num_joints, NUM_VERTICES) ** 8
+    J_regressor /= J_regressor.sum(axis=1, keepdims=True)
+
+    kintree_table = np.stack([PARENTS, np.arange(num_joints)])
+    kintree_table[0, 0] = 2 ** 32 - 1
+    faces = np.stack([rng.choice(NUM_VERTICES, 3, replace=False)
+                      for _ in range(NUM_FACES)])
+    bary_coords = rng.dirichlet(np.ones(3), size=51 + 79 * 17)
+
+    folder = tmp_path_factory.mktemp('models')
+    model_dir = folder / 'smplx'
+    model_dir.mkdir()
+    np.savez(
+        str(model_dir / 'SMPLX_NEUTRAL.npz'),
+        v_template=rng.randn(NUM_VERTICES, 3).astype(np.float32),
+        # 10 shape and 10 expression coefficients
+        shapedirs=1e-2 * rng.randn(NUM_VERTICES, 3, 20).astype(np.float32),
+        posedirs=1e-2 * rng.randn(NUM_VERTICES, 3, (num_joints - 1) * 9
+                                  ).astype(np.float32),
+        J_regressor=J_regressor.astype(np.float32),
+        weights=lbs_weights.astype(np.float32),
+        kintree_table=kintree_table,
+        f=faces,
+        hands_componentsl=np.linalg.qr(rng.randn(45, 45))[0],
+        hands_componentsr=np.linalg.qr(rng.randn(45, 45))[0],
+        hands_meanl=0.1 * rng.randn(45),
+        hands_meanr=0.1 * rng.randn(45),
+        lmk_faces_idx=rng.choice(NUM_FACES, 51),
+        lmk_bary_coords=bary_coords[:51],
+        dynamic_lmk_faces_idx=rng.choice(NUM_FACES, [79, 17]),
+        dynamic_lmk_bary_coords=bary_coords[51:].reshape(79, 17, 3))
+    return str(folder)
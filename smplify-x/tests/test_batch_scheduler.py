@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from batch_scheduler import BatchScheduler, WindowScheduler
+
+
+def add_person(scheduler, idx, **kwargs):
+    keypoints = np.full([25, 3], idx, dtype=np.float32)
+    return scheduler.add(img='img{}'.format(idx), keypoints=keypoints,
+                         result_fn='result{}.pkl'.format(idx),
+                         mesh_fn='mesh{}.obj'.format(idx),
+                         out_img_fn='out{}.png'.format(idx),
+                         frame='frame{}'.format(idx), **kwargs)
+
+
+def create_result(window, offset=0.0):
+    num_frames = len(window['frames'])
+    return {'betas': np.arange(num_frames, dtype=np.float32).reshape(
+        num_frames, 1) + offset}
+
+
+def test_full_batch_is_returned():
+    scheduler = BatchScheduler(batch_size=2)
+    assert add_person(scheduler, 0) == []
+    batches = add_person(scheduler, 1)
+
+    assert len(batches) == 1
+    assert batches[0]['num_persons'] == 2
+    assert batches[0]['result_fn'] == ['result0.pkl', 'result1.pkl']
+    assert len(scheduler) == 0
+    assert scheduler.flush() == []
+
+
+def test_padded_flush_writes_nothing_for_copies():
+    scheduler = BatchScheduler(batch_size=4)
+    add_person(scheduler, 0)
+    add_person(scheduler, 1)
+    add_person(scheduler, 2, group='female')
+
+    batches = scheduler.flush()
+    assert len(batches) == 2
+    assert len(scheduler) == 0
+
+    neutral, female = batches
+    assert neutral['group'] == 'neutral'
+    assert female['group'] == 'female'
+    # The batches have the full size, but the padding is not counted
+    assert neutral['num_persons'] == 2
+    assert female['num_persons'] == 1
+    for batch in batches:
+        num_persons = batch['num_persons']
+        assert batch['keypoints'].shape[0] == 4
+        for key in ['result_fn', 'mesh_fn', 'out_img_fn']:
+            assert len(batch[key]) == 4
+            assert all(fn is not None for fn in batch[key][:num_persons])
+            assert all(fn is None for fn in batch[key][num_persons:])
+        # The copies repeat the last person
+        np.testing.assert_array_equal(
+            batch['keypoints'][num_persons:],
+            np.broadcast_to(batch['keypoints'][num_persons - 1],
+                            batch['keypoints'][num_persons:].shape))
+
+    assert neutral['frame'] == ['frame0', 'frame1', 'frame1', 'frame1']
+
+
+def test_padded_init_params():
+    scheduler = BatchScheduler(batch_size=3)
+    for idx in range(2):
+        add_person(scheduler, idx, init_params={
+            'betas': np.full([1, 10], idx, dtype=np.float32)})
+
+    batch, = scheduler.flush()
+    assert batch['num_persons'] == 2
+    assert batch['init_params']['betas'].shape == (3, 10)
+    np.testing.assert_array_equal(batch['init_params']['betas'][:, 0],
+                                  [0, 1, 1])
+
+
+def add_frame(scheduler, idx, position=0.0, frame_idx=None, **kwargs):
+    ''' Adds a person whose keypoints are a square around a position '''
+    keypoints = np.ones([25, 3], dtype=np.float32)
+    keypoints[:, :2] = position + 100 * np.linspace(0, 1, 50).reshape(25, 2)
+    return scheduler.add(img='img{}'.format(idx), keypoints=keypoints,
+                         result_fn='result{}.pkl'.format(idx),
+                         mesh_fn='mesh{}.obj'.format(idx),
+                         out_img_fn='out{}.png'.format(idx),
+                         frame_idx=idx if frame_idx is None else frame_idx,
+                         frame='frame{}'.format(idx), **kwargs)
+
+
+def test_window_is_returned_when_full():
+    scheduler = WindowScheduler(window_size=3, window_stride=2)
+    assert add_frame(scheduler, 0, person_id=0) == []
+    assert add_frame(scheduler, 1, person_id=0) == []
+    windows = add_frame(scheduler, 2, person_id=0)
+
+    assert len(windows) == 1
+    window = windows[0]
+    assert window['num_persons'] == 3
+    assert window['frame'] == ['frame0', 'frame1', 'frame2']
+    assert window['frame_idx'] == [0, 1, 2]
+    assert window['person_id'] == [0, 0, 0]
+    # The person has not been fitted before
+    assert window['init_params'] is None
+
+
+def test_update_drops_window_stride_frames():
+    scheduler = WindowScheduler(window_size=4, window_stride=3)
+    for idx in range(3):
+        add_frame(scheduler, idx, person_id=0)
+    window, = add_frame(scheduler, 3, person_id=0)
+
+    scheduler.update(window, create_result(window))
+    track = scheduler.tracks[('neutral', 0)]
+    assert [frame['frame'] for frame in track['frames']] == ['frame3']
+
+    # The next window starts from the fit of the kept frame, and the new
+    # frames from the fit of the latest fitted frame
+    for idx in range(4, 6):
+        assert add_frame(scheduler, idx, person_id=0) == []
+    window, = add_frame(scheduler, 6, person_id=0)
+    assert window['frame'] == ['frame3', 'frame4', 'frame5', 'frame6']
+    np.testing.assert_array_equal(window['init_params']['betas'][:, 0],
+                                  [3, 3, 3, 3])
+
+    scheduler.update(window, create_result(window, offset=10))
+    assert [frame['frame'] for frame in track['frames']] == ['frame6']
+    # All the frames have been fitted
+    assert scheduler.flush() == []
+
+
+def test_short_track_is_flushed_once():
+    scheduler = WindowScheduler(window_size=8, window_stride=4)
+    for idx in range(3):
+        assert add_frame(scheduler, idx, person_id=1) == []
+
+    windows = scheduler.flush()
+    assert len(windows) == 1
+    window = windows[0]
+    assert window['num_persons'] == 3
+    assert window['frame'] == ['frame0', 'frame1', 'frame2']
+
+    scheduler.update(window, create_result(window))
+    # The frames are kept, but they are not fitted again
+    assert len(scheduler.tracks[('neutral', 0)]['frames']) == 3
+    assert scheduler.flush() == []
+
+
+def test_persons_are_matched_by_position():
+    scheduler = WindowScheduler(window_size=3, window_stride=1)
+    # OpenPose lists the two persons in another order in the second frame
+    for idx, positions in enumerate([[0, 500], [510, 10], [20, 520]]):
+        windows = []
+        for person_id, position in enumerate(positions):
+            windows += add_frame(scheduler, idx, position=position,
+                                 person_id=person_id)
+    assert [window['person_id'] for window in windows] == [[0, 1, 0],
+                                                           [1, 0, 1]]
+    for window in windows:
+        assert window['frame_idx'] == [0, 1, 2]
+        positions = window['keypoints'][:, 0, 0]
+        assert np.ptp(positions) < 50
+
+    # A person far from every track, or with another body model, starts a
+    # new one
+    assert add_frame(scheduler, 3, position=2000, person_id=0) == []
+    assert add_frame(scheduler, 3, position=20, person_id=1,
+                     group='female') == []
+    assert list(scheduler.tracks) == [('neutral', 0), ('neutral', 1),
+                                      ('neutral', 2), ('female', 3)]
+
+
+def test_gap_ends_the_track():
+    scheduler = WindowScheduler(window_size=4, window_stride=2)
+    for idx in range(2):
+        assert add_frame(scheduler, idx, person_id=0) == []
+
+    # The person is missing in frame 2, so its track ends with a last
+    # window of the frames before the gap
+    window, = add_frame(scheduler, 3, person_id=0)
+    assert window['track'] == ('neutral', 0)
+    assert window['frame_idx'] == [0, 1]
+    scheduler.update(window, create_result(window))
+    assert list(scheduler.tracks) == [('neutral', 1)]
+
+    for idx in range(4, 6):
+        add_frame(scheduler, idx, person_id=0)
+    window, = scheduler.flush()
+    assert window['frame_idx'] == [3, 4, 5]
+    # The new track is not started from the fit of the old one
+    assert window['init_params'] is None
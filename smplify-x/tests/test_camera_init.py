@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+
+import fitting
+from camera import create_camera
+
+ModelOutput = namedtuple('ModelOutput', ['joints'])
+
+# Hips, shoulders, neck and spine of a torso in its rest pose, relative to
+# the root joint
+TORSO_JOINTS = [[0.0, 0.0, 0.0], [0.1, -0.05, 0.0], [-0.1, -0.05, 0.0],
+                [0.18, 0.5, 0.0], [-0.18, 0.5, 0.0], [0.0, 0.55, 0.0],
+                [0.0, 0.25, 0.0]]
+
+
+class Skeleton(nn.Module):
+    ''' A rigid skeleton that rotates around its root joint '''
+
+    def __init__(self, batch_size, dtype=torch.float64):
+        super(Skeleton, self).__init__()
+        self.register_buffer('rest_joints',
+                             torch.tensor(TORSO_JOINTS, dtype=dtype))
+        self.global_orient = nn.Parameter(
+            torch.zeros([batch_size, 3], dtype=dtype))
+
+    def forward(self, global_orient=None, **kwargs):
+        if global_orient is None:
+            global_orient = self.global_orient
+        rot_mats = torch.tensor(
+            np.stack([cv2.Rodrigues(orient)[0]
+                      for orient in global_orient.detach().cpu().numpy()]),
+            dtype=self.rest_joints.dtype)
+        return ModelOutput(joints=torch.matmul(self.rest_joints,
+                                               rot_mats.transpose(1, 2)))
+
+
+def rotation_angle(orient, gt_orient):
+    rot_mat = np.matmul(cv2.Rodrigues(orient)[0].T,
+                        cv2.Rodrigues(gt_orient)[0])
+    return np.degrees(np.arccos(np.clip((np.trace(rot_mat) - 1) / 2,
+                                        -1, 1)))
+
+
+def test_recovers_orientation_and_translation():
+    # The first two persons are turned by the same angle to either side,
+    # which gives the same weak perspective projection, so each sign of
+    # the rotation is selected once from the reprojection error
+    gt_orient = torch.tensor([[0.0, 0.7, 0.0], [0.0, -0.7, 0.0],
+                              [0.2, 2.5, -0.1], [3.0, 0.2, 0.1]],
+                             dtype=torch.float64)
+    gt_transl = torch.tensor([[0.1, 0.2, 20.0], [0.1, 0.2, 20.0],
+                              [0.0, -0.2, 15.0], [0.2, 0.3, 25.0]],
+                             dtype=torch.float64)
+    batch_size = gt_orient.shape[0]
+
+    model = Skeleton(batch_size)
+    camera = create_camera(batch_size=batch_size, dtype=torch.float64,
+                           center=torch.full([batch_size, 2], 500.0,
+                                             dtype=torch.float64))
+    with torch.no_grad():
+        camera.translation[:] = gt_transl
+        joints_2d = camera(model(global_orient=gt_orient).joints)
+        camera.translation.zero_()
+    assert torch.allclose(joints_2d[0], joints_2d[1], atol=5.0)
+
+    init_joints_idxs = torch.arange(len(TORSO_JOINTS))
+    init_t, global_orient = fitting.solve_camera_init(
+        model, camera, joints_2d, init_joints_idxs, use_vposer=False)
+
+    assert init_t.shape == (batch_size, 3)
+    assert global_orient.shape == (batch_size, 3)
+    # The rotation comes from a weak perspective approximation, so it is
+    # only exact up to the depth variation of the torso
+    for orient, gt in zip(global_orient.numpy(), gt_orient.numpy()):
+        assert rotation_angle(orient, gt) < 2.0
+    assert torch.allclose(init_t[:, :2], gt_transl[:, :2], atol=1e-2)
+    assert torch.allclose(init_t[:, 2], gt_transl[:, 2], rtol=1e-2)
+
+    # The two persons with the mirrored weak perspective projection are
+    # resolved to opposite rotations
+    assert global_orient[0, 1] > 0 > global_orient[1, 1]
+
+
+def test_ignores_joints_without_confidence():
+    gt_orient = torch.tensor([[0.3, -1.0, 0.2]], dtype=torch.float64)
+    gt_transl = torch.tensor([[-0.2, 0.1, 18.0]], dtype=torch.float64)
+
+    model = Skeleton(1)
+    camera = create_camera(batch_size=1, dtype=torch.float64)
+    with torch.no_grad():
+        camera.translation[:] = gt_transl
+        joints_2d = camera(model(global_orient=gt_orient).joints)
+        camera.translation.zero_()
+
+    # A wrong detection with zero confidence does not change the solution
+    joints_conf = torch.ones(joints_2d.shape[:2], dtype=torch.float64)
+    joints_conf[0, -1] = 0
+    outlier_2d = joints_2d.clone()
+    outlier_2d[0, -1] += 300.0
+
+    init_joints_idxs = torch.arange(len(TORSO_JOINTS))
+    init_t, global_orient = fitting.solve_camera_init(
+        model, camera, joints_2d, init_joints_idxs, use_vposer=False,
+        joints_conf=joints_conf)
+    outlier_t, outlier_orient = fitting.solve_camera_init(
+        model, camera, outlier_2d, init_joints_idxs, use_vposer=False,
+        joints_conf=joints_conf)
+
+    assert torch.allclose(init_t, outlier_t)
+    assert torch.allclose(global_orient, outlier_orient)
+    assert rotation_angle(global_orient[0].numpy(), gt_orient[0].numpy()) < 2
+    assert torch.allclose(init_t, gt_transl, rtol=1e-2, atol=1e-2)
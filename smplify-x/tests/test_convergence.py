@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+import torch
+
+import fitting
+from conftest import create_closure
+from optimizers.lbfgs_ls_batch import BatchLBFGS
+from profiling import FittingProfiler
+
+
+class GradientDescent(torch.optim.Optimizer):
+    ''' Plain gradient descent, whose iterates are known in closed form '''
+
+    def __init__(self, params, lr=0.1):
+        super(GradientDescent, self).__init__(params, dict(lr=lr))
+        self.batched = True
+
+    @torch.no_grad()
+    def step(self, closure):
+        with torch.enable_grad():
+            loss = closure()
+        for group in self.param_groups:
+            for param in group['params']:
+                if param.grad is not None:
+                    param.sub_(group['lr'] * param.grad)
+        return loss
+
+
+def test_check_convergence():
+    monitor = fitting.FittingMonitor(ftol=1e-3, gtol=1e-4, batch_size=4)
+    param = torch.zeros([4, 2], dtype=torch.float64, requires_grad=True)
+    param.grad = torch.tensor([[1.0, -1.0], [1e-5, -1e-5], [1.0, 0.0],
+                               [1e-5, 0.0]], dtype=torch.float64)
+    prev_loss = torch.tensor([10.0, 10.0, 10.0, 10.0], dtype=torch.float64)
+    loss = torch.tensor([5.0, 5.0, 10.0 - 1e-3, float('nan')],
+                        dtype=torch.float64)
+
+    stop_code = monitor.check_convergence(loss, prev_loss, [param])
+    assert stop_code.tolist() == [0, fitting.STOP_GTOL, fitting.STOP_FTOL,
+                                  fitting.STOP_NON_FINITE]
+    # Without a previous loss only the gradient and the value are checked
+    stop_code = monitor.check_convergence(loss, None, [param])
+    assert stop_code.tolist() == [0, fitting.STOP_GTOL, 0,
+                                  fitting.STOP_NON_FINITE]
+
+    # A single loss for the whole batch
+    param.grad = torch.full_like(param, 1e-5)
+    stop_code = monitor.check_convergence(loss[:1].sum(), None, [param])
+    assert stop_code.dim() == 0 and stop_code.item() == fitting.STOP_GTOL
+
+
+def test_nan_sample_with_delayed_checks():
+    check_every = 4
+    # Every step of gradient descent scales the parameters by 1 - 2 * lr *
+    # scale, the first sample converges fast and the second one slowly.
+    # The loss of the third sample is not finite once its parameter drops
+    # below 0.5, which happens at the start of its fifth step
+    scale = torch.tensor([2.0, 0.5, 1.0], dtype=torch.float64)
+    lr = 0.1
+
+    def loss_func(x):
+        loss = scale * x.pow(2).sum(dim=1)
+        nan_mask = (torch.arange(x.shape[0]) == 2) & (x[:, 0] < 0.5)
+        return torch.where(nan_mask, torch.full_like(loss, float('nan')),
+                           loss)
+
+    x = torch.ones([3, 2], dtype=torch.float64, requires_grad=True)
+    optimizer = GradientDescent([x], lr=lr)
+    monitor = fitting.FittingMonitor(maxiters=1000, ftol=0, gtol=1e-6,
+                                     batch_size=3, check_every=check_every)
+    closure = create_closure(optimizer, x, loss_func, monitor)
+
+    num_steps = [0]
+    step = optimizer.step
+
+    def count_step(closure):
+        num_steps[0] += 1
+        return step(closure)
+
+    optimizer.step = count_step
+    with monitor:
+        final_loss = monitor.run_batch_fitting(optimizer, closure, [x], None,
+                                               use_vposer=False)
+
+    exit_codes = [fitting.EXIT_REASONS[code]
+                  for code in monitor.exit_code.tolist()]
+    assert exit_codes == ['gtol', 'gtol', 'nan']
+    assert monitor.active is None
+
+    # The third sample stopped at its fifth step and returned to the last
+    # parameters whose loss was finite, those of the start of its fourth
+    sample_steps = monitor.sample_steps.tolist()
+    assert sample_steps[2] == 5
+    expected = (1 - 2 * lr * scale[2]) ** 3
+    assert torch.allclose(x.detach()[2], torch.full([2], expected.item(),
+                                                    dtype=torch.float64))
+    assert torch.isfinite(final_loss[2])
+    assert final_loss[2].item() == loss_func(x.detach())[2].item()
+
+    # The other samples kept fitting until their gradient vanished
+    assert sample_steps[1] > sample_steps[0] > sample_steps[2]
+    assert torch.all(x.detach()[:2].abs() < 1e-6)
+    # The first sample kept the result of the step it converged at
+    expected = (1 - 2 * lr * scale[0]) ** sample_steps[0]
+    assert torch.allclose(x.detach()[0], torch.full([2], expected.item(),
+                                                    dtype=torch.float64))
+
+    # The loop only stops at the first read back of the stopping criteria
+    # after the last sample converged
+    last_step = max(sample_steps)
+    assert last_step % check_every != 0
+    expected_steps = (last_step // check_every + 1) * check_every
+    assert num_steps[0] == monitor.num_steps == expected_steps
+
+
+def test_single_fit_stops_at_delayed_checks():
+    check_every = 5
+    lr = 0.1
+
+    # Every step of gradient descent scales the parameters by 0.8. The loss
+    # and the gradient are not finite once the parameters drop below 0.7,
+    # which happens at the start of the third step
+    def loss_func(x):
+        factor = torch.where(x[:, 0] < 0.7, torch.full_like(x[:, 0],
+                                                            float('nan')),
+                             torch.ones_like(x[:, 0]))
+        return factor * x.pow(2).sum(dim=1)
+
+    x = torch.ones([1, 2], dtype=torch.float64, requires_grad=True)
+    optimizer = GradientDescent([x], lr=lr)
+    monitor = fitting.FittingMonitor(maxiters=100, ftol=0, gtol=1e-6,
+                                     check_every=check_every)
+    closure = create_closure(optimizer, x, loss_func, batched=False)
+    with monitor:
+        final_loss = monitor.run_single_fitting(optimizer, closure, [x], None,
+                                                use_vposer=False)
+
+    # The NaN is read back at the fifth step, and the parameters returned to
+    # the last ones whose loss was finite, those of the start of the second
+    assert monitor.num_steps == check_every
+    assert monitor.exit_code.item() == fitting.STOP_NON_FINITE
+    assert torch.all(torch.isfinite(x.detach()))
+    assert torch.allclose(x.detach(), torch.full_like(x, 0.8))
+    assert final_loss == loss_func(x.detach()).item()
+
+    # A converged fit keeps the result of the step it converged at
+    x = torch.ones([1, 2], dtype=torch.float64, requires_grad=True)
+    optimizer = GradientDescent([x], lr=lr)
+    monitor = fitting.FittingMonitor(maxiters=100, ftol=0, gtol=1e-3,
+                                     check_every=check_every)
+    closure = create_closure(optimizer, x, lambda x: x.pow(2).sum(dim=1),
+                             batched=False)
+    with monitor:
+        monitor.run_single_fitting(optimizer, closure, [x], None,
+                                   use_vposer=False)
+
+    # The gradient of the last step is the one at its start
+    last_step = 1
+    while 2 * 0.8 ** (last_step - 1) >= 1e-3:
+        last_step += 1
+    assert last_step % check_every != 0
+    assert monitor.num_steps == (last_step // check_every + 1) * check_every
+    assert monitor.exit_code.item() == fitting.STOP_GTOL
+    assert torch.allclose(x.detach(), torch.full_like(x, 0.8 ** last_step))
+
+
+def read_profile(profile_fn):
+    with open(profile_fn) as profile_file:
+        return [json.loads(line) for line in profile_file]
+
+
+def test_profile_records(tmpdir):
+    # The second sample converges fast, the loss of the third one is not
+    # finite once its parameter drops below 0.5
+    scale = torch.tensor([1.0, 2.0, 1.0], dtype=torch.float64)
+
+    def residual_func(x):
+        residuals = scale.sqrt().unsqueeze(dim=1) * x
+        nan_mask = (torch.arange(x.shape[0]) == 2) & (x[:, 0] < 0.5)
+        return torch.where(nan_mask.unsqueeze(dim=1),
+                           torch.full_like(residuals, float('nan')),
+                           residuals)
+
+    def loss_func(x):
+        return residual_func(x).pow(2).sum(dim=1)
+
+    profile_fn = str(tmpdir.join('profile.jsonl'))
+    x = torch.ones([3, 2], dtype=torch.float64, requires_grad=True)
+    optimizer = GradientDescent([x], lr=0.1)
+    monitor = fitting.FittingMonitor(maxiters=1000, ftol=0, gtol=1e-6,
+                                     batch_size=3,
+                                     profiler=FittingProfiler(profile_fn))
+    closure = create_closure(optimizer, x, loss_func, monitor,
+                             residual_func=residual_func)
+    profile_info = [{'frame': 'f000', 'person': idx, 'stage': 0}
+                    for idx in range(3)]
+    with monitor:
+        final_loss = monitor.run_fitting(optimizer, closure, [x], None,
+                                         use_vposer=False,
+                                         profile_info=profile_info)
+
+    records = read_profile(profile_fn)
+    assert len(records) == 3
+    for idx, record in enumerate(records):
+        # Every record keeps the labels of its row
+        for key, val in profile_info[idx].items():
+            assert record[key] == val
+        assert record['batch_size'] == 3
+        assert record['optimizer_steps'] == monitor.num_steps
+        assert record['closure_evals'] == monitor.num_steps
+        # The optimizer does not search along its steps
+        assert record['line_search_evals'] == 0
+        assert record['loss'] == final_loss[idx].item()
+        # The terms are evaluated at the final parameters
+        assert record['loss_terms']['data'] == pytest.approx(
+            loss_func(x.detach())[idx].item())
+    assert [record['exit_reason'] for record in records] == [
+        'gtol', 'gtol', 'nan']
+    assert [record['iterations'] for record in records] == \
+        monitor.sample_steps.tolist()
+    assert records[0]['iterations'] > records[1]['iterations']
+
+
+def test_profile_records_of_line_searches(tmpdir):
+    profile_fn = str(tmpdir.join('profile.jsonl'))
+    scale = torch.tensor([[1.0, 10.0], [1.0, 100.0]], dtype=torch.float64)
+    x = torch.ones([2, 2], dtype=torch.float64, requires_grad=True)
+    optimizer = BatchLBFGS([x], lr=1, max_iter=1,
+                           line_search_fn='strong_Wolfe')
+    monitor = fitting.FittingMonitor(maxiters=3, ftol=0, gtol=0,
+                                     batch_size=2,
+                                     profiler=FittingProfiler(profile_fn))
+    closure = create_closure(
+        optimizer, x, lambda x: (scale * x.pow(2)).sum(dim=1), monitor,
+        residual_func=lambda x: scale.sqrt() * x)
+    with monitor:
+        monitor.run_fitting(optimizer, closure, [x], None, use_vposer=False)
+
+    records = read_profile(profile_fn)
+    assert len(records) == 2
+    for record in records:
+        assert record['optimizer_steps'] == 3
+        assert record['exit_reason'] == 'maxiters'
+        # Every step evaluates the closure once before its line search
+        assert record['closure_evals'] == monitor.steps
+        assert record['line_search_evals'] == monitor.steps - 3
+        assert record['line_search_evals'] > 0
+        assert record['iterations'] == 3
@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import os.path as osp
+import time
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+Image = pytest.importorskip('PIL.Image')
+
+import data_parser  # noqa: E402
+from data_parser import (FramePrefetcher, LazyImage, OpenPose,  # noqa
+                         list_images, read_keypoints, read_keypoints_batch,
+                         select_frames)
+import keypoint_store  # noqa: E402
+from keypoint_store import KeypointStore, compile_keypoint_store  # noqa
+
+
+def write_image(folder, orientation, ext='.jpg', size=(40, 24)):
+    ''' Writes an image with an EXIF orientation tag '''
+    rng = np.random.RandomState(orientation)
+    pixels = (rng.rand(size[1], size[0], 3) * 255).astype(np.uint8)
+    img = Image.fromarray(pixels)
+    img_fn = osp.join(folder, 'img_{}{}'.format(orientation, ext))
+    exif = img.getexif()
+    if orientation is not None:
+        exif[0x0112] = orientation
+    img.save(img_fn, exif=exif)
+    return img_fn
+
+
+@pytest.mark.parametrize('orientation', [None] + list(range(1, 9)))
+def test_lazy_image_matches_imread(tmpdir, orientation):
+    img_fn = write_image(str(tmpdir), orientation)
+    expected = cv2.imread(img_fn)
+
+    img = LazyImage(img_fn)
+    # The size is read from the header, with the rotation of the EXIF
+    # orientation that cv2.imread applies
+    assert img.shape == expected.shape
+    pixels = np.asarray(img)
+    assert pixels.dtype == np.float32
+    assert np.array_equal(
+        pixels, expected.astype(np.float32)[:, :, ::-1] / 255.0)
+
+
+def test_lazy_image_of_png(tmpdir):
+    img_fn = write_image(str(tmpdir), None, ext='.png')
+    img = LazyImage(img_fn)
+    assert img.shape == cv2.imread(img_fn).shape
+    assert np.asarray(img, dtype=np.float64).dtype == np.float64
+
+
+def write_keypoints(folder, num_frames=7, num_body_joints=25, seed=0):
+    ''' Writes OpenPose keypoint files, some with undetected parts '''
+    rng = np.random.RandomState(seed)
+    keypoint_fns = []
+    for frame_idx in range(num_frames):
+        people = []
+        for person_idx in range(frame_idx % 3):
+            person_data = {
+                'pose_keypoints_2d': rng.rand(num_body_joints * 3).tolist(),
+                'hand_left_keypoints_2d': rng.rand(21 * 3).tolist(),
+                'hand_right_keypoints_2d': rng.rand(21 * 3).tolist(),
+                'face_keypoints_2d': rng.rand(70 * 3).tolist()}
+            if person_idx == 1:
+                person_data['hand_left_keypoints_2d'] = []
+                person_data['face_keypoints_2d'] = []
+            if frame_idx % 2 == 0:
+                person_data['gender_gt'] = 'female'
+            people.append(person_data)
+
+        keypoint_fn = osp.join(folder, 'f{:03d}_keypoints.json'.format(
+            frame_idx))
+        with open(keypoint_fn, 'w') as keypoint_file:
+            json.dump({'version': 1.3, 'people': people}, keypoint_file)
+        keypoint_fns.append(keypoint_fn)
+    return keypoint_fns
+
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+@pytest.mark.parametrize('use_hands,use_face,use_face_contour', [
+    (False, False, False), (True, False, False), (True, True, False),
+    (True, True, True), (False, True, True)])
+def test_batch_matches_single_files(tmpdir, num_workers, use_hands,
+                                    use_face, use_face_contour):
+    keypoint_fns = write_keypoints(str(tmpdir))
+    flags = dict(use_hands=use_hands, use_face=use_face,
+                 use_face_contour=use_face_contour)
+
+    batch = read_keypoints_batch(keypoint_fns, num_workers=num_workers,
+                                 **flags)
+    assert len(batch) == len(keypoint_fns)
+    for keypoint_fn, keyp_tuple in zip(keypoint_fns, batch):
+        expected = read_keypoints(keypoint_fn, **flags)
+        np.testing.assert_array_equal(keyp_tuple.keypoints,
+                                      expected.keypoints)
+        assert keyp_tuple.gender_gt == expected.gender_gt
+        assert keyp_tuple.gender_pd == expected.gender_pd
+
+
+def test_undetected_parts_are_zero(tmpdir):
+    keypoint_fns = write_keypoints(str(tmpdir))
+    keypoints = read_keypoints(keypoint_fns[2], use_hands=True,
+                               use_face=True,
+                               use_face_contour=True).keypoints
+    with open(keypoint_fns[2]) as keypoint_file:
+        person_data = json.load(keypoint_file)['people'][1]
+
+    assert keypoints.shape == (2, 25 + 42 + 51 + 17, 3)
+    np.testing.assert_array_equal(
+        keypoints[1, :25].ravel(),
+        np.array(person_data['pose_keypoints_2d'], dtype=np.float32))
+    assert np.all(keypoints[1, 25:46] == 0)
+    assert np.all(keypoints[1, 46:67] != 0)
+    assert np.all(keypoints[1, 67:] == 0)
+
+
+def test_mismatched_body_joints(tmpdir):
+    keypoint_fns = (write_keypoints(str(tmpdir.mkdir('coco25'))) +
+                    write_keypoints(str(tmpdir.mkdir('coco19')),
+                                    num_body_joints=19))
+    with pytest.raises(ValueError):
+        read_keypoints_batch(keypoint_fns)
+
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+@pytest.mark.parametrize('num_body_joints', [25, 19])
+def test_keypoint_store_matches_json(tmpdir, num_workers, num_body_joints):
+    keyp_folder = str(tmpdir.mkdir('keypoints'))
+    keypoint_fns = write_keypoints(keyp_folder,
+                                   num_body_joints=num_body_joints)
+    store_folder = str(tmpdir.join('store'))
+    compile_keypoint_store(keyp_folder, store_folder,
+                           num_workers=num_workers, chunk_size=3)
+
+    store = KeypointStore(store_folder)
+    for keypoint_fn in keypoint_fns:
+        frame = osp.basename(keypoint_fn)[:-len('_keypoints.json')]
+        keypoints, gender_gt, _ = store.read(frame, use_face_contour=True)
+        expected = read_keypoints(keypoint_fn, use_face_contour=True)
+        assert len(keypoints) == len(expected.keypoints)
+        # Frames without persons do not know the number of body joints
+        if len(keypoints) > 0:
+            np.testing.assert_array_equal(keypoints, expected.keypoints)
+        assert gender_gt == expected.gender_gt
+
+
+def write_images(folder, num_images):
+    img_fns = ['f{:03d}.png'.format(idx) for idx in range(num_images)]
+    for img_fn in img_fns:
+        open(osp.join(folder, img_fn), 'w').close()
+    return img_fns
+
+
+def test_failed_compilation_leaves_no_files(tmpdir, monkeypatch):
+    keyp_folder = str(tmpdir.mkdir('keypoints'))
+    write_keypoints(keyp_folder)
+    store_folder = str(tmpdir.join('store'))
+
+    # The keypoints are read, but the index cannot be written
+    def fail_savez(*args, **kwargs):
+        raise IOError('No space left on device')
+
+    monkeypatch.setattr(keypoint_store.np, 'savez', fail_savez)
+    with pytest.raises(IOError):
+        compile_keypoint_store(keyp_folder, store_folder)
+    assert os.listdir(store_folder) == []
+    monkeypatch.undo()
+
+    # A keypoint file with another number of body joints
+    coco19_fn = write_keypoints(str(tmpdir.mkdir('coco19')),
+                                num_body_joints=19)[-2]
+    os.rename(coco19_fn, osp.join(keyp_folder, 'g000_keypoints.json'))
+    with pytest.raises(ValueError):
+        compile_keypoint_store(keyp_folder, store_folder, chunk_size=3)
+    assert os.listdir(store_folder) == []
+
+
+def test_stale_keypoint_store_is_compiled_again(tmpdir, monkeypatch):
+    data_folder = str(tmpdir)
+    write_images(str(tmpdir.mkdir('images')), 7)
+    keyp_folder = str(tmpdir.mkdir('keypoints'))
+    keypoint_fns = write_keypoints(keyp_folder)
+
+    compiled = []
+    compile_store = keypoint_store.compile_keypoint_store
+
+    def record_compile(keyp_folder, store_folder, **kwargs):
+        compiled.append(store_folder)
+        return compile_store(keyp_folder, store_folder, **kwargs)
+
+    monkeypatch.setattr(data_parser, 'compile_keypoint_store',
+                        record_compile)
+
+    def read_frame(idx):
+        dataset = OpenPose(data_folder, keypoint_store='store')
+        return dataset.keypoint_store.read(
+            'f{:03d}'.format(idx), use_hands=False, use_face=False)[0]
+
+    read_frame(2)
+    assert len(compiled) == 1
+    # No temporary file is left behind
+    assert sorted(os.listdir(str(tmpdir.join('store')))) == [
+        'index.npz', 'keypoints.bin']
+    # The store is up to date, so it is only read
+    read_frame(2)
+    assert len(compiled) == 1
+
+    # OpenPose is run again on a frame
+    keypoint_fns = write_keypoints(keyp_folder, seed=1)
+    stat = os.stat(keypoint_fns[2])
+    os.utime(keypoint_fns[2], (stat.st_atime, stat.st_mtime + 10))
+    keypoints = read_frame(2)
+    assert len(compiled) == 2
+    np.testing.assert_array_equal(
+        keypoints, read_keypoints(keypoint_fns[2], use_hands=False,
+                                  use_face=False).keypoints)
+
+    # A keypoint file is removed
+    os.remove(keypoint_fns[-1])
+    read_frame(2)
+    assert len(compiled) == 3
+    assert len(KeypointStore(str(tmpdir.join('store')))) == 6
+
+
+def test_read_items_without_image_folder(tmpdir):
+    keypoint_fns = write_keypoints(str(tmpdir.mkdir('keypoints')))
+    img_fn = write_image(str(tmpdir), 1)
+
+    dataset = OpenPose(str(tmpdir), list_frames=False)
+    assert len(dataset) == 0
+    # The image folder is neither listed nor created
+    assert not osp.exists(str(tmpdir.join('images')))
+
+    item = dataset.read_item(img_fn, keypoint_fn=keypoint_fns[2])
+    assert item['img'].shape == cv2.imread(img_fn).shape
+    np.testing.assert_array_equal(
+        item['keypoints'], read_keypoints(keypoint_fns[2], use_hands=False,
+                                          use_face=False).keypoints)
+
+
+@pytest.mark.parametrize('num_shards', [1, 2, 3, 7, 10])
+@pytest.mark.parametrize('start_idx,end_idx', [(0, None), (2, -1), (3, 8)])
+def test_shards_cover_the_range(num_shards, start_idx, end_idx):
+    num_frames = 9
+    frames = select_frames(num_frames, start_idx=start_idx, end_idx=end_idx)
+    assert list(frames) == list(range(num_frames))[start_idx:end_idx]
+
+    shards = [select_frames(num_frames, start_idx=start_idx,
+                            end_idx=end_idx,
+                            shard='{}/{}'.format(shard_idx, num_shards))
+              for shard_idx in range(num_shards)]
+    # The shards are contiguous blocks of nearly equal size, in order
+    assert sum((list(shard) for shard in shards), []) == list(frames)
+    sizes = [len(shard) for shard in shards]
+    assert max(sizes) - min(sizes) <= 1
+
+
+@pytest.mark.parametrize('shard', ['2/2', '-1/2', '0/0', '1', 'a/b'])
+def test_invalid_shard(shard):
+    with pytest.raises(ValueError):
+        select_frames(5, shard=shard)
+
+
+def test_shards_do_not_depend_on_listing_order(tmpdir, monkeypatch):
+    data_folder = str(tmpdir)
+    img_fns = write_images(str(tmpdir.mkdir('images')), 11)
+    num_shards = 3
+
+    def shard_paths():
+        return [OpenPose(data_folder, shard='{}/{}'.format(
+            shard_idx, num_shards)).img_paths
+            for shard_idx in range(num_shards)]
+
+    shards = shard_paths()
+    scandir = os.scandir
+
+    def reversed_scandir(path):
+        with scandir(path) as entries:
+            return iter(sorted(entries, key=lambda entry: entry.name,
+                               reverse=True))
+
+    monkeypatch.setattr(os, 'scandir', reversed_scandir)
+    assert shard_paths() == shards
+
+    all_paths = sum(shards, [])
+    assert len(set(all_paths)) == len(all_paths)
+    assert [osp.basename(path) for path in all_paths] == img_fns
+
+
+def test_cached_index_is_read_back(tmpdir, monkeypatch):
+    img_folder = str(tmpdir.mkdir('images'))
+    img_fns = write_images(img_folder, 5)
+    index_fn = str(tmpdir.join('img_index.txt'))
+
+    assert list_images(img_folder, index_fn=index_fn) == img_fns
+    assert osp.exists(index_fn)
+    # No temporary file is left behind
+    assert sorted(os.listdir(str(tmpdir))) == ['images', 'img_index.txt']
+
+    # The folder did not change, so it is not listed again
+    scandir = os.scandir
+    listed = []
+
+    def record_scandir(path):
+        listed.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', record_scandir)
+    assert list_images(img_folder, index_fn=index_fn) == img_fns
+    dataset = OpenPose(str(tmpdir), img_index='img_index.txt',
+                       shard='1/2')
+    assert [osp.basename(path) for path in dataset.img_paths] == \
+        img_fns[2:]
+    assert listed == []
+
+    # Images are removed and added, so the folder is listed and the index
+    # written again
+    new_fns = write_images(img_folder, 7)[1:]
+    os.remove(osp.join(img_folder, img_fns[0]))
+    stat = os.stat(img_folder)
+    os.utime(img_folder, (stat.st_atime, stat.st_mtime + 10))
+    assert list_images(img_folder, index_fn=index_fn) == new_fns
+    assert listed == [img_folder]
+    assert list_images(img_folder, index_fn=index_fn) == new_fns
+    assert listed == [img_folder]
+
+
+class RecordingDataset(object):
+    ''' Records the frames that are read, and fails for some of them '''
+
+    def __init__(self, dataset, failing_idx=None):
+        self.dataset = dataset
+        self.failing_idx = failing_idx
+        self.started = []
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        self.started.append(idx)
+        if idx == self.failing_idx:
+            raise IOError('Could not read frame {}'.format(idx))
+        # Reading takes longer than the fitting below
+        time.sleep(0.01)
+        return self.dataset[idx]
+
+
+def create_frames(tmpdir, num_frames=7):
+    ''' Writes a folder of images and keypoints and returns its dataset '''
+    img_folder = str(tmpdir.mkdir('images'))
+    for idx in range(num_frames):
+        img_fn = write_image(img_folder, None, ext='.png')
+        os.rename(img_fn, osp.join(img_folder, 'f{:03d}.png'.format(idx)))
+    write_keypoints(str(tmpdir.mkdir('keypoints')), num_frames=num_frames)
+    return OpenPose(str(tmpdir))
+
+
+def assert_same_frames(frames, expected):
+    assert len(frames) == len(expected)
+    for data, expected_data in zip(frames, expected):
+        assert sorted(data.keys()) == sorted(expected_data.keys())
+        if len(data) > 0:
+            assert data['fn'] == expected_data['fn']
+            np.testing.assert_array_equal(data['keypoints'],
+                                          expected_data['keypoints'])
+
+
+@pytest.mark.parametrize('num_prefetch,num_threads', [(1, 1), (3, 2),
+                                                      (10, 4)])
+def test_prefetched_frames_are_in_order(tmpdir, num_prefetch, num_threads):
+    dataset = create_frames(tmpdir)
+    recording = RecordingDataset(dataset)
+    prefetcher = FramePrefetcher(recording, num_prefetch=num_prefetch,
+                                 num_threads=num_threads)
+    assert prefetcher.summary() == 'No frames were read'
+
+    frames = []
+    for data in prefetcher:
+        # Only the next frames are read ahead of the current one
+        assert max(recording.started) < len(frames) + 1 + num_prefetch
+        frames.append(data)
+    assert_same_frames(frames, [dataset[idx] for idx in range(len(dataset))])
+    assert sorted(recording.started) == list(range(len(dataset)))
+
+    assert [timing['index'] for timing in prefetcher.timings] == \
+        list(range(len(dataset)))
+    assert all(timing['read_time'] >= 0.01 and timing['wait_time'] >= 0
+               for timing in prefetcher.timings)
+    assert prefetcher.summary().startswith(
+        'Read {} frames'.format(len(dataset)))
+
+
+def test_prefetched_indices(tmpdir):
+    dataset = create_frames(tmpdir)
+    indices = [4, 1, 5, 0]
+    # The indices can be an iterator, e.g. over a queue of frames
+    prefetcher = FramePrefetcher(dataset, indices=iter(indices),
+                                 num_prefetch=2)
+    assert_same_frames(list(prefetcher),
+                       [dataset[idx] for idx in indices])
+    assert [timing['index'] for timing in prefetcher.timings] == indices
+
+
+def test_failed_read_is_raised(tmpdir):
+    dataset = RecordingDataset(create_frames(tmpdir), failing_idx=3)
+    prefetcher = FramePrefetcher(dataset, num_prefetch=2)
+
+    frames = []
+    with pytest.raises(IOError, match='frame 3'):
+        for data in prefetcher:
+            frames.append(data)
+    # The frames before the failing one are returned
+    assert len(frames) == 3
+
+
+def test_undetected_face_is_zero_in_store(tmpdir):
+    create_frames(tmpdir)
+    # The face was never detected in the capture
+    keyp_folder = str(tmpdir.join('keypoints'))
+    for keypoint_fn in os.listdir(keyp_folder):
+        keypoint_fn = osp.join(keyp_folder, keypoint_fn)
+        with open(keypoint_fn) as keypoint_file:
+            data = json.load(keypoint_file)
+        for person_data in data['people']:
+            person_data['face_keypoints_2d'] = [0.0] * (70 * 3)
+        with open(keypoint_fn, 'w') as keypoint_file:
+            json.dump(data, keypoint_file)
+
+    flags = dict(use_hands=True, use_face=True, use_face_contour=True)
+    store_dataset = OpenPose(str(tmpdir), keypoint_store='store', **flags)
+    json_dataset = OpenPose(str(tmpdir), **flags)
+    frames = [store_dataset[idx] for idx in range(len(store_dataset))]
+    assert_same_frames(frames, [json_dataset[idx]
+                                for idx in range(len(json_dataset))])
+    assert any(len(data) > 0 for data in frames)
+
+
+def test_workers_open_the_checked_store(tmpdir, monkeypatch):
+    data_folder = str(tmpdir)
+    write_images(str(tmpdir.mkdir('images')), 7)
+    keypoint_fns = write_keypoints(str(tmpdir.mkdir('keypoints')))
+
+    checked = []
+    is_stale = data_parser.is_stale_store
+
+    def record_check(keyp_folder, store_folder):
+        checked.append(store_folder)
+        return is_stale(keyp_folder, store_folder)
+
+    monkeypatch.setattr(data_parser, 'is_stale_store', record_check)
+    OpenPose(data_folder, keypoint_store='store')
+    assert len(checked) == 1
+
+    # The keypoint files are not listed again for the datasets of the
+    # workers
+    dataset = OpenPose(data_folder, keypoint_store='store',
+                       check_store=False)
+    assert len(checked) == 1
+    keypoints = dataset.keypoint_store.read('f002', use_hands=False,
+                                            use_face=False)[0]
+    np.testing.assert_array_equal(
+        keypoints, read_keypoints(keypoint_fns[2], use_hands=False,
+                                  use_face=False).keypoints)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+import os.path as osp
+import queue
+import threading
+import time
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+pytest.importorskip('smplx')
+pytest.importorskip('human_body_prior')
+
+import main  # noqa: E402
+import utils  # noqa: E402
+
+
+class BatchModule(nn.Module):
+    def __init__(self, batch_size):
+        super(BatchModule, self).__init__()
+        self.batch_size = batch_size
+        self.param = nn.Parameter(torch.zeros([batch_size, 3]))
+
+
+def create_frames(num_frames, num_persons=2):
+    return [{'fn': 'f{:03d}'.format(idx),
+             'img_path': 'f{:03d}.png'.format(idx),
+             'img': np.zeros([10, 10, 3], dtype=np.float32),
+             'keypoints': np.ones([num_persons, 25, 3], dtype=np.float32)}
+            for idx in range(num_frames)]
+
+
+def test_failed_job_does_not_resize_the_next_one(tmpdir, monkeypatch):
+    batch_size = 2
+    models = {'body_models': {'neutral': BatchModule(batch_size)},
+              'camera': BatchModule(batch_size), 'joint_regressors': {},
+              'joint_weights': None, 'vposer': None}
+    for name in ['shape_prior', 'expr_prior', 'body_pose_prior',
+                 'left_hand_prior', 'right_hand_prior', 'jaw_prior',
+                 'angle_prior']:
+        models[name] = None
+
+    def failing_fit(img, keypoints, body_model, camera, **kwargs):
+        # Fails after adding the rows of the flipped orientations
+        rows = torch.arange(body_model.batch_size + 1) % body_model.batch_size
+        utils.index_batch(body_model, rows)
+        utils.index_batch(camera, rows)
+        raise RuntimeError('The line search failed')
+
+    fitted_sizes = []
+
+    def fit(img, keypoints, body_model, camera, batch_size=1, **kwargs):
+        assert body_model.batch_size == batch_size
+        assert camera.batch_size == batch_size
+        fitted_sizes.append(len(keypoints))
+        return {}
+
+    fit_args = dict(output_folder=str(tmpdir),
+                    result_folder=str(tmpdir.join('results')),
+                    mesh_folder=str(tmpdir.join('meshes')),
+                    batch_size=batch_size)
+    monkeypatch.setattr(main, 'fit_single_frame', failing_fit)
+    with pytest.raises(RuntimeError):
+        main.fit_frames(create_frames(1), models, **fit_args)
+    assert models['body_models']['neutral'].batch_size == batch_size + 1
+
+    monkeypatch.setattr(main, 'fit_single_frame', fit)
+    output_fns = main.fit_frames(create_frames(2), models, **fit_args)
+    assert fitted_sizes == [batch_size, batch_size]
+    assert len(output_fns) == 4
+
+
+def test_windows_follow_the_persons(tmpdir, monkeypatch):
+    models = {'body_models': {'neutral': BatchModule(2)},
+              'camera': BatchModule(2), 'joint_regressors': {},
+              'joint_weights': None, 'vposer': None}
+    for name in ['shape_prior', 'expr_prior', 'body_pose_prior',
+                 'left_hand_prior', 'right_hand_prior', 'jaw_prior',
+                 'angle_prior']:
+        models[name] = None
+
+    # OpenPose swaps the order of the two persons in every other frame, and
+    # finds nobody in the fourth frame
+    frames = create_frames(6)
+    for idx, data in enumerate(frames):
+        data['keypoints'][:, :, 0] += np.linspace(0, 20, 25)
+        data['keypoints'][1 - idx % 2, :, 0] += 1000
+    frames[3] = {}
+
+    windows = []
+
+    def fit(img, keypoints, body_model, camera, batch_size=1, **kwargs):
+        assert body_model.batch_size == batch_size == len(keypoints)
+        windows.append((kwargs['result_fn'], keypoints[:, 0, 0]))
+        return {}
+
+    monkeypatch.setattr(main, 'fit_single_frame', fit)
+    main.fit_frames(frames, models, output_folder=str(tmpdir),
+                    result_folder=str(tmpdir.join('results')),
+                    mesh_folder=str(tmpdir.join('meshes')),
+                    window_size=3, window_stride=1)
+
+    fitted = set()
+    for result_fns, positions in windows:
+        # Every window holds one person in consecutive frames
+        assert np.ptp(positions) < 1
+        frame_idxs = [int(osp.basename(osp.dirname(result_fn))[1:])
+                      for result_fn in result_fns]
+        assert frame_idxs == list(range(frame_idxs[0],
+                                        frame_idxs[0] + len(frame_idxs)))
+        fitted.update(zip(frame_idxs, positions))
+    assert len(fitted) == 2 * 5
+
+
+def test_sequence_follows_the_persons(tmpdir, monkeypatch):
+    models = {'body_models': {'neutral': BatchModule(1)},
+              'camera': BatchModule(1), 'joint_regressors': {},
+              'joint_weights': None, 'vposer': None}
+    for name in ['shape_prior', 'expr_prior', 'body_pose_prior',
+                 'left_hand_prior', 'right_hand_prior', 'jaw_prior',
+                 'angle_prior']:
+        models[name] = None
+
+    # OpenPose swaps the order of the two persons in the second frame, and
+    # finds nobody in the third one
+    frames = create_frames(4)
+    for idx, data in enumerate(frames):
+        data['keypoints'][:, :, 0] += np.linspace(0, 20, 25)
+        data['keypoints'][1 if idx == 1 else 0, :, 0] += 1000
+    frames[2] = {}
+
+    fits = []
+
+    def fit(img, keypoints, body_model, camera, init_params=None, **kwargs):
+        position = float(keypoints[0, 0, 0])
+        fits.append((position, init_params))
+        return {'position': np.array([[position]])}
+
+    monkeypatch.setattr(main, 'fit_single_frame', fit)
+    main.fit_frames(frames, models, output_folder=str(tmpdir),
+                    result_folder=str(tmpdir.join('results')),
+                    mesh_folder=str(tmpdir.join('meshes')), sequence=True)
+
+    assert len(fits) == 6
+    # Every person of the second frame starts from its own fit
+    for position, init_params in fits[2:4]:
+        assert init_params['position'][0, 0] == position
+    # The persons after the empty frame are fitted from scratch
+    for position, init_params in fits[:2] + fits[4:]:
+        assert init_params is None
+
+
+class ThreadContext(object):
+    ''' Runs the worker processes of main as threads of the test, which
+        see its monkeypatches
+    '''
+
+    def __init__(self):
+        self.queues = []
+
+    def Queue(self):
+        self.queues.append(queue.Queue())
+        return self.queues[-1]
+
+    def Process(self, target, args):
+        return WorkerThread(target, args)
+
+
+class WorkerThread(threading.Thread):
+    def __init__(self, target, args):
+        super(WorkerThread, self).__init__()
+        self.worker_target = target
+        self.worker_args = args
+        self.exitcode = None
+
+    def run(self):
+        try:
+            self.worker_target(*self.worker_args)
+            self.exitcode = 0
+        except Exception:
+            self.exitcode = 1
+            raise
+
+
+def test_workers_fit_every_frame_once(tmpdir, monkeypatch):
+    num_frames, num_workers = 11, 2
+    frames = create_frames(num_frames)
+    context = ThreadContext()
+    monkeypatch.setattr(main.mp, 'get_context', lambda method: context)
+    monkeypatch.setattr(main.mp, 'cpu_count', lambda: 8)
+    dataset_args = []
+
+    def create_dataset(**kwargs):
+        dataset_args.append(kwargs)
+        return frames
+
+    monkeypatch.setattr(main, 'create_dataset', create_dataset)
+    monkeypatch.setattr(main, 'load_models',
+                        lambda dataset_obj, **kwargs: {})
+
+    num_threads = []
+    monkeypatch.setattr(main.torch, 'set_num_threads', num_threads.append)
+    monkeypatch.setattr(main.torch, 'set_num_interop_threads',
+                        lambda num_threads: None)
+
+    fitted = []
+    lock = threading.Lock()
+
+    def fit_frames(frames, models, **kwargs):
+        for data in frames:
+            # The other worker takes the next frames meanwhile
+            time.sleep(0.01)
+            with lock:
+                fitted.append((threading.current_thread().name, data['fn']))
+
+    monkeypatch.setattr(main, 'fit_frames', fit_frames)
+    main.main(output_folder=str(tmpdir), use_cuda=False,
+              num_workers=num_workers, prefetch_frames=4)
+
+    # Every frame is fitted exactly once, and both workers fitted some
+    assert sorted(fn for _, fn in fitted) == [data['fn'] for data in frames]
+    assert len(set(name for name, _ in fitted)) == num_workers
+    # Every worker stopped at its own None, which leaves the queue empty
+    frame_queue, = context.queues
+    assert frame_queue.empty()
+    # Only the main process checks whether the keypoint store is stale
+    assert [kwargs.get('check_store', True) for kwargs in dataset_args] == \
+        [True] + [False] * num_workers
+    # The cores are split among the workers
+    assert num_threads == [8 // num_workers] * num_workers
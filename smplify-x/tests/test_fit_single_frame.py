@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+smplx = pytest.importorskip('smplx')
+
+import fitting  # noqa: E402
+from camera import create_camera  # noqa: E402
+from fit_single_frame import fit_single_frame  # noqa: E402
+from prior import L2Prior, SMPLifyAnglePrior  # noqa: E402
+from utils import JointMapper, smpl_to_openpose  # noqa: E402
+
+NUM_PERSONS = 3
+NUM_JOINTS = 25
+IMG_SIZE = 1000
+FOCAL_LENGTH = 5000.0
+
+
+def create_model(model_folder, batch_size):
+    joint_mapper = JointMapper(smpl_to_openpose(
+        'smplx', use_hands=False, use_face=False))
+    return smplx.create(model_folder, model_type='smplx', ext='npz',
+                        joint_mapper=joint_mapper, batch_size=batch_size,
+                        dtype=torch.float64)
+
+
+def create_keypoints(model_folder):
+    ''' Projects the joints of randomly posed bodies, with some noise '''
+    generator = torch.Generator().manual_seed(0)
+    body_model = create_model(model_folder, NUM_PERSONS)
+    camera = create_camera(batch_size=NUM_PERSONS, dtype=torch.float64,
+                           focal_length_x=FOCAL_LENGTH,
+                           focal_length_y=FOCAL_LENGTH,
+                           center=torch.full([NUM_PERSONS, 2], IMG_SIZE / 2,
+                                             dtype=torch.float64))
+    with torch.no_grad():
+        body_model.body_pose[:] = 0.2 * torch.randn(
+            body_model.body_pose.shape, generator=generator,
+            dtype=torch.float64)
+        body_model.global_orient[:] = torch.tensor(
+            [[np.pi, 0.0, 0.0], [np.pi, 0.4, 0.0], [np.pi, -0.3, 0.2]],
+            dtype=torch.float64)
+        camera.translation[:] = torch.tensor(
+            [[0.1, 0.0, 20.0], [-0.2, 0.1, 25.0], [0.0, 0.2, 18.0]],
+            dtype=torch.float64)
+        joints_2d = camera(body_model(return_verts=False).joints)
+        joints_2d += 2.0 * torch.randn(joints_2d.shape, generator=generator,
+                                       dtype=torch.float64)
+    return np.concatenate([joints_2d.numpy(),
+                           np.ones([NUM_PERSONS, NUM_JOINTS, 1])], axis=-1)
+
+
+def fit(model_folder, body_pose_prior, keypoints, result_folder, **kwargs):
+    ''' Fits the keypoints and returns the results of every person '''
+    batch_size = keypoints.shape[0]
+    result_fn = [str(result_folder / '{:03d}.pkl'.format(idx))
+                 for idx in range(batch_size)]
+    body_model = create_model(model_folder, batch_size)
+    camera = create_camera(batch_size=batch_size, dtype=torch.float64,
+                           focal_length_x=FOCAL_LENGTH,
+                           focal_length_y=FOCAL_LENGTH)
+    img = np.zeros([IMG_SIZE, IMG_SIZE, 3], dtype=np.float32)
+    fit_args = dict(
+        joint_weights=torch.ones([1, NUM_JOINTS], dtype=torch.float64),
+        body_pose_prior=body_pose_prior, jaw_prior=None,
+        left_hand_prior=None, right_hand_prior=None,
+        shape_prior=L2Prior(dtype=torch.float64), expr_prior=None,
+        angle_prior=SMPLifyAnglePrior(dtype=torch.float64),
+        result_fn=result_fn, mesh_fn=[None] * batch_size,
+        out_img_fn=[None] * batch_size, use_cuda=False, use_face=False,
+        use_hands=False, use_vposer=False, use_joints_conf=True,
+        interactive=False, visualize=False, save_meshes=False,
+        batch_size=batch_size, dtype=torch.float64, model_type='smplx',
+        data_weights=[1, 1], body_pose_prior_weights=[4.04e2, 57.4],
+        shape_weights=[1e2, 1e1], optim_type='lbfgsls', lr=1.0,
+        maxiters=4, ftol=1e-9, gtol=1e-9, focal_length=FOCAL_LENGTH,
+        body_tri_idxs=[(5, 12), (2, 9)])
+    fit_args.update(kwargs)
+    fit_single_frame(img, keypoints, body_model=body_model, camera=camera,
+                     **fit_args)
+    results = []
+    for fn in result_fn:
+        with open(fn, 'rb') as result_file:
+            results.append(pickle.load(result_file))
+    return results
+
+
+@pytest.mark.parametrize('optim_type,lr', [('adam', 1e-2),
+                                            ('lbfgsls', 1.0)])
+@pytest.mark.parametrize('side_view_thsh', [0.0, 1e4])
+def test_batch_matches_separate_fits(model_folder, body_pose_prior,
+                                     optim_type, lr, side_view_thsh,
+                                     tmp_path):
+    # With the larger threshold every person is also fitted with the
+    # flipped orientation. The fits only differ by the rounding of the
+    # batched sums, which the line searches amplify over the iterations.
+    keypoints = create_keypoints(model_folder)
+    results = fit(model_folder, body_pose_prior, keypoints, tmp_path,
+                  optim_type=optim_type, lr=lr,
+                  side_view_thsh=side_view_thsh)
+
+    for idx in range(NUM_PERSONS):
+        single_result, = fit(model_folder, body_pose_prior,
+                             keypoints[idx:idx + 1], tmp_path,
+                             optim_type=optim_type, lr=lr,
+                             side_view_thsh=side_view_thsh)
+        for key in ['global_orient', 'body_pose', 'betas',
+                    'camera_translation']:
+            assert np.allclose(results[idx][key], single_result[key],
+                               rtol=1e-5, atol=1e-5), \
+                'The {} of person {} differs'.format(key, idx)
+
+
+def test_converged_sample_stops_updating(model_folder, body_pose_prior,
+                                         monkeypatch, tmp_path):
+    # The parameters and the active samples of every batched run, at the
+    # start of each optimizer step
+    runs = []
+    run_batch_fitting = fitting.FittingMonitor.run_batch_fitting
+
+    def record_batch_fitting(self, optimizer, closure, params, *args,
+                             **kwargs):
+        iterates, active = [], []
+        step = optimizer.step
+
+        def record_step(closure):
+            iterates.append([param.detach().clone() for param in params])
+            active.append(self.active.clone())
+            return step(closure)
+
+        optimizer.step = record_step
+        loss = run_batch_fitting(self, optimizer, closure, params, *args,
+                                 **kwargs)
+        iterates.append([param.detach().clone() for param in params])
+        runs.append((iterates, active))
+        return loss
+
+    monkeypatch.setattr(fitting.FittingMonitor, 'run_batch_fitting',
+                        record_batch_fitting)
+    keypoints = create_keypoints(model_folder)
+    fit(model_folder, body_pose_prior, keypoints, tmp_path,
+        side_view_thsh=0.0, maxiters=10, ftol=1e-3)
+
+    num_early = 0
+    for iterates, active in runs:
+        final = iterates[-1]
+        for step_idx, step_active in enumerate(active):
+            for idx in np.nonzero(~step_active.numpy())[0]:
+                num_early += 1
+                # Once a sample has converged its parameters do not change
+                assert all(torch.equal(param[idx], final_param[idx])
+                           for param, final_param in
+                           zip(iterates[step_idx], final))
+    # Some samples converged while the others were still fitted
+    assert num_early > 0
+
+
+@pytest.mark.parametrize('orient_stop_ratio', [0.0, 1.0])
+def test_orientation_hypotheses_are_pruned(model_folder, body_pose_prior,
+                                           monkeypatch, tmp_path,
+                                           orient_stop_ratio):
+    # The global orientation at the start and at the end of every body
+    # stage, with the final loss of every row of the batch
+    stages = []
+    run_batch_fitting = fitting.FittingMonitor.run_batch_fitting
+
+    def record_batch_fitting(self, optimizer, closure, params, body_model,
+                             *args, **kwargs):
+        start = body_model.global_orient.detach().clone()
+        loss = run_batch_fitting(self, optimizer, closure, params,
+                                 body_model, *args, **kwargs)
+        if any(param is body_model.body_pose for param in params):
+            stages.append((start, body_model.global_orient.detach().clone(),
+                           loss.detach().clone()))
+        return loss
+
+    monkeypatch.setattr(fitting.FittingMonitor, 'run_batch_fitting',
+                        record_batch_fitting)
+    keypoints = create_keypoints(model_folder)
+    # Every person is fitted with both orientations
+    fit(model_folder, body_pose_prior, keypoints, tmp_path,
+        side_view_thsh=1e4, orient_stop_ratio=orient_stop_ratio)
+
+    assert len(stages) == 2
+    (_, first_orient, first_loss), (second_start, _, _) = stages
+    assert len(first_loss) == 2 * NUM_PERSONS
+    if orient_stop_ratio <= 0:
+        # Both orientations are fitted until the end
+        assert torch.equal(second_start, first_orient)
+        return
+
+    # Only the hypothesis with the lower loss of every person goes on to the
+    # next stage. The flipped rows follow the original ones.
+    kept_rows = [idx if first_loss[idx] < first_loss[idx + NUM_PERSONS]
+                 else idx + NUM_PERSONS for idx in range(NUM_PERSONS)]
+    assert torch.equal(second_start, first_orient[kept_rows])
+
+
+def test_dropped_hypotheses_keep_optimizer_state(model_folder,
+                                                 body_pose_prior,
+                                                 monkeypatch, tmp_path):
+    # The optimizer of every run with the state it starts and ends with
+    runs = []
+    run_fitting = fitting.FittingMonitor.run_fitting
+
+    def copy_state(optimizer):
+        state = optimizer.state.get(optimizer.param_groups[0]['params'][0],
+                                    {})
+        return {key: val.clone() for key, val in state.items()
+                if torch.is_tensor(val)}
+
+    def record_fitting(self, optimizer, *args, **kwargs):
+        start_state = copy_state(optimizer)
+        loss = run_fitting(self, optimizer, *args, **kwargs)
+        runs.append((optimizer, start_state, copy_state(optimizer)))
+        return loss
+
+    monkeypatch.setattr(fitting.FittingMonitor, 'run_fitting',
+                        record_fitting)
+    keypoints = create_keypoints(model_folder)
+    # Every person is fitted with both orientations, and the worse one is
+    # dropped after the first stage
+    results = fit(model_folder, body_pose_prior, keypoints, tmp_path,
+                  side_view_thsh=1e4, orient_stop_ratio=1.0,
+                  keep_optim_state=True)
+    assert len(results) == NUM_PERSONS
+
+    (first, _, end_state), (second, start_state, _) = runs[-2:]
+    # The optimizer of the body is reused with the rows of the kept
+    # hypotheses, and its history is carried over to the next stage
+    assert second is first
+    assert second._batch_size == NUM_PERSONS
+    assert end_state['hist_len'].shape[0] == 2 * NUM_PERSONS
+    kept_rows = [row for row in range(2 * NUM_PERSONS)
+                 if any(torch.equal(end_state['old_dirs'][row],
+                                    start_state['old_dirs'][kept])
+                        for kept in range(NUM_PERSONS))]
+    assert len(kept_rows) == NUM_PERSONS
+    # Every person keeps one of its two hypotheses
+    assert sorted(row % NUM_PERSONS for row in kept_rows) == list(
+        range(NUM_PERSONS))
+    for key in ['hist_len', 'hist_head', 'ro', 'old_dirs', 'old_stps',
+                'H_diag', 'prev_flat_grad']:
+        assert start_state[key].shape[0] == NUM_PERSONS, key
+        assert torch.equal(start_state[key], end_state[key][kept_rows]), key
+    # Only the samples without any history start over
+    assert torch.equal(start_state['skip_update'],
+                       start_state['hist_len'] > 0)
+    assert torch.all(start_state['hist_len'] > 0)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+import fitting
+import utils
+
+
+class LinearModel(nn.Module):
+    ''' A body model whose output is its parameter '''
+
+    def __init__(self, batch_size=2):
+        super(LinearModel, self).__init__()
+        self.batch_size = batch_size
+        self.faces_tensor = torch.zeros([1, 3], dtype=torch.long)
+        self.x = nn.Parameter(torch.arange(
+            batch_size * 3, dtype=torch.float64).view(batch_size, 3))
+
+    def forward(self, **kwargs):
+        return self.x
+
+
+class SquaredLoss(object):
+    ''' The squared distance of the model output to a target '''
+
+    def residual_blocks(self, body_model_output, **kwargs):
+        return OrderedDict(data=body_model_output - 1.0)
+
+    def reduce_residuals(self, blocks):
+        return sum(fitting.block_losses(blocks).values()).sum()
+
+
+def evaluate(monkeypatch, compile_function):
+    ''' Evaluates a compiled closure three times '''
+    monkeypatch.setattr(utils, 'compile_function', compile_function)
+    body_model = LinearModel()
+    optimizer = torch.optim.SGD(body_model.parameters(), lr=0.1)
+    monitor = fitting.FittingMonitor(batch_size=2, compile_closure=True)
+    losses, grads = [], []
+    with monitor:
+        closure = monitor.create_fitting_closure(optimizer, body_model,
+                                                 loss=SquaredLoss())
+        for _ in range(3):
+            losses.append(closure().item())
+            grads.append(body_model.x.grad.clone())
+    return losses, grads
+
+
+def test_failed_compilation_falls_back_to_eager(monkeypatch):
+    eager_losses, eager_grads = evaluate(monkeypatch, lambda func: None)
+    assert eager_losses[0] == ((torch.arange(6.0) - 1) ** 2).sum().item()
+
+    calls = []
+
+    def compile_function(func):
+        def compiled():
+            calls.append(func)
+            raise RuntimeError('Unsupported operator')
+        return compiled
+
+    losses, grads = evaluate(monkeypatch, compile_function)
+    # The compiled function is only tried once, and the closure returns the
+    # eager results
+    assert len(calls) == 1
+    assert losses == eager_losses
+    for grad, eager_grad in zip(grads, eager_grads):
+        assert torch.equal(grad, eager_grad)
+
+
+def test_compiled_function_is_kept(monkeypatch):
+    calls = []
+
+    def compile_function(func):
+        def compiled():
+            calls.append(func)
+            return func()
+        return compiled
+
+    evaluate(monkeypatch, compile_function)
+    assert len(calls) == 3
+
+
+def test_compile_function_without_compiler(monkeypatch):
+    monkeypatch.delattr(torch, 'compile', raising=False)
+    assert utils.compile_function(lambda: None) is None
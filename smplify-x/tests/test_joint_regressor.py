@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+import os.path as osp
+from collections import OrderedDict
+
+import pytest
+import torch
+
+smplx = pytest.importorskip('smplx')
+
+import fitting  # noqa: E402
+from joint_regressor import JointRegressor, create_joint_regressor  # noqa
+from utils import JointMapper, smpl_to_openpose  # noqa: E402
+
+
+def create_model(model_folder, batch_size=4, use_face=True,
+                 use_face_contour=True, use_pca=True):
+    joint_mapper = JointMapper(smpl_to_openpose(
+        'smplx', use_hands=True, use_face=use_face,
+        use_face_contour=use_face_contour))
+    return smplx.create(model_folder, model_type='smplx', ext='npz',
+                        joint_mapper=joint_mapper, batch_size=batch_size,
+                        use_face_contour=use_face_contour, use_pca=use_pca,
+                        num_pca_comps=12, dtype=torch.float64)
+
+
+def randomize(body_model, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        for param in [body_model.betas, body_model.expression,
+                      body_model.global_orient, body_model.body_pose,
+                      body_model.jaw_pose, body_model.left_hand_pose,
+                      body_model.right_hand_pose, body_model.transl]:
+            param.copy_(0.3 * torch.randn(param.shape, generator=generator,
+                                          dtype=param.dtype))
+        # Turn the head to either side, to select different triangles for
+        # the landmarks of the contour of the face
+        body_model.body_pose[:, 11 * 3 + 1] = torch.linspace(
+            -1.2, 1.2, body_model.batch_size)
+
+
+class JointsLoss(object):
+    ''' The squared distance of the joints of the model to a target '''
+
+    def __init__(self, target):
+        self.target = target
+
+    def residual_blocks(self, body_model_output, **kwargs):
+        return OrderedDict(data=body_model_output.joints - self.target)
+
+    def reduce_residuals(self, blocks):
+        return sum(fitting.block_losses(blocks).values()).sum()
+
+
+def evaluate_closure(body_model, joint_regressor, target):
+    ''' Returns the loss and the gradients of a closure of a stage that
+        does not need the vertices
+    '''
+    params = [body_model.betas, body_model.body_pose,
+              body_model.global_orient]
+    optimizer = torch.optim.SGD(params, lr=0.1)
+    monitor = fitting.FittingMonitor(batch_size=body_model.batch_size)
+    with monitor:
+        closure = monitor.create_fitting_closure(
+            optimizer, body_model, loss=JointsLoss(target),
+            return_verts=False, joint_regressor=joint_regressor)
+        loss = closure()
+    return loss.detach(), [param.grad.clone() for param in params]
+
+
+@pytest.mark.parametrize('use_face,use_face_contour,use_pca', [
+    (True, True, True), (True, False, False), (False, False, True)])
+def test_matches_body_model(model_folder, use_face, use_face_contour,
+                            use_pca):
+    body_model = create_model(model_folder, use_face=use_face,
+                              use_face_contour=use_face_contour,
+                              use_pca=use_pca)
+    randomize(body_model)
+    regressor = create_joint_regressor(body_model)
+    assert regressor is not None
+
+    output = regressor(body_model, return_full_pose=True)
+    model_output = body_model(return_verts=False, return_full_pose=True)
+    assert output.vertices is None
+    assert output.joints.shape == model_output.joints.shape
+    assert torch.allclose(output.joints, model_output.joints, atol=1e-8)
+    assert torch.allclose(output.full_pose, model_output.full_pose)
+
+    # The pose and the shape given by the fitting closures
+    generator = torch.Generator().manual_seed(1)
+    body_pose = 0.3 * torch.randn(body_model.body_pose.shape,
+                                  generator=generator, dtype=torch.float64)
+    betas = 0.5 * torch.randn(body_model.betas.shape, generator=generator,
+                              dtype=torch.float64)
+    output = regressor(body_model, body_pose=body_pose, betas=betas)
+    model_output = body_model(body_pose=body_pose, betas=betas,
+                              return_verts=False)
+    assert torch.allclose(output.joints, model_output.joints, atol=1e-8)
+
+
+def test_stale_cache_is_rebuilt(model_folder, tmpdir, monkeypatch):
+    cache_folder = str(tmpdir.join('joint_regressors'))
+    body_model = create_model(model_folder)
+    randomize(body_model)
+
+    num_builds = [0]
+    build = JointRegressor.build
+
+    def count_build(self, body_model):
+        num_builds[0] += 1
+        return build(self, body_model)
+
+    monkeypatch.setattr(JointRegressor, 'build', count_build)
+
+    create_joint_regressor(body_model, cache_folder=cache_folder)
+    assert num_builds[0] == 1
+    cache_fn = osp.join(cache_folder, 'smplx_neutral.pt')
+    assert osp.exists(cache_fn)
+
+    # A cache built for the same model is loaded
+    create_joint_regressor(body_model, cache_folder=cache_folder)
+    assert num_builds[0] == 1
+
+    # The cached regressor was built for another version of the model
+    data = torch.load(cache_fn)
+    data['key']['template_sum'] += 1.0
+    torch.save(data, cache_fn)
+    regressor = create_joint_regressor(body_model, cache_folder=cache_folder)
+    assert num_builds[0] == 2
+    assert torch.load(cache_fn)['key'] == JointRegressor.cache_key(body_model)
+    assert torch.allclose(regressor(body_model).joints,
+                          body_model(return_verts=False).joints, atol=1e-8)
+
+    # A model with another joint mapping does not use the cached regressor
+    # of the first one
+    other_model = create_model(model_folder, use_face=False,
+                               use_face_contour=False)
+    randomize(other_model)
+    regressor = create_joint_regressor(other_model,
+                                       cache_folder=cache_folder)
+    assert num_builds[0] == 3
+    assert torch.allclose(regressor(other_model).joints,
+                          other_model(return_verts=False).joints, atol=1e-8)
+
+
+@pytest.mark.parametrize('use_face_contour', [True, False])
+def test_landmarks_match_body_model(model_folder, use_face_contour):
+    body_model = create_model(model_folder, use_face=True,
+                              use_face_contour=use_face_contour)
+    randomize(body_model)
+    regressor = create_joint_regressor(body_model)
+    num_landmarks = 51 + 17 * use_face_contour
+
+    params = [body_model.body_pose, body_model.jaw_pose,
+              body_model.expression, body_model.betas]
+    landmarks = regressor(body_model).joints[:, -num_landmarks:]
+    grads = torch.autograd.grad(landmarks.pow(2).sum(), params)
+    model_landmarks = body_model(return_verts=True).joints[
+        :, -num_landmarks:]
+    model_grads = torch.autograd.grad(model_landmarks.pow(2).sum(), params)
+
+    assert torch.allclose(landmarks, model_landmarks, atol=1e-8)
+    for grad, model_grad in zip(grads, model_grads):
+        assert torch.allclose(grad, model_grad, atol=1e-8)
+
+
+@pytest.mark.parametrize('use_face', [False, True])
+def test_closure_matches_full_forward(model_folder, monkeypatch, use_face):
+    body_model = create_model(model_folder, use_face=use_face,
+                              use_face_contour=use_face)
+    randomize(body_model)
+    with torch.no_grad():
+        target = body_model(return_verts=False).joints + 0.1
+
+    num_forwards = [0]
+    forward = body_model.forward
+
+    def count_forward(*args, **kwargs):
+        num_forwards[0] += 1
+        return forward(*args, **kwargs)
+
+    monkeypatch.setattr(body_model, 'forward', count_forward)
+    regressor = create_joint_regressor(body_model)
+    loss, grads = evaluate_closure(body_model, regressor, target)
+    # Only the joints are computed, also for the landmarks of the face
+    assert num_forwards[0] == 0
+
+    full_loss, full_grads = evaluate_closure(body_model, None, target)
+    assert num_forwards[0] == 1
+    assert torch.allclose(loss, full_loss, rtol=1e-10)
+    for grad, full_grad in zip(grads, full_grads):
+        assert torch.allclose(grad, full_grad, atol=1e-8)
+
+
+def test_unsupported_mapping_uses_full_forward(model_folder, monkeypatch):
+    # A mapping with joints that the regressor cannot compute, as the
+    # landmarks of the face were before the regressor posed them
+    body_model = create_model(model_folder)
+    randomize(body_model)
+    monkeypatch.setattr(JointRegressor, 'is_supported',
+                        staticmethod(lambda body_model: False))
+    assert create_joint_regressor(body_model) is None
+
+    num_forwards = [0]
+    forward = body_model.forward
+
+    def count_forward(*args, **kwargs):
+        num_forwards[0] += 1
+        assert not kwargs['return_verts']
+        return forward(*args, **kwargs)
+
+    monkeypatch.setattr(body_model, 'forward', count_forward)
+    with torch.no_grad():
+        target = body_model(return_verts=False).joints + 0.1
+    loss, _ = evaluate_closure(body_model, None, target)
+    assert num_forwards[0] == 2
+    assert abs(loss.item() - 0.1 ** 2 * target.numel()) < 1e-8
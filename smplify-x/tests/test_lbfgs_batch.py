@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import torch
+
+import fitting
+from conftest import STARTS, create_closure, quadratic
+from optimizers.lbfgs_ls import LBFGS
+from optimizers.lbfgs_ls_batch import BatchLBFGS
+
+
+def rosenbrock(x):
+    return (100 * (x[..., 1] - x[..., 0] ** 2) ** 2 +
+            (1 - x[..., 0]) ** 2)
+
+
+PROBLEMS = [quadratic, rosenbrock, rosenbrock, quadratic]
+
+
+def stacked_loss(x, problems=PROBLEMS):
+    return torch.stack([problem(x[idx])
+                        for idx, problem in enumerate(problems)])
+
+
+@pytest.mark.parametrize('max_iter', [1, 5])
+def test_matches_separate_runs(max_iter):
+    # With several iterations per step, the line searches of the samples
+    # take different numbers of evaluations before they reach max_eval
+    opt_args = dict(lr=1, max_iter=max_iter, line_search_fn='strong_Wolfe',
+                    tolerance_grad=1e-9, tolerance_change=1e-12)
+    num_steps = 40 // max_iter
+
+    x = torch.tensor(STARTS, dtype=torch.float64, requires_grad=True)
+    optimizer = BatchLBFGS([x], **opt_args)
+    closure = create_closure(optimizer, x, stacked_loss)
+    batch_iterates = []
+    for _ in range(num_steps):
+        optimizer.step(closure)
+        batch_iterates.append(x.detach().clone())
+
+    for idx, problem in enumerate(PROBLEMS):
+        x_single = torch.tensor([STARTS[idx]], dtype=torch.float64,
+                                requires_grad=True)
+        single_optimizer = LBFGS([x_single], **opt_args)
+
+        def single_closure():
+            single_optimizer.zero_grad()
+            loss = problem(x_single).sum()
+            loss.backward()
+            return loss
+
+        for step, batch_x in enumerate(batch_iterates):
+            single_optimizer.step(single_closure)
+            assert torch.allclose(x_single.detach()[0], batch_x[idx],
+                                  rtol=1e-6, atol=1e-8), \
+                'Sample {} differs at step {}'.format(idx, step)
+            assert torch.allclose(problem(x_single.detach()[0]),
+                                  PROBLEMS[idx](batch_x[idx]),
+                                  rtol=1e-6, atol=1e-10)
+
+    # Both problems are solved at the end
+    final_loss = stacked_loss(batch_iterates[-1])
+    assert torch.all(final_loss < 1e-8)
+
+
+def test_converged_sample_stops_updating():
+    # The first sample starts next to the minimum of the quadratic and
+    # converges after a couple of iterations, the Rosenbrock ones do not
+    starts = [[1.0 + 1e-3, -2.0], [-1.2, 1.0], [0.5, -0.5]]
+    problems = [quadratic, rosenbrock, rosenbrock]
+
+    x = torch.tensor(starts, dtype=torch.float64, requires_grad=True)
+    optimizer = BatchLBFGS([x], lr=1, max_iter=1,
+                           line_search_fn='strong_Wolfe',
+                           tolerance_grad=1e-7, tolerance_change=1e-12)
+    closure = create_closure(
+        optimizer, x, lambda x: stacked_loss(x, problems))
+
+    converged_at = None
+    for step in range(40):
+        prev_x = x.detach().clone()
+        optimizer.step(closure)
+        grad_norm = x.grad.abs().max(dim=1)[0]
+        if converged_at is None and grad_norm[0] <= 1e-7:
+            converged_at = step
+            converged_x = x.detach()[0].clone()
+        elif converged_at is not None:
+            assert torch.equal(x.detach()[0], converged_x)
+            # The other samples are still being optimized
+            if step == converged_at + 1:
+                assert not torch.equal(x.detach()[1:], prev_x[1:])
+
+    assert converged_at is not None and converged_at < 5
+    assert torch.all(stacked_loss(x.detach(), problems) < 1e-8)
+
+
+def test_nan_sample_is_frozen():
+    num_evals = [0]
+    frozen = {}
+
+    def loss_func(x):
+        # The model of the third sample diverges at the start of a step,
+        # after a few evaluations
+        num_evals[0] += 1
+        if monitor.sample_loss is None and 'x' not in frozen:
+            if num_evals[0] > 4:
+                frozen['x'] = frozen['start']
+            else:
+                frozen['start'] = x.detach()[2].clone()
+        loss = stacked_loss(x)
+        if 'x' not in frozen:
+            return loss
+        nan_mask = torch.arange(x.shape[0]) == 2
+        return torch.where(nan_mask, torch.full_like(loss, float('nan')),
+                           loss)
+
+    x = torch.tensor(STARTS, dtype=torch.float64, requires_grad=True)
+    optimizer = BatchLBFGS([x], lr=1, max_iter=1,
+                           line_search_fn='strong_Wolfe',
+                           tolerance_grad=1e-9, tolerance_change=1e-12)
+    monitor = fitting.FittingMonitor(maxiters=100, ftol=1e-14, gtol=1e-9,
+                                     batch_size=x.shape[0])
+    closure = create_closure(optimizer, x, loss_func, monitor=monitor)
+
+    with monitor:
+        final_loss = monitor.run_batch_fitting(optimizer, closure, [x],
+                                               None, use_vposer=False)
+
+    exit_codes = [fitting.EXIT_REASONS[code]
+                  for code in monitor.exit_code.tolist()]
+    assert exit_codes[2] == 'nan'
+    assert all(code in ('ftol', 'gtol') for idx, code in enumerate(exit_codes)
+               if idx != 2)
+
+    # The frozen sample stopped early and keeps its last finite loss, while
+    # the rest of the batch was optimized until convergence
+    steps = monitor.sample_steps.tolist()
+    assert steps[2] < max(steps)
+    assert torch.isfinite(final_loss[2])
+    other = [0, 1, 3]
+    assert torch.all(final_loss[other] < 1e-8)
+    assert torch.all(stacked_loss(x.detach())[other] < 1e-8)
+    # The parameters of the frozen sample are those of the last step whose
+    # loss was finite
+    assert torch.equal(x.detach()[2], frozen['x'])
+
+
+@pytest.mark.parametrize('line_search_fn,lr', [('strong_Wolfe', 1.0),
+                                               (None, 0.05)])
+def test_float64_state_matches_float64(line_search_fn, lr):
+    # Two iterations per step also re-evaluate the loss after a fixed step
+    problems = [quadratic, quadratic]
+    starts = [STARTS[0], STARTS[3]]
+
+    def run(dtype, state_dtype=None):
+        x = torch.tensor(starts, dtype=dtype, requires_grad=True)
+        optimizer = BatchLBFGS([x], lr=lr, max_iter=2,
+                               line_search_fn=line_search_fn,
+                               tolerance_grad=1e-9, tolerance_change=1e-12,
+                               state_dtype=state_dtype)
+        closure = create_closure(
+            optimizer, x, lambda x: stacked_loss(x, problems))
+        iterates = []
+        for _ in range(20):
+            optimizer.step(closure)
+            iterates.append(x.detach().clone())
+        return iterates
+
+    mixed_iterates = run(torch.float32, state_dtype=torch.float64)
+    for mixed_x, double_x in zip(mixed_iterates, run(torch.float64)):
+        assert mixed_x.dtype == torch.float32
+        # The parameters are the float64 iterates rounded to float32
+        assert torch.allclose(mixed_x.double(), double_x, rtol=1e-6,
+                              atol=1e-6)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import torch
+
+from conftest import STARTS, create_closure, quadratic
+from optimizers.lbfgs_ls import LBFGS
+from optimizers.lbfgs_ls_batch import BatchLBFGS
+
+
+def other_quadratic(x):
+    return quadratic(x, center=(-0.5, 0.5), scale=(4.0, 2.0))
+
+
+def opt_args(**kwargs):
+    args = dict(lr=1, max_iter=1, line_search_fn='strong_Wolfe',
+                tolerance_grad=1e-12, tolerance_change=1e-14)
+    args.update(kwargs)
+    return args
+
+
+def test_history_survives_reset_objective():
+    x = torch.tensor([STARTS[0]], dtype=torch.float64, requires_grad=True)
+    optimizer = LBFGS([x], **opt_args())
+    for _ in range(3):
+        optimizer.step(create_closure(optimizer, x, quadratic,
+                                      batched=False))
+    state = optimizer.state[x]
+    old_dirs = [y.clone() for y in state['old_dirs']]
+    assert len(old_dirs) == 2
+
+    def grad(x):
+        return torch.autograd.functional.jacobian(
+            lambda x: other_quadratic(x).sum(), x).view(-1)
+
+    optimizer.reset_objective()
+    closure = create_closure(optimizer, x, other_quadratic, batched=False)
+    start_x = x.detach().clone()
+    optimizer.step(closure)
+    # The history is kept, so the step is not a steepest descent step,
+    # but the pair of the gradients of the two objectives is not stored
+    assert state['n_iter'] == 4
+    assert len(state['old_dirs']) == len(old_dirs)
+    assert all(torch.equal(y, old_y)
+               for y, old_y in zip(state['old_dirs'], old_dirs))
+    step = (x.detach() - start_x).view(-1)
+    start_grad = grad(start_x)
+    cos = torch.dot(step, -start_grad) / (step.norm() * start_grad.norm())
+    assert cos < 1 - 1e-6
+
+    # The next pair only uses the gradients of the new objective
+    next_x = x.detach().clone()
+    optimizer.step(closure)
+    assert len(state['old_dirs']) == len(old_dirs) + 1
+    assert torch.allclose(state['old_dirs'][-1],
+                          grad(next_x) - start_grad)
+
+
+def test_reset_objective_without_history():
+    x = torch.tensor([STARTS[0]], dtype=torch.float64, requires_grad=True)
+    optimizer = LBFGS([x], **opt_args())
+    optimizer.step(create_closure(optimizer, x, quadratic, batched=False))
+    assert len(optimizer.state[x]['old_dirs']) == 0
+
+    # Without any history the optimizer starts over
+    optimizer.reset_objective()
+    assert x not in optimizer.state
+    optimizer.step(create_closure(optimizer, x, other_quadratic,
+                                  batched=False))
+    assert optimizer.state[x]['n_iter'] == 1
+
+
+def test_batch_history_survives_reset_objective():
+    x = torch.tensor(STARTS, dtype=torch.float64, requires_grad=True)
+    optimizer = BatchLBFGS([x], **opt_args())
+    closure = create_closure(optimizer, x, quadratic)
+    for _ in range(3):
+        optimizer.step(closure)
+
+    # The last sample starts over, as if it had just been added
+    state = optimizer.state[x]
+    state['hist_len'][-1] = 0
+    hist_len = state['hist_len'].clone()
+    old_dirs = state['old_dirs'].clone()
+    assert torch.all(hist_len[:-1] == 2)
+
+    optimizer.reset_objective()
+    assert state['skip_update'].tolist() == [True, True, True, False]
+    assert state['sample_iter'].tolist() == [3, 3, 3, 0]
+
+    closure = create_closure(optimizer, x, other_quadratic)
+    optimizer.step(closure)
+    # The pairs that mix the two objectives are skipped
+    assert torch.equal(state['hist_len'], hist_len)
+    assert torch.equal(state['old_dirs'], old_dirs)
+    assert not state['skip_update'].any()
+
+    prev_grad = state['prev_flat_grad'].clone()
+    optimizer.step(closure)
+    assert torch.equal(state['hist_len'][:-1], hist_len[:-1] + 1)
+    # The newest pair of every sample holds the gradients of the new
+    # objective only
+    idxs = torch.arange(x.shape[0])
+    slots = (state['hist_head'] - 1) % 100
+    assert torch.allclose(state['old_dirs'][idxs, slots][:-1],
+                          (state['prev_flat_grad'] - prev_grad)[:-1])
+
+
+def test_index_batch_keeps_the_state_of_the_samples():
+    index = torch.tensor([3, 0, 2])
+    x_full = torch.tensor(STARTS, dtype=torch.float64, requires_grad=True)
+    x_sub = x_full.detach().clone().requires_grad_()
+    full_optimizer = BatchLBFGS([x_full], **opt_args())
+    sub_optimizer = BatchLBFGS([x_sub], **opt_args())
+    for _ in range(3):
+        full_optimizer.step(create_closure(full_optimizer, x_full,
+                                           quadratic))
+        sub_optimizer.step(create_closure(sub_optimizer, x_sub, quadratic))
+    state = {key: (val.clone() if torch.is_tensor(val) else val)
+             for key, val in sub_optimizer.state[x_sub].items()}
+
+    x_sub = x_sub.detach()[index].clone().requires_grad_()
+    sub_optimizer.index_batch([x_sub], index)
+    assert sub_optimizer.param_groups[0]['params'] == [x_sub]
+    # Every row of the ring buffers and of the per-sample state moves with
+    # its sample, the counters of the batch are kept
+    new_state = sub_optimizer.state[x_sub]
+    assert set(new_state.keys()) == set(state.keys())
+    for key, val in state.items():
+        if torch.is_tensor(val) and val.dim() > 0:
+            assert new_state[key].shape[0] == len(index), key
+            assert torch.equal(new_state[key], val[index]), key
+        else:
+            assert new_state[key] == val, key
+
+    # Both objectives change, and the kept samples continue as in the
+    # full batch
+    full_optimizer.reset_objective()
+    sub_optimizer.reset_objective()
+    for _ in range(5):
+        full_optimizer.step(create_closure(full_optimizer, x_full,
+                                           other_quadratic))
+        sub_optimizer.step(create_closure(sub_optimizer, x_sub,
+                                          other_quadratic))
+        assert torch.allclose(x_sub.detach(), x_full.detach()[index],
+                              rtol=1e-12, atol=1e-14)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import torch
+
+from optimizers.lm import LevenbergMarquardt
+
+
+def rosenbrock_residuals(x):
+    ''' The residuals of the Rosenbrock function, with its minimum at 1 '''
+    return torch.stack([10 * (x[..., 1] - x[..., 0] ** 2), 1 - x[..., 0]],
+                       dim=-1)
+
+
+def exp_residuals(x, times, values):
+    ''' The residuals of the fit of a * exp(b * t) to some values '''
+    return x[..., :1] * torch.exp(x[..., 1:] * times) - values
+
+
+def create_closure(x, residual_func):
+    def closure():
+        return residual_func(x)
+    return closure
+
+
+def test_reaches_minimum():
+    x = torch.tensor([-1.2, 1.0], dtype=torch.float64, requires_grad=True)
+    optimizer = LevenbergMarquardt([x], max_iter=100, tolerance_grad=1e-12,
+                                   tolerance_change=1e-15)
+    optimizer.step(create_closure(x, rosenbrock_residuals))
+
+    assert torch.allclose(x.detach(), torch.ones_like(x), atol=1e-6)
+    assert rosenbrock_residuals(x.detach()).pow(2).sum() < 1e-12
+
+
+def test_batched_samples_reach_their_minimum():
+    times = torch.linspace(0, 2, 10, dtype=torch.float64)
+    gt_params = torch.tensor([[2.0, -0.5], [0.5, 0.3], [1.0, 0.0]],
+                             dtype=torch.float64)
+    values = gt_params[:, :1] * torch.exp(gt_params[:, 1:] * times)
+
+    x = torch.ones_like(gt_params).requires_grad_()
+    optimizer = LevenbergMarquardt([x], max_iter=100, tolerance_grad=1e-12,
+                                   tolerance_change=1e-15, batched=True)
+    loss = optimizer.step(create_closure(
+        x, lambda x: exp_residuals(x, times, values)))
+
+    # The loss of every sample at the start of the step is returned
+    assert loss.shape == (3,)
+    assert torch.allclose(x.detach(), gt_params, atol=1e-6)
+
+
+def test_batched_jacobian_matches_unbatched(monkeypatch):
+    starts = torch.tensor([[-1.2, 1.0], [0.5, -0.5], [2.0, 2.0]],
+                          dtype=torch.float64)
+
+    def run_step(x, batched):
+        optimizer = LevenbergMarquardt([x], max_iter=1, batched=batched)
+        optimizer.step(create_closure(x, rosenbrock_residuals))
+        return x.detach()
+
+    x = starts.clone().requires_grad_()
+    batched_x = run_step(x, batched=True)
+
+    # Every sample as a problem of its own
+    for idx, start in enumerate(starts):
+        x = start.clone().requires_grad_()
+        assert torch.allclose(run_step(x, batched=False), batched_x[idx])
+
+    # The Jacobian computed one row at a time, when PyTorch does not
+    # support batched gradients
+    grad = torch.autograd.grad
+
+    def unbatched_grad(*args, **kwargs):
+        if kwargs.get('is_grads_batched', False):
+            raise TypeError('is_grads_batched is not supported')
+        return grad(*args, **kwargs)
+
+    monkeypatch.setattr(torch.autograd, 'grad', unbatched_grad)
+    x = starts.clone().requires_grad_()
+    assert torch.allclose(run_step(x, batched=True), batched_x)
+
+
+def test_singular_normal_equations(monkeypatch):
+    # Only the sum of the parameters affects the residual, at a scale for
+    # which the damped normal equations are singular
+    scale = 1e10
+
+    def residual_func(x):
+        return scale * (x.sum(dim=-1, keepdim=True) - 3)
+
+    lstsq = torch.linalg.lstsq
+    num_calls = [0]
+
+    def count_lstsq(*args, **kwargs):
+        num_calls[0] += 1
+        return lstsq(*args, **kwargs)
+
+    monkeypatch.setattr(torch.linalg, 'lstsq', count_lstsq)
+
+    x = torch.zeros([1, 2], dtype=torch.float64, requires_grad=True)
+    optimizer = LevenbergMarquardt([x], max_iter=10, damping=0,
+                                   batched=True)
+    optimizer.step(create_closure(x, residual_func))
+
+    assert num_calls[0] > 0
+    assert torch.isfinite(x).all()
+    assert x.detach().sum().item() == pytest.approx(3.0)
+
+
+def test_rejected_steps_restore_the_parameters():
+    torch.manual_seed(0)
+    start = torch.rand([4, 2], dtype=torch.float32) * 10
+    x = start.clone().requires_grad_()
+    # The trial points of the first three samples always look worse, while
+    # the steps of the last one are accepted
+    def residual_func(x):
+        residuals = rosenbrock_residuals(x)
+        if not torch.is_grad_enabled():
+            penalty = torch.tensor([1e6, 1e6, 1e6, 0.0]).unsqueeze(dim=1)
+            residuals = residuals + penalty
+        return residuals
+
+    optimizer = LevenbergMarquardt([x], max_iter=5, batched=True)
+    optimizer.step(create_closure(x, residual_func))
+
+    # The rejected samples are bitwise at their start, in single precision
+    assert torch.equal(x.detach()[:3], start[:3])
+    assert not torch.equal(x.detach()[3], start[3])
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+from prior import MaxMixturePrior
+
+NUM_GAUSSIANS = 6
+POSE_DIM = 69
+
+
+@pytest.fixture(scope='module')
+def gmm():
+    ''' A random mixture with the layout of the pose prior of SMPLify '''
+    rng = np.random.RandomState(0)
+    means = 0.3 * rng.randn(NUM_GAUSSIANS, POSE_DIM)
+    covars = []
+    for _ in range(NUM_GAUSSIANS):
+        basis = rng.randn(POSE_DIM, POSE_DIM)
+        covars.append(0.05 * np.matmul(basis, basis.T) / POSE_DIM +
+                      0.05 * np.eye(POSE_DIM))
+    weights = rng.dirichlet(np.ones(NUM_GAUSSIANS))
+    return dict(means=means, covars=np.stack(covars), weights=weights)
+
+
+@pytest.fixture(scope='module')
+def prior_folder(gmm, tmp_path_factory):
+    folder = tmp_path_factory.mktemp('prior')
+    with open(str(folder / 'gmm_{:02d}.pkl'.format(NUM_GAUSSIANS)),
+              'wb') as f:
+        pickle.dump(gmm, f)
+    return str(folder)
+
+
+def reference_merged(gmm, pose):
+    ''' The merged likelihood with the dense precisions '''
+    means = torch.tensor(gmm['means'])
+    precisions = torch.inverse(torch.tensor(gmm['covars']))
+    sqrdets = torch.det(torch.tensor(gmm['covars'])).sqrt()
+    const = (2 * np.pi) ** (POSE_DIM / 2.)
+    nll_weights = torch.tensor(gmm['weights']) / (
+        const * (sqrdets / sqrdets.min()))
+
+    diff_from_mean = pose.unsqueeze(dim=1) - means
+    prec_diff_prod = torch.einsum('mij,bmj->bmi',
+                                  [precisions, diff_from_mean])
+    diff_prec_quadratic = (prec_diff_prod * diff_from_mean).sum(dim=-1)
+    curr_loglikelihood = 0.5 * diff_prec_quadratic - torch.log(nll_weights)
+    return torch.min(curr_loglikelihood, dim=1)[0]
+
+
+def reference_log_likelihood(gmm, pose, epsilon=1e-16):
+    ''' The likelihood of the closest component, with the determinant of
+        every component computed on its own
+    '''
+    likelihoods = []
+    for mean, cov in zip(torch.tensor(gmm['means']),
+                         torch.tensor(gmm['covars'])):
+        diff_from_mean = pose - mean
+        quadratic = torch.einsum('bj,ji,bi->b', [diff_from_mean,
+                                                 torch.inverse(cov),
+                                                 diff_from_mean])
+        cov_term = torch.log(torch.det(cov) + epsilon)
+        likelihoods.append(quadratic + 0.5 * (
+            cov_term + POSE_DIM * np.log(2 * np.pi)))
+    likelihoods = torch.stack(likelihoods, dim=1)
+    min_likelihood, min_idx = torch.min(likelihoods, dim=1)
+
+    sqrdets = torch.det(torch.tensor(gmm['covars'])).sqrt()
+    const = (2 * np.pi) ** (POSE_DIM / 2.)
+    nll_weights = torch.tensor(gmm['weights']) / (
+        const * (sqrdets / sqrdets.min()))
+    return -torch.log(nll_weights[min_idx]) + min_likelihood
+
+
+def sample_poses(gmm, num_poses=16, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    means = torch.tensor(gmm['means'])
+    idxs = torch.arange(num_poses) % NUM_GAUSSIANS
+    return means[idxs] + 0.5 * torch.randn(
+        [num_poses, POSE_DIM], generator=generator, dtype=torch.float64)
+
+
+@pytest.mark.parametrize('use_merged', [True, False])
+def test_matches_reference(gmm, prior_folder, use_merged):
+    prior = MaxMixturePrior(prior_folder=prior_folder,
+                            num_gaussians=NUM_GAUSSIANS,
+                            dtype=torch.float64, use_merged=use_merged)
+    pose = sample_poses(gmm)
+    if use_merged:
+        expected = reference_merged(gmm, pose)
+    else:
+        expected = reference_log_likelihood(gmm, pose)
+
+    loss = prior(pose, None)
+    assert loss.shape == (pose.shape[0],)
+    assert torch.allclose(loss, expected, rtol=1e-10)
+
+    # Poses with more leading dimensions
+    loss = prior(pose.view(2, -1, POSE_DIM), None)
+    assert torch.allclose(loss, expected.view(2, -1), rtol=1e-10)
+
+    # In single precision the determinants are still computed in double
+    # precision
+    prior32 = MaxMixturePrior(prior_folder=prior_folder,
+                              num_gaussians=NUM_GAUSSIANS,
+                              dtype=torch.float32, use_merged=use_merged)
+    loss32 = prior32(pose.float(), None)
+    assert torch.allclose(loss32.double(), expected, rtol=1e-4)
+
+
+@pytest.mark.parametrize('use_merged', [True, False])
+def test_residuals_match_loss(gmm, prior_folder, use_merged):
+    prior = MaxMixturePrior(prior_folder=prior_folder,
+                            num_gaussians=NUM_GAUSSIANS,
+                            dtype=torch.float64, use_merged=use_merged)
+    pose = sample_poses(gmm, seed=2)
+
+    residuals = prior.residuals(pose, None)
+    assert residuals.shape == (pose.shape[0], POSE_DIM + 1)
+    assert torch.allclose(residuals.pow(2).sum(dim=1), prior(pose, None),
+                          rtol=1e-10)
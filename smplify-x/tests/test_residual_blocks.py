@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+
+import pytest
+import torch
+
+import fitting
+from camera import create_camera
+from prior import L2Prior, SMPLifyAnglePrior
+
+ModelOutput = namedtuple('ModelOutput', [
+    'joints', 'vertices', 'body_pose', 'betas', 'full_pose',
+    'left_hand_pose', 'right_hand_pose', 'expression', 'jaw_pose'])
+
+BATCH_SIZE = 3
+NUM_JOINTS = 25
+RHO = 100
+
+
+def robustifier(residual, rho=RHO):
+    ''' The Geman-McClure penalty of the original loss '''
+    squared_res = residual ** 2
+    return rho ** 2 * squared_res / (squared_res + rho ** 2)
+
+
+def per_sample(value):
+    return value.reshape(value.shape[0], -1).sum(dim=1)
+
+
+@pytest.fixture
+def inputs():
+    generator = torch.Generator().manual_seed(0)
+
+    def randn(*shape, scale=1.0):
+        return scale * torch.randn(shape, generator=generator,
+                                   dtype=torch.float64)
+
+    full_pose = randn(BATCH_SIZE, 165, scale=0.5)
+    output = ModelOutput(
+        joints=randn(BATCH_SIZE, NUM_JOINTS, 3, scale=0.5),
+        vertices=None,
+        body_pose=full_pose[:, 3:66], betas=randn(BATCH_SIZE, 10),
+        full_pose=full_pose,
+        left_hand_pose=randn(BATCH_SIZE, 12),
+        right_hand_pose=randn(BATCH_SIZE, 12),
+        expression=randn(BATCH_SIZE, 10), jaw_pose=randn(BATCH_SIZE, 3))
+
+    camera = create_camera(batch_size=BATCH_SIZE, dtype=torch.float64,
+                           center=torch.full([BATCH_SIZE, 2], 500.0,
+                                             dtype=torch.float64))
+    with torch.no_grad():
+        camera.translation[:] = randn(BATCH_SIZE, 3, scale=0.1)
+        camera.translation[:, 2] += 20
+        # Some joints are far from their detection, beyond rho
+        gt_joints = camera(output.joints) + randn(BATCH_SIZE, NUM_JOINTS, 2,
+                                                  scale=100)
+    return dict(body_model_output=output, camera=camera,
+                gt_joints=gt_joints,
+                joints_conf=torch.rand([BATCH_SIZE, NUM_JOINTS],
+                                       generator=generator,
+                                       dtype=torch.float64),
+                joint_weights=torch.rand([1, NUM_JOINTS],
+                                         generator=generator,
+                                         dtype=torch.float64),
+                pose_embedding=randn(BATCH_SIZE, 32),
+                body_model_faces=None)
+
+
+def reference_terms(loss, inputs, use_vposer=False):
+    ''' The terms of the loss, per sample, as the loss used to sum them '''
+    output = inputs['body_model_output']
+    projected_joints = inputs['camera'](output.joints)
+    weights = (inputs['joint_weights'] * inputs['joints_conf']).unsqueeze(
+        dim=-1)
+    data_weight = fitting.sample_weight(loss.data_weight, 3)
+
+    terms = {}
+    terms['joints'] = per_sample(
+        weights ** 2 * robustifier(inputs['gt_joints'] - projected_joints) *
+        data_weight ** 2)
+    if use_vposer:
+        terms['pose_prior'] = (per_sample(inputs['pose_embedding'] ** 2) *
+                               loss.body_pose_weight ** 2)
+    else:
+        terms['pose_prior'] = loss.body_pose_prior(
+            output.body_pose, output.betas) * loss.body_pose_weight ** 2
+    terms['shape_prior'] = (loss.shape_prior(output.betas) *
+                            loss.shape_weight ** 2)
+    terms['angle_prior'] = per_sample(
+        loss.angle_prior(output.full_pose[:, 3:66])) * \
+        loss.bending_prior_weight
+    terms['left_hand_prior'] = loss.left_hand_prior(
+        output.left_hand_pose) * loss.hand_prior_weight ** 2
+    terms['right_hand_prior'] = loss.right_hand_prior(
+        output.right_hand_pose) * loss.hand_prior_weight ** 2
+    terms['expression_prior'] = loss.expr_prior(
+        output.expression) * loss.expr_prior_weight ** 2
+    terms['jaw_prior'] = per_sample(loss.jaw_prior(
+        output.jaw_pose.mul(loss.jaw_prior_weight)))
+    return terms
+
+
+@pytest.mark.parametrize('use_vposer', [False, True])
+def test_blocks_match_the_loss_terms(body_pose_prior, inputs, use_vposer):
+    loss = fitting.create_loss(
+        'smplify', rho=RHO, body_pose_prior=body_pose_prior,
+        shape_prior=L2Prior(), expr_prior=L2Prior(), jaw_prior=L2Prior(),
+        left_hand_prior=L2Prior(), right_hand_prior=L2Prior(),
+        angle_prior=SMPLifyAnglePrior(dtype=torch.float64),
+        use_joints_conf=True, interpenetration=False, reduction='none',
+        dtype=torch.float64)
+    loss.reset_loss_weights({
+        'data_weight': torch.tensor([1.0, 2.0, 0.5], dtype=torch.float64),
+        'body_pose_weight': 4.78, 'shape_weight': 5.0,
+        'bending_prior_weight': 15.2, 'hand_prior_weight': 3.0,
+        'expr_prior_weight': 2.0,
+        'jaw_prior_weight': torch.tensor([10.0, 20.0, 30.0],
+                                         dtype=torch.float64)})
+
+    blocks = loss.residual_blocks(use_vposer=use_vposer, **inputs)
+    terms = reference_terms(loss, inputs, use_vposer=use_vposer)
+    assert set(blocks.keys()) == set(terms.keys())
+
+    block_losses = fitting.block_losses(blocks)
+    for name, term in terms.items():
+        assert block_losses[name].shape == (BATCH_SIZE,)
+        assert torch.allclose(block_losses[name], term, rtol=1e-10), name
+
+    # The loss of every sample and the loss of the batch
+    total = sum(terms.values())
+    assert torch.allclose(loss(use_vposer=use_vposer, **inputs), total,
+                          rtol=1e-10)
+    loss.reduction = 'sum'
+    assert torch.allclose(loss(use_vposer=use_vposer, **inputs), total.sum(),
+                          rtol=1e-10)
+    residuals = loss.residuals(use_vposer=use_vposer, **inputs)
+    assert torch.allclose(residuals.pow(2).sum(dim=1), total, rtol=1e-10)
+
+
+def test_blocks_match_the_camera_loss(inputs):
+    init_joints_idxs = torch.tensor([9, 12, 2, 5])
+    trans_estimation = inputs['camera'].translation.detach() + 0.5
+    loss = fitting.create_loss(
+        'camera_init', init_joints_idxs=init_joints_idxs,
+        trans_estimation=trans_estimation, depth_loss_weight=1e2,
+        reduction='none', dtype=torch.float64)
+    loss.reset_loss_weights({'data_weight': [1.0, 2.0, 0.5]})
+
+    output = inputs['body_model_output']
+    camera = inputs['camera']
+    gt_joints = inputs['gt_joints']
+    blocks = loss.residual_blocks(output, camera=camera, gt_joints=gt_joints)
+    assert list(blocks.keys()) == ['joints', 'depth']
+
+    projected_joints = camera(output.joints)
+    joint_term = per_sample(
+        (gt_joints[:, init_joints_idxs] -
+         projected_joints[:, init_joints_idxs]).pow(2)) * \
+        loss.data_weight ** 2
+    depth_term = loss.depth_loss_weight ** 2 * (
+        camera.translation[:, 2] - trans_estimation[:, 2]).pow(2)
+
+    block_losses = fitting.block_losses(blocks)
+    assert torch.allclose(block_losses['joints'], joint_term, rtol=1e-10)
+    assert torch.allclose(block_losses['depth'], depth_term, rtol=1e-10)
+
+    loss.reduction = 'sum'
+    assert torch.allclose(loss(output, camera=camera, gt_joints=gt_joints),
+                          (joint_term + depth_term).sum(), rtol=1e-10)